@@ -0,0 +1,141 @@
+"""
+Measures VariableInspector (the analysis run on every edit) on large
+generated cells, against the astor.TreeWalk based inspector it replaced.
+
+Usage:
+
+    python benchmarks/analysis_benchmark.py --lines 100 --lines 5000
+"""
+import os
+import ast
+import sys
+import time
+import astor
+import click
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from sheets.env import VariableInspector  # noqa: E402
+
+
+class TreeWalkInspector(astor.TreeWalk):
+    """The previous VariableInspector, which walked assignment targets again
+    and didn't handle scopes"""
+
+    def init_variables(self):
+        self.used = set()
+        self.set = set()
+        self.imports = set()
+        self.in_target = False
+
+    def pre_arg(self):
+        self.set.add(self.cur_node.arg)
+
+    def pre_Name(self):
+        if self.in_target:
+            self.set.add(self.cur_node.id)
+        else:
+            self.used.add(self.cur_node.id)
+
+    def pre_For(self):
+        self.process_assignment(self.cur_node.target)
+
+    def pre_Assign(self):
+        self.process_assignment(self.cur_node.targets)
+
+    def pre_withitem(self):
+        self.process_assignment(self.cur_node.optional_vars)
+
+    def pre_ExceptHandler(self):
+        if self.cur_node.name:
+            self.set.add(self.cur_node.name)
+
+    def pre_alias(self):
+        name = self.cur_node.asname or self.cur_node.name
+        name = name.split(".")[0]
+        self.set.add(name)
+        self.imports.add(name)
+
+    def pre_FunctionDef(self):
+        self.set.add(self.cur_node.name)
+
+    def pre_ListComp(self):
+        self.process_assignment(self.cur_node.elt)
+
+    def process_assignment(self, item):
+        if isinstance(item, list):
+            for x in item:
+                self.process_assignment(x)
+            return
+        old_in_target = self.in_target
+        self.in_target = True
+        try:
+            self.walk(item)
+        finally:
+            self.in_target = old_in_target
+
+
+# Repeated to make a cell, with {i} replaced by the block number:
+block = """
+import math as m{i}
+data{i} = [x * {i} for x in range(100) if x % 3]
+a{i}, (b{i}, c{i}) = data{i}[0], (data{i}[1], data{i}[-1])
+table{i} = {{k: v + offset for k, v in zip(names, data{i})}}
+table{i}["total"] = sum(table{i}.values())
+
+def f{i}(value, scale=2, *args, **kw):
+    result = []
+    for item in value:
+        if item > limit:
+            result.append(m{i}.sqrt(item) * scale)
+        else:
+            result.append(helper(item, *args, **kw))
+    return [r for r in result if r]
+
+class C{i}(Base):
+    size = {i}
+    def method(self, other):
+        return self.size + other.size + f{i}(data{i})
+
+with open(path) as fp{i}:
+    lines{i} = [line.strip() for line in fp{i}]
+total{i} = f{i}(data{i}) + [c{i}]
+"""
+
+
+def make_cell(lines):
+    block_lines = block.count("\n")
+    return "".join(block.format(i=i) for i in range(max(lines // block_lines, 1)))
+
+
+def time_analysis(func, tree, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        func(tree)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def run(lines, repeat):
+    source = make_cell(lines)
+    tree = ast.parse(source)
+    single_pass = time_analysis(lambda tree: VariableInspector().walk(tree), tree, repeat)
+    tree_walk = time_analysis(lambda tree: TreeWalkInspector().walk(tree), tree, repeat)
+    print("%6i lines: VariableInspector %8.2f ms, TreeWalk inspector %8.2f ms" % (
+        source.count("\n"), single_pass * 1000, tree_walk * 1000))
+
+
+@click.command()
+@click.option("--lines", multiple=True, type=int,
+              help="Approximate lines in the generated cell (default 100, 1000, 10000)")
+@click.option("--repeat", default=5, help="Times to analyze each cell (the best is shown)")
+def main(lines, repeat):
+    for line_count in lines or [100, 1000, 10000]:
+        run(line_count, repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+Measures how fast each history backend saves and replays commands.
+
+Usage:
+
+    python benchmarks/history_benchmark.py --count 10000 --count 100000
+    python benchmarks/history_benchmark.py --backend sqlite --count 1000000
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+import click
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from sheets.history import History  # noqa: E402
+from sheets.historystore import backends, rocksdb  # noqa: E402
+from sheets.datalayer import FileEdit, Analysis, Execution  # noqa: E402
+
+
+def make_commands(count, files=50):
+    """A synthetic history: mostly edits, with analysis and executions mixed
+    in, roughly like a session of typing and running cells"""
+    for i in range(count):
+        filename = "cell-%s.py" % (i % files)
+        content = "x%s = %s\n" % (i, i) * (1 + i % 20)
+        id = "c-%020d" % i
+        if i % 10 == 9:
+            yield Execution(
+                id=id, filename=filename, content=content,
+                emitted=[{"type": "print", "time": i, "parts": [{"type": "str", "str": str(i)}]}],
+                defines={"x%s" % i: {"json": {"type": "plain_str", "str": str(i)}, "type": "<class 'int'>"}},
+                start_time=i, end_time=i, exec_time=0)
+        elif i % 10 == 8:
+            yield Analysis(
+                id=id, filename=filename, content=content,
+                properties={"variables_used": [], "variables_set": ["x%s" % i], "imports": []})
+        else:
+            yield FileEdit(id=id, filename=filename, content=content)
+
+
+def run(backend, count):
+    path = tempfile.mkdtemp(prefix="sheets-bench-")
+    try:
+        history = History(path, backend=backend)
+        commands = list(make_commands(count))
+        start = time.time()
+        for command in commands:
+            history.save_command(command)
+        history.store.close()
+        save_time = time.time() - start
+        history = History(path, backend=backend)
+        start = time.time()
+        replayed = history.get_commands()
+        replay_time = time.time() - start
+        assert len(replayed) == count, (len(replayed), count)
+        print("%-8s %9i commands: save %9.0f commands/sec, replay %7.3f sec" % (
+            backend, count, count / save_time, replay_time))
+    finally:
+        shutil.rmtree(path)
+
+
+@click.command()
+@click.option("--backend", multiple=True, type=click.Choice(sorted(backends)),
+              help="Backends to test (default all available)")
+@click.option("--count", multiple=True, type=int,
+              help="Number of commands in the history (default 10000)")
+def main(backend, count):
+    backend = backend or [name for name in sorted(backends) if name != "rocksdb" or rocksdb]
+    count = count or [10000]
+    for c in count:
+        for name in backend:
+            run(name, c)
+
+
+if __name__ == "__main__":
+    main()
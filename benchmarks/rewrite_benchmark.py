@@ -0,0 +1,72 @@
+"""
+Measures rewriting cells for subexpressions, with expression strings taken
+from the source (as RewriteExprToPrint does) and with astor.to_source on
+every expression (as it used to), on generated cells of nested expressions.
+
+Usage:
+
+    python benchmarks/rewrite_benchmark.py --lines 100 --lines 1000 --depth 8
+"""
+import os
+import ast
+import sys
+import time
+import astor
+import click
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from sheets.env import RewriteExprToPrint  # noqa: E402
+
+
+class AstorRewriteExprToPrint(RewriteExprToPrint):
+
+    def expr_source(self, node):
+        return astor.to_source(node)
+
+
+def nested_expr(depth, i):
+    if not depth:
+        return "x%s" % (i % 10)
+    return "f(%s + %s.a[%s], y=-%s)" % (
+        nested_expr(depth - 1, i), "o", i, nested_expr(depth - 1, i + 1) if depth < 3 else "z")
+
+
+def make_cell(lines, depth):
+    return "\n".join("v%s = %s" % (i, nested_expr(depth, i)) for i in range(lines)) + "\n"
+
+
+def time_rewrite(cls, source, repeat):
+    best = None
+    for i in range(repeat):
+        tree = ast.parse(source)
+        start = time.time()
+        cls(source, subexpressions=True).walk(tree)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def run(lines, depth, repeat):
+    source = make_cell(lines, depth)
+    segments = time_rewrite(RewriteExprToPrint, source, repeat)
+    to_source = time_rewrite(AstorRewriteExprToPrint, source, repeat)
+    print("%5i lines, depth %2i: source segments %8.1f ms, astor.to_source %8.1f ms" % (
+        lines, depth, segments * 1000, to_source * 1000))
+
+
+@click.command()
+@click.option("--lines", multiple=True, type=int,
+              help="Lines in the generated cell (default 100, 1000)")
+@click.option("--depth", multiple=True, type=int,
+              help="Nesting depth of each line's expression (default 2, 4, 8)")
+@click.option("--repeat", default=3, help="Times to rewrite each cell (the best is shown)")
+def main(lines, depth, repeat):
+    for line_count in lines or [100, 1000]:
+        for nesting in depth or [2, 4, 8]:
+            run(line_count, nesting, repeat)
+
+
+if __name__ == "__main__":
+    main()
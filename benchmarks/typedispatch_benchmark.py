@@ -0,0 +1,75 @@
+"""
+Measures TypeDispatcher lookups with many registered types: with the
+resolution cache, resolving on every call without it, and with the
+quadratic ranking funcs_for_type used before it was cached.
+
+Usage:
+
+    python benchmarks/typedispatch_benchmark.py --registrations 10 --registrations 500
+"""
+import os
+import sys
+import time
+import click
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from sheets.typedispatch import TypeDispatcher  # noqa: E402
+
+
+def ranked_funcs_for_type(dispatch, t):
+    """The previous funcs_for_type, which ranked each matching function by
+    how many of the other matching types its type is a subclass of"""
+    options = [
+        (f, f_type) for f_type, f in dispatch.registered
+        if issubclass(t, f_type)]
+    options_ranked = [
+        (len([f_type for sub_f, f_type in options if issubclass(main_type, f_type)]), f)
+        for f, main_type in options]
+    options_ranked.sort(key=lambda x: -x[0])
+    return [f for c, f in options_ranked]
+
+
+def make_dispatcher(registrations):
+    """A dispatcher with a chain of subclasses, each with its own function,
+    like a stack of support modules each registering their own types"""
+    dispatch = TypeDispatcher()
+    classes = [object]
+    for i in range(registrations):
+        cls = type("Class%s" % i, (classes[-1],), {})
+        classes.append(cls)
+        dispatch.register_function(cls, lambda ob, i=i: i)
+    return dispatch, classes
+
+
+def time_lookups(func, types, lookups):
+    start = time.time()
+    for i in range(lookups):
+        func(types[i % len(types)])
+    return (time.time() - start) / lookups
+
+
+def run(registrations, lookups):
+    dispatch, classes = make_dispatcher(registrations)
+    # A handful of types in use at once, like watched objects in a sheet:
+    types = classes[-10:] + [int, str, dict]
+    cached = time_lookups(dispatch.funcs_for_type, types, lookups)
+    uncached_lookups = max(lookups // 100, 10)
+    uncached = time_lookups(dispatch.resolve, types, uncached_lookups)
+    ranked_lookups = max(lookups // 10000, 3)
+    ranked = time_lookups(lambda t: ranked_funcs_for_type(dispatch, t), types, ranked_lookups)
+    print("%5i registrations: cached %8.2f us, uncached %10.2f us, previous ranking %12.2f us per lookup" % (
+        registrations, cached * 1e6, uncached * 1e6, ranked * 1e6))
+
+
+@click.command()
+@click.option("--registrations", multiple=True, type=int,
+              help="Number of registered types (default 10, 100, 500)")
+@click.option("--lookups", default=100000, help="Lookups to time")
+def main(registrations, lookups):
+    for count in registrations or [10, 100, 500]:
+        run(count, lookups)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,7 +3,11 @@ export let AllCommands = {};
 export class Model {
   constructor() {
     this.files = new Map();
+    // Handle -> {offset: page} for values fetched with ExpandValue:
+    this.expansions = new Map();
     this.showNavigation = false;
+    // Metrics from the latest ServerStats command:
+    this.serverStats = null;
     this.connectionLive = false;
     this.connectionDirection = null;
     this._connectionTimeout = null;
@@ -64,6 +68,9 @@ export const FileEdit = AllCommands.FileEdit = class FileEdit extends Command {
     this.filename = options.filename;
     this.content = options.content;
     this.external_edit = !!options.external_edit;
+    // Set by the server (e.g. when resyncing after a rejected patch), so
+    // later patches are made against the server's version:
+    this.version = options.version;
   }
 
   applyToModel(model) {
@@ -79,6 +86,92 @@ export const FileEdit = AllCommands.FileEdit = class FileEdit extends Command {
     let f = model.files.get(this.filename);
     f.content = this.content;
     f.external_edit = this.external_edit;
+    f.version = this.version === null || this.version === undefined ? (f.version || 0) + 1 : this.version;
+  }
+};
+
+// Patch offsets are in Unicode code points, like Python string indexes,
+// while JavaScript strings are indexed by UTF-16 code units
+const surrogatePattern = /[\uD800-\uDBFF]/g;
+const hasSurrogate = /[\uD800-\uDBFF]/;
+
+export function codePointLength(s) {
+  let surrogates = s.match(surrogatePattern);
+  return s.length - (surrogates ? surrogates.length : 0);
+}
+
+function codeUnitOffset(s, codePoints) {
+  if (!hasSurrogate.test(s)) {
+    return codePoints;
+  }
+  let offset = 0;
+  for (let i=0; i<codePoints; i++) {
+    let c = s.charCodeAt(offset);
+    offset += (c >= 0xD800 && c <= 0xDBFF) ? 2 : 1;
+  }
+  return offset;
+}
+
+export function applyPatch(content, ops) {
+  for (let [start, end, text] of ops) {
+    let startOffset = codeUnitOffset(content, start);
+    let endOffset = startOffset + codeUnitOffset(content.substr(startOffset), end - start);
+    content = content.substr(0, startOffset) + text + content.substr(endOffset);
+  }
+  return content;
+}
+
+export const FilePatch = AllCommands.FilePatch = class FilePatch extends Command {
+  constructor(options) {
+    super()
+    this.filename = options.filename;
+    this.base_version = options.base_version;
+    this.version = options.version;
+    this.ops = options.ops;
+    this.external_edit = !!options.external_edit;
+  }
+
+  // A patch replacing everything between the common prefix and suffix of
+  // oldContent and newContent
+  static fromContents(filename, oldContent, newContent, baseVersion) {
+    let limit = Math.min(oldContent.length, newContent.length);
+    let prefix = 0;
+    while (prefix < limit && oldContent.charCodeAt(prefix) == newContent.charCodeAt(prefix)) {
+      prefix++;
+    }
+    limit -= prefix;
+    let suffix = 0;
+    while (suffix < limit && oldContent.charCodeAt(oldContent.length - suffix - 1) == newContent.charCodeAt(newContent.length - suffix - 1)) {
+      suffix++;
+    }
+    // Don't split a surrogate pair:
+    let c = oldContent.charCodeAt(prefix - 1);
+    if (prefix && c >= 0xD800 && c <= 0xDBFF) {
+      prefix--;
+    }
+    c = oldContent.charCodeAt(oldContent.length - suffix);
+    if (suffix && c >= 0xDC00 && c <= 0xDFFF) {
+      suffix--;
+    }
+    let start = codePointLength(oldContent.substr(0, prefix));
+    let end = start + codePointLength(oldContent.substring(prefix, oldContent.length - suffix));
+    return new FilePatch({
+      filename,
+      base_version: baseVersion,
+      version: baseVersion + 1,
+      ops: [[start, end, newContent.substring(prefix, newContent.length - suffix)]],
+    });
+  }
+
+  applyToModel(model) {
+    let f = model.files.get(this.filename);
+    if (!f || f.version !== this.base_version) {
+      // The server will reject the patch, and send the real content
+      return;
+    }
+    f.content = applyPatch(f.content || "", this.ops);
+    f.version = this.version;
+    f.external_edit = this.external_edit;
   }
 };
 
@@ -100,6 +193,8 @@ export const ExecutionRequest = AllCommands.ExecutionRequest = class ExecutionRe
     this.filename = options.filename;
     this.content = options.content;
     this.subexpressions = options.subexpressions;
+    this.use_cache = options.use_cache !== false;
+    this.profile = !!options.profile;
   }
 
   applyToModel(model) {
@@ -111,6 +206,24 @@ export const ExecutionRequest = AllCommands.ExecutionRequest = class ExecutionRe
   }
 };
 
+export const ExecuteStaleRequest = AllCommands.ExecuteStaleRequest = class ExecuteStaleRequest extends Command {
+  constructor(options) {
+    super()
+  }
+};
+
+export const KernelInterrupt = AllCommands.KernelInterrupt = class KernelInterrupt extends Command {
+  constructor(options) {
+    super()
+  }
+};
+
+export const KernelRestart = AllCommands.KernelRestart = class KernelRestart extends Command {
+  constructor(options) {
+    super()
+  }
+};
+
 export const Analysis = AllCommands.Analysis = class Analysis extends Command {
   constructor(options) {
     super()
@@ -135,6 +248,128 @@ export const Analysis = AllCommands.Analysis = class Analysis extends Command {
   }
 };
 
+export const ExpandValue = AllCommands.ExpandValue = class ExpandValue extends Command {
+  constructor(options) {
+    super()
+    this.handle = options.handle;
+    this.offset = options.offset;
+    this.count = options.count;
+    this.column_offset = options.column_offset;
+  }
+};
+
+// The key of a page of a value in model.expansions
+export function expansionKey(offset, columnOffset) {
+  let key = offset === null || offset === undefined ? "all" : offset;
+  if (columnOffset !== null && columnOffset !== undefined) {
+    key = `${key}@${columnOffset}`;
+  }
+  return key;
+}
+
+export const ValueExpansion = AllCommands.ValueExpansion = class ValueExpansion extends Command {
+  constructor(options) {
+    super()
+    this.handle = options.handle;
+    this.offset = options.offset;
+    this.column_offset = options.column_offset;
+    this.page = options.page;
+  }
+  applyToModel(model) {
+    let pages = model.expansions.get(this.handle) || {};
+    pages[expansionKey(this.offset, this.column_offset)] = this.page;
+    model.expansions.set(this.handle, pages);
+  }
+};
+
+export const ServerStats = AllCommands.ServerStats = class ServerStats extends Command {
+  constructor(options) {
+    super()
+    this.stats = options.stats;
+  }
+  applyToModel(model) {
+    model.serverStats = this.stats;
+  }
+};
+
+export const Snapshot = AllCommands.Snapshot = class Snapshot extends Command {
+  constructor(options) {
+    super()
+    this.files = options.files;
+  }
+  applyToModel(model) {
+    model.files = new Map();
+    for (let filename in this.files) {
+      let serverFile = this.files[filename];
+      let f = {
+        content: serverFile.content,
+        version: serverFile.version || 0,
+        analysis: serverFile.analysis,
+      };
+      if (serverFile.execution) {
+        f.output = serverFile.execution;
+      }
+      if (serverFile.streaming) {
+        f.streaming = serverFile.streaming;
+        f.output = Object.assign({}, f.output, {emitted: f.streaming.emitted});
+      }
+      if (serverFile.progress) {
+        f.progress = serverFile.progress;
+      }
+      model.files.set(filename, f);
+    }
+  }
+};
+
+export const ExecutionOutput = AllCommands.ExecutionOutput = class ExecutionOutput extends Command {
+  constructor(options) {
+    super()
+    this.filename = options.filename;
+    this.output_id = options.output_id;
+    this.index = options.index;
+    this.emitted = options.emitted;
+  }
+  applyToModel(model) {
+    let f = model.files.get(this.filename);
+    if (!f) {
+      return;
+    }
+    if (!f.streaming || f.streaming.output_id != this.output_id) {
+      f.streaming = {output_id: this.output_id, emitted: []};
+    }
+    f.streaming.emitted = f.streaming.emitted.concat(this.emitted);
+    f.output = Object.assign({}, f.output, {emitted: f.streaming.emitted});
+  }
+};
+
+export const ExecutionProgress = AllCommands.ExecutionProgress = class ExecutionProgress extends Command {
+  constructor(options) {
+    super()
+    this.filename = options.filename;
+    this.loop_id = options.loop_id;
+    this.lineno = options.lineno;
+    this.count = options.count;
+    this.total = options.total;
+    this.elapsed = options.elapsed;
+    this.done = options.done;
+  }
+  applyToModel(model) {
+    let f = model.files.get(this.filename);
+    if (!f) {
+      return;
+    }
+    f.progress = Object.assign({}, f.progress, {
+      [this.loop_id]: {
+        lineno: this.lineno,
+        count: this.count,
+        total: this.total,
+        elapsed: this.elapsed,
+        done: this.done,
+      },
+    });
+  }
+};
+
 export const Execution = AllCommands.Execution = class Execution extends Command {
   constructor(options) {
     super()
@@ -146,16 +381,28 @@ export const Execution = AllCommands.Execution = class Execution extends Command
     this.end_time = options.end_time;
     this.exec_time = options.exec_time;
     this.with_subexpressions = options.with_subexpressions
+    this.cached = !!options.cached;
+    this.output_id = options.output_id;
+    this.output_chunks = options.output_chunks;
+    this.profile = options.profile;
   }
   applyToModel(model) {
     let f = model.files.get(this.filename);
     if (!f) {
       return;
     }
+    let emitted = this.emitted;
+    if (this.output_id && f.streaming && f.streaming.output_id == this.output_id) {
+      emitted = f.streaming.emitted.concat(emitted);
+    }
+    delete f.streaming;
+    delete f.progress;
     f.output = {
       content: this.content,
-      emitted: this.emitted,
+      emitted,
       defines: this.defines,
+      cached: this.cached,
+      profile: this.profile,
     };
     f.isExecuting = false;
   }
@@ -0,0 +1,144 @@
+// Decoding for binary (MessagePack) messages from the server; see
+// sheets/encoding.py.  This list must be kept identical to interned_keys
+// there, and only ever added to at the end.
+export const internedKeys = [
+  "command", "id", "filename", "content", "type", "time", "show_repr",
+  "parts", "str", "repr", "contents", "emitted", "defines", "json",
+  "properties", "variables_used", "variables_set", "imports", "name",
+  "signature", "qualname", "self", "dump", "url", "html", "expr_string",
+  "expr_value", "start_time", "end_time", "exec_time", "with_subexpressions",
+  "cached", "output_id", "output_chunks", "index", "external_edit",
+  "subexpressions", "use_cache", "files", "analysis", "execution",
+  "streaming", "obj", "label", "attributes", "object_class", "doc",
+  "docstring", "dir", "bases", "sep", "end", "remaining_suppressed",
+  "this_suppressed", "embedded", "icon", "exists", "base", "dtype",
+  "values", "ref", "ref_id", "value_type", "version",
+  "base_version", "ops", "profile", "lines", "total_time", "peak_memory",
+  "memory_traced", "stats", "loop_id", "lineno", "count", "total",
+  "elapsed", "done", "progress", "handle", "length", "size", "min", "max",
+  "last",
+];
+
+const textDecoder = new TextDecoder("utf-8");
+
+class Decoder {
+  constructor(bytes) {
+    this.bytes = bytes;
+    this.view = new DataView(bytes.buffer, bytes.byteOffset, bytes.byteLength);
+    this.pos = 0;
+  }
+
+  str(length) {
+    let s = textDecoder.decode(this.bytes.subarray(this.pos, this.pos + length));
+    this.pos += length;
+    return s;
+  }
+
+  bin(length) {
+    let b = this.bytes.slice(this.pos, this.pos + length);
+    this.pos += length;
+    return b;
+  }
+
+  array(length) {
+    let result = new Array(length);
+    for (let i=0; i<length; i++) {
+      result[i] = this.value();
+    }
+    return result;
+  }
+
+  map(length) {
+    let result = {};
+    for (let i=0; i<length; i++) {
+      let key = this.value();
+      if (typeof key == "number") {
+        key = internedKeys[key];
+      }
+      result[key] = this.value();
+    }
+    return result;
+  }
+
+  uint(size) {
+    let v;
+    if (size == 1) {
+      v = this.view.getUint8(this.pos);
+    } else if (size == 2) {
+      v = this.view.getUint16(this.pos);
+    } else if (size == 4) {
+      v = this.view.getUint32(this.pos);
+    } else {
+      v = this.view.getUint32(this.pos) * 0x100000000 + this.view.getUint32(this.pos + 4);
+    }
+    this.pos += size;
+    return v;
+  }
+
+  int(size) {
+    let v;
+    if (size == 1) {
+      v = this.view.getInt8(this.pos);
+    } else if (size == 2) {
+      v = this.view.getInt16(this.pos);
+    } else if (size == 4) {
+      v = this.view.getInt32(this.pos);
+    } else {
+      v = this.view.getInt32(this.pos) * 0x100000000 + this.view.getUint32(this.pos + 4);
+    }
+    this.pos += size;
+    return v;
+  }
+
+  value() {
+    let b = this.view.getUint8(this.pos++);
+    if (b <= 0x7f) {
+      return b;
+    } else if (b <= 0x8f) {
+      return this.map(b & 0x0f);
+    } else if (b <= 0x9f) {
+      return this.array(b & 0x0f);
+    } else if (b <= 0xbf) {
+      return this.str(b & 0x1f);
+    } else if (b >= 0xe0) {
+      return b - 0x100;
+    }
+    let v;
+    switch (b) {
+      case 0xc0: return null;
+      case 0xc2: return false;
+      case 0xc3: return true;
+      case 0xc4: return this.bin(this.uint(1));
+      case 0xc5: return this.bin(this.uint(2));
+      case 0xc6: return this.bin(this.uint(4));
+      case 0xca:
+        v = this.view.getFloat32(this.pos);
+        this.pos += 4;
+        return v;
+      case 0xcb:
+        v = this.view.getFloat64(this.pos);
+        this.pos += 8;
+        return v;
+      case 0xcc: return this.uint(1);
+      case 0xcd: return this.uint(2);
+      case 0xce: return this.uint(4);
+      case 0xcf: return this.uint(8);
+      case 0xd0: return this.int(1);
+      case 0xd1: return this.int(2);
+      case 0xd2: return this.int(4);
+      case 0xd3: return this.int(8);
+      case 0xd9: return this.str(this.uint(1));
+      case 0xda: return this.str(this.uint(2));
+      case 0xdb: return this.str(this.uint(4));
+      case 0xdc: return this.array(this.uint(2));
+      case 0xdd: return this.array(this.uint(4));
+      case 0xde: return this.map(this.uint(2));
+      case 0xdf: return this.map(this.uint(4));
+    }
+    throw new Error(`Unsupported MessagePack type: 0x${b.toString(16)}`);
+  }
+}
+
+export function decode(buffer) {
+  return new Decoder(new Uint8Array(buffer)).value();
+}
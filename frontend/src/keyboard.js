@@ -1,11 +1,17 @@
 // shortcuts with: https://craig.is/killing/mice
 import * as mousetrap from './vendor/mousetrap.min';
+import { executeStale } from './script';
 
 Mousetrap.bind(['ctrl+shift+a', 'command+shift+a'], () => {
   runAll();
   return false;
 });
 
+Mousetrap.bind(['ctrl+shift+s', 'command+shift+s'], () => {
+  executeStale();
+  return false;
+});
+
 Mousetrap.bind('tab', (event) => {
   if (event.target.tagName == "TEXTAREA") {
     insertAtCursor(event.target, "    ");
@@ -1,4 +1,4 @@
-import { model, FileEdit, FileDelete, ExecutionRequest } from './datalayer';
+import { model, FileEdit, FilePatch, FileDelete, ExecutionRequest, ExecuteStaleRequest, KernelInterrupt, KernelRestart, ExpandValue } from './datalayer';
 import { openSocket, registerSocketListener, send } from './socket';
 
 function runAll() {
@@ -12,11 +12,14 @@ function runAll() {
 openSocket();
 
 export function updateFile(filename, content) {
-  let command = new FileEdit({filename, content});
-  if (!model.files.get(filename)) {
-    model.files.set(filename, {});
+  let f = model.files.get(filename);
+  let command;
+  if (f && typeof f.content == "string" && f.version !== undefined) {
+    // Only send the part of the file that changed
+    command = FilePatch.fromContents(filename, f.content, content, f.version);
+  } else {
+    command = new FileEdit({filename, content});
   }
-  model.files.get(filename).content = content;
   send(command);
 }
 
@@ -25,15 +28,33 @@ export function deleteFile(filename) {
   send(command);
 }
 
-export function executeFile(filename, subexpressions) {
+export function executeFile(filename, subexpressions, force, profile) {
   let command = new ExecutionRequest({
     filename,
     content: model.files.get(filename).content,
     subexpressions,
+    use_cache: !force,
+    profile,
   });
   send(command);
 }
 
+export function executeStale() {
+  send(new ExecuteStaleRequest({}));
+}
+
+export function interruptKernel() {
+  send(new KernelInterrupt({}));
+}
+
+export function restartKernel() {
+  send(new KernelRestart({}));
+}
+
+export function expandValue(handle, offset, count, columnOffset) {
+  send(new ExpandValue({handle, offset, count, column_offset: columnOffset}));
+}
+
 registerSocketListener((newStatus) => {
   model.connectionLive = newStatus == "OPENED";
   if (window.renderPage) {
@@ -1,4 +1,5 @@
 import { model, AllCommands, Command } from './datalayer';
+import { decode } from './encoding';
 
 let socket;
 let socketStatus;
@@ -11,14 +12,21 @@ export function openSocket() {
   }
   console.log("Opening socket");
   sendSocketStatus("OPENING");
-  let _socket = new WebSocket("ws://localhost:10101");
+  let _socket = new WebSocket("ws://localhost:10101/?encoding=msgpack");
+  // The server sends binary (MessagePack) frames if it supports them,
+  // otherwise JSON text frames
+  _socket.binaryType = "arraybuffer";
   _socket.onopen = () => {
     socket = _socket;
     sendSocketStatus("OPENED");
     console.log("Connected to WebSocket");
   };
   _socket.onmessage = (event) => {
-    incoming(JSON.parse(event.data));
+    if (typeof event.data == "string") {
+      incoming(JSON.parse(event.data));
+    } else {
+      incoming(decode(event.data));
+    }
   };
   _socket.onclose = (reason) => {
     console.log("Closed:", reason, "reopening...");
@@ -1,9 +1,9 @@
 import React from 'react';
 import * as ReactDOM from 'react-dom';
-import { Button, Container, Dropdown, Menu, Header, Icon, TextArea, Card, Grid, Popup, List, Accordion, Label, Modal, Dimmer, Loader, Segment } from 'semantic-ui-react';
+import { Button, Container, Dropdown, Menu, Header, Icon, TextArea, Card, Grid, Popup, List, Accordion, Label, Modal, Dimmer, Loader, Segment, Table } from 'semantic-ui-react';
 import CodeMirror from 'react-codemirror';
-import { model } from './datalayer';
-import { updateFile, deleteFile, executeFile } from './script';
+import { model, expansionKey } from './datalayer';
+import { updateFile, deleteFile, executeFile, interruptKernel, restartKernel, expandValue } from './script';
 require('codemirror/lib/codemirror.css');
 require("../public/style.css");
 require('codemirror/mode/python/python');
@@ -70,6 +70,13 @@ class PageMenu extends React.Component {
             <Dropdown.Item>List Item</Dropdown.Item>
           </Dropdown.Menu>
         </Dropdown>
+        <Menu.Item as="a" onClick={interruptKernel}>Interrupt</Menu.Item>
+        <Menu.Item as="a" onClick={() => {
+          if (window.confirm("Restart the kernel? All variables will be lost.")) {
+            restartKernel();
+          }
+        }}>Restart kernel</Menu.Item>
+        <ServerStatus stats={this.props.serverStats} />
         <Help trigger={
           <Menu.Item as="a">Shortcuts: Ctrl+?</Menu.Item>
         } />
@@ -79,6 +86,50 @@ class PageMenu extends React.Component {
 
 }
 
+// Timers shown in the server status popup, and what to call them:
+const serverTimers = [
+  ["execution", "Running code"],
+  ["jsonify", "Serializing values"],
+  ["history_save", "Saving history"],
+  ["ws_send", "Sending to clients"],
+  ["task.analyze", "Analyzing files"],
+];
+
+class ServerStatus extends React.Component {
+  render() {
+    let stats = this.props.stats;
+    if (!stats) {
+      return null;
+    }
+    let rows = [];
+    for (let [name, title] of serverTimers) {
+      // Timers from the kernel process have a .kernel suffix
+      let timer = stats.timers[name] || stats.timers[`${name}.kernel`];
+      if (!timer || !timer.count) {
+        continue;
+      }
+      rows.push(<tr key={name}>
+        <td>{title}</td>
+        <td>{timer.count}</td>
+        <td>{formatMilliseconds(timer.total * 1000 / timer.count)}</td>
+        <td>{formatMilliseconds(timer.max * 1000)}</td>
+      </tr>);
+    }
+    let gauges = stats.gauges;
+    return <Popup trigger={<Menu.Item as="a">Server</Menu.Item>} on="click" wide>
+      <div>
+        {gauges.ws_sockets} clients, {gauges.ws_queued} messages queued, {gauges.tasks_pending} tasks pending
+      </div>
+      <table className="table">
+        <thead>
+          <tr><th></th><th>count</th><th>mean</th><th>max</th></tr>
+        </thead>
+        <tbody>{rows}</tbody>
+      </table>
+    </Popup>;
+  }
+}
+
 class CloudStatus extends React.Component {
   render() {
     let name = "cloud";
@@ -129,11 +180,21 @@ class File extends React.Component {
         "Shift-Cmd-Enter": () => {
           executeFile(this.props.name, true);
         },
+        "Shift-Alt-Enter": () => {
+          executeFile(this.props.name, false, true);
+        },
+        "Shift-Alt-P": () => {
+          executeFile(this.props.name, false, true, true);
+        },
       },
+      gutters: ["CodeMirror-linenumbers", "profile-gutter"],
     };
     return <div ref={baseEl => this.baseEl = baseEl} data-name={this.props.name} data-collapsed={this.state.collapsed ? "1" : null}>
       <Dimmer.Dimmable as={Segment} dimmed={this.props.isExecuting}>
-        <Dimmer className="loading" active={this.props.isExecuting}><Loader active /></Dimmer>
+        <Dimmer className="loading" active={this.props.isExecuting}>
+          <Loader active />
+          <LoopProgress progress={this.props.progress} />
+        </Dimmer>
         <Card style={{width: "100%", marginBottom: "1em"}}>
           <Card.Content>
             <Card.Header>
@@ -215,7 +276,40 @@ class File extends React.Component {
     }
   }
 
+  // Shows the time spent on each line in the gutter, if the last execution
+  // was profiled and the code hasn't changed since
+  updateProfileMarkers() {
+    let cm = this.codeMirror;
+    if (!cm) {
+      return;
+    }
+    let output = this.props.output;
+    let profile = output && output.content == this.state.value ? output.profile : null;
+    if (profile === this.shownProfile) {
+      return;
+    }
+    this.shownProfile = profile;
+    cm.clearGutter("profile-gutter");
+    if (!profile) {
+      return;
+    }
+    let total = profile.total_time || 1;
+    for (let [lineno, hits, time, peak] of profile.lines) {
+      let marker = document.createElement("div");
+      marker.className = "profile-marker";
+      marker.textContent = formatMilliseconds(time);
+      marker.style.backgroundColor = `rgba(255, 80, 0, ${Math.min(time / total, 1) * 0.8})`;
+      let title = `${hits} hits, ${formatMilliseconds(time)}`;
+      if (profile.memory_traced) {
+        title += `, ${formatBytes(peak)} peak allocation`;
+      }
+      marker.title = title;
+      cm.setGutterMarker(lineno - 1, "profile-gutter", marker);
+    }
+  }
+
   componentDidMount() {
+    this.updateProfileMarkers();
     return;
     this.refreshFocus();
     this.refreshSelection();
@@ -228,6 +322,7 @@ class File extends React.Component {
   }
 
   componentDidUpdate() {
+    this.updateProfileMarkers();
     return;
     this.refreshFocus();
     this.refreshSelection();
@@ -240,6 +335,55 @@ class File extends React.Component {
   }
 }
 
+function formatMilliseconds(ms) {
+  if (ms >= 1000) {
+    return `${(ms / 1000).toFixed(2)}s`;
+  }
+  return `${ms < 10 ? ms.toFixed(2) : Math.round(ms)}ms`;
+}
+
+function formatBytes(bytes) {
+  if (bytes >= 1024 * 1024) {
+    return `${(bytes / (1024 * 1024)).toFixed(1)}MB`;
+  } else if (bytes >= 1024) {
+    return `${(bytes / 1024).toFixed(1)}KB`;
+  }
+  return `${bytes}B`;
+}
+
+function formatDuration(seconds) {
+  if (seconds >= 3600) {
+    return `${Math.floor(seconds / 3600)}h${Math.floor(seconds % 3600 / 60)}m`;
+  } else if (seconds >= 60) {
+    return `${Math.floor(seconds / 60)}m${Math.floor(seconds % 60)}s`;
+  }
+  return `${seconds.toFixed(1)}s`;
+}
+
+function LoopProgress(props) {
+  if (!props.progress) {
+    return null;
+  }
+  let loops = [];
+  for (let loopId in props.progress) {
+    let p = props.progress[loopId];
+    if (p.done) {
+      continue;
+    }
+    let rate = p.elapsed ? p.count / p.elapsed : 0;
+    let text = `line ${p.lineno}: ${p.count}`;
+    if (p.total !== null && p.total !== undefined) {
+      text += ` / ${p.total} (${Math.floor(100 * p.count / (p.total || 1))}%)`;
+    }
+    text += `, ${rate >= 10 ? Math.round(rate) : rate.toFixed(1)}/s`;
+    if (p.total && rate) {
+      text += `, ${formatDuration(Math.max(p.total - p.count, 0) / rate)} left`;
+    }
+    loops.push(<div key={loopId} className="loop-progress">{text}</div>);
+  }
+  return <div>{loops}</div>;
+}
+
 class Output extends React.Component {
   render() {
     let defines = null;
@@ -279,10 +423,24 @@ class Output extends React.Component {
         </div>;
       }
     }
+    let cached = null;
+    if (this.props.output && this.props.output.cached) {
+      cached = <Label size="mini">cached</Label>;
+    }
+    let profile = null;
+    if (this.props.output && this.props.output.profile) {
+      let p = this.props.output.profile;
+      profile = <Label size="mini">
+        profiled: {formatMilliseconds(p.total_time)}
+        {p.memory_traced ? `, peak allocation ${formatBytes(p.peak_memory)}` : null}
+      </Label>;
+    }
     return <div>
       {imports}
       {used}
       {defines}
+      {cached}
+      {profile}
       {output}
     </div>;
   }
@@ -415,10 +573,22 @@ class Help extends React.Component {
               <td>Shift + Command + Enter</td>
               <td>Execute current cell, tracking subexpressions</td>
             </tr>
+            <tr>
+              <td>Shift + Alt + Enter</td>
+              <td>Execute current cell, even if its inputs haven't changed</td>
+            </tr>
+            <tr>
+              <td>Shift + Alt + P</td>
+              <td>Execute current cell with a line profiler (times are shown next to each line)</td>
+            </tr>
             <tr>
               <td>Command/Ctrl + Shift + A</td>
               <td>Execute all cells</td>
             </tr>
+            <tr>
+              <td>Command/Ctrl + Shift + S</td>
+              <td>Execute cells whose inputs have changed</td>
+            </tr>
             <tr>
               <td>Ctrl + T</td>
               <td>File/cell browser</td>
@@ -454,6 +624,13 @@ function renderRemoteItem(item, key, extraProps) {
   extraProps = extraProps || {};
   let type = item.type;
   let Factory = Factories[type] || GenericFactory;
+  if (item.ref_id !== undefined) {
+    // This value is referred to elsewhere (by ref items) in the same output
+    return <span key={key} className="ref-target">
+      <Label size="mini" basic pointing="right">#{item.ref_id}</Label>
+      <Factory {...item} {...extraProps} />
+    </span>;
+  }
   return <Factory key={key} {...item} {...extraProps} />;
 }
 
@@ -508,6 +685,11 @@ Factories.plain_str = class plain_str extends React.Component {
 
 Factories.str = class str extends React.Component {
   render() {
+    if (this.props.truncated) {
+      return <Folded className="inline" title={<code>{JSON.stringify(this.props.str.substr(0, 40))}... ({this.props.truncated.total} characters)</code>}>
+        <pre style={{overflowWrap: "break-word", whiteSpace: "normal"}}>{this.props.str}<MoreItems {...this.props.truncated} /></pre>
+      </Folded>;
+    }
     let s = JSON.stringify(this.props.str);
     if (s.length > 100) {
       let longS = '"""' + s.substr(1, s.length - 2) + '"""';
@@ -551,6 +733,23 @@ Factories["class"] = class PythonClass extends React.Component {
   }
 };
 
+// Formats a value from a packed list (a list of only ints, floats, bools, or
+// Nones) the way Python would
+function formatPacked(value, dtype) {
+  if (dtype == "bool") {
+    return value ? "True" : "False";
+  } else if (dtype == "NoneType") {
+    return "None";
+  } else if (dtype == "float" && Number.isInteger(value)) {
+    return value.toFixed(1);
+  }
+  return String(value);
+}
+
+function renderPackedItem(value, dtype, i) {
+  return <code key={i} className="packed-item">{formatPacked(value, dtype)}</code>;
+}
+
 Factories.tuple = Factories.list = class list_tuple extends React.Component {
   render() {
     let parts = [];
@@ -559,12 +758,24 @@ Factories.tuple = Factories.list = class list_tuple extends React.Component {
     } else {
       parts.push(<code key="start">[</code>);
     }
-    for (let i=0; i<this.props.content.length; i++) {
-      let item = this.props.contents[i];
-      parts.push(renderRemoteItem(item, i));
+    let length;
+    if (this.props.values) {
+      length = this.props.values.length;
+      for (let i=0; i<length; i++) {
+        parts.push(renderPackedItem(this.props.values[i], this.props.dtype, i));
+      }
+    } else {
+      length = this.props.contents.length;
+      for (let i=0; i<length; i++) {
+        let item = this.props.contents[i];
+        parts.push(renderRemoteItem(item, i));
+      }
+    }
+    if (this.props.truncated) {
+      parts.push(<MoreItems key="more" {...this.props.truncated} render={(item, i) => renderRemoteItem(item, i)} />);
     }
     if (this.props.type == "tuple") {
-      if (this.props.content.length === 1) {
+      if (length === 1) {
         parts.push(<code key="end">,)</code>);
       } else {
         parts.push(<code key="end">)</code>);
@@ -576,17 +787,268 @@ Factories.tuple = Factories.list = class list_tuple extends React.Component {
   }
 };
 
+function renderDictItem(item, i) {
+  return <span key={i}>{renderRemoteItem(item[0])}<code style={{whiteSpace: "nowrap"}}>: </code>{renderRemoteItem(item[1])}</span>;
+}
+
 Factories.dict = class dict extends React.Component {
   render() {
     let parts = [];
     for (let i=0; i < this.props.contents.length; i++) {
-      let item = this.props.contents[i];
-      parts.push(<span key={i}>{renderRemoteItem(item[0])}<code style={{whiteSpace: "nowrap"}}>: </code>{renderRemoteItem(item[1])}</span>);
+      parts.push(renderDictItem(this.props.contents[i], i));
+    }
+    if (this.props.truncated) {
+      parts.push(<MoreItems key="more" {...this.props.truncated} render={renderDictItem} />);
     }
     return <span><code>{"{"}</code>{parts}<code>{"}"}</code></span>;
   }
 };
 
+// The rest of a truncated list, dict, or string, fetched a page at a time
+// (from the handle, shown, and total properties)
+class MoreItems extends React.Component {
+  render() {
+    let pages = model.expansions.get(this.props.handle) || {};
+    let parts = [];
+    let offset = this.props.shown;
+    let expired = false;
+    while (pages[offset]) {
+      let page = pages[offset];
+      if (page.type == "expired") {
+        expired = true;
+        break;
+      } else if (page.type == "str_page") {
+        parts.push(<code key={offset}>{page.str}</code>);
+        // Pages of bytes give their length, since escaping changes it
+        offset += page.length !== undefined ? page.length : page.str.length;
+      } else if (page.values) {
+        for (let i=0; i<page.values.length; i++) {
+          parts.push(renderPackedItem(page.values[i], page.dtype, offset + i));
+        }
+        offset += page.values.length;
+      } else {
+        for (let i=0; i<page.contents.length; i++) {
+          parts.push(this.props.render(page.contents[i], offset + i));
+        }
+        offset += page.contents.length;
+      }
+    }
+    if (expired) {
+      parts.push(<Label key="expired" size="mini">value no longer available</Label>);
+    } else if (offset < this.props.total) {
+      parts.push(<Button key="more" size="mini" onClick={() => expandValue(this.props.handle, offset)}>
+        {this.props.total - offset} more...
+      </Button>);
+    }
+    return <span>{parts}</span>;
+  }
+}
+
+Factories.deferred = class deferred extends React.Component {
+  render() {
+    let pages = model.expansions.get(this.props.handle) || {};
+    if (pages.all) {
+      if (pages.all.type == "expired") {
+        return <Label size="mini">value no longer available</Label>;
+      }
+      return renderRemoteItem(pages.all.value);
+    }
+    // Summaries of values defined by a cell may have no length, but have a size
+    let description = this.props.value_type;
+    if (this.props.length !== undefined) {
+      description += ` of ${this.props.length}`;
+    }
+    if (this.props.size !== undefined) {
+      description += ` (${formatBytes(this.props.size)})`;
+    }
+    return <Button size="mini" onClick={() => expandValue(this.props.handle, null)}>
+      {description}...
+    </Button>;
+  }
+};
+
+// The rows of an array or frame: the head rows, any pages fetched since, and
+// the tail rows.  Rows are lists of already-formatted cells.  Wide tables
+// only show some column_windows at first (with a gap between them); the
+// other columns are fetched a page at a time.
+class TableRows extends React.Component {
+  constructor(props) {
+    super(props);
+    // The first column of the page of columns shown, or null for the
+    // columns the value was sent with:
+    this.state = {columnOffset: null};
+  }
+
+  showColumns(columnOffset) {
+    let pages = model.expansions.get(this.props.handle) || {};
+    if (columnOffset !== null && !pages[expansionKey(null, columnOffset)]) {
+      expandValue(this.props.handle, null, null, columnOffset);
+    }
+    this.setState({columnOffset});
+  }
+
+  renderRow(row, index, gapAt) {
+    let cells = row.map((cell, i) => <Table.Cell key={i}><code>{cell}</code></Table.Cell>);
+    if (gapAt !== null) {
+      cells.splice(gapAt, 0, <Table.Cell key="gap" disabled>…</Table.Cell>);
+    }
+    if (this.props.rowNumbers) {
+      cells.unshift(<Table.Cell key="index" disabled>{index}</Table.Cell>);
+    }
+    return <Table.Row key={index}>{cells}</Table.Row>;
+  }
+
+  renderColumnNavigation(windows, columnCount) {
+    let columnOffset = this.state.columnOffset;
+    let pageColumns = windows[0][1] - windows[0][0];
+    let buttons = [];
+    if (columnOffset === null) {
+      buttons.push(<Button key="more" size="mini" onClick={() => this.showColumns(windows[0][1])}>
+        {windows[1][0] - windows[0][1]} more columns...
+      </Button>);
+    } else {
+      buttons.push(<Button key="first" size="mini" onClick={() => this.showColumns(null)}>edges</Button>);
+      if (columnOffset > 0) {
+        buttons.push(<Button key="previous" size="mini" icon="left chevron"
+          onClick={() => this.showColumns(Math.max(0, columnOffset - pageColumns))} />);
+      }
+      if (windows[0][1] < columnCount) {
+        buttons.push(<Button key="next" size="mini" icon="right chevron"
+          onClick={() => this.showColumns(windows[0][1])} />);
+      }
+    }
+    let shown = windows.map(([start, stop]) => `${start}–${stop - 1}`).join(", ");
+    return <div>columns {shown} of {columnCount} {buttons}</div>;
+  }
+
+  render() {
+    let pages = model.expansions.get(this.props.handle) || {};
+    let columnOffset = this.state.columnOffset;
+    let view = this.props;
+    if (columnOffset !== null) {
+      view = pages[expansionKey(null, columnOffset)];
+      if (!view) {
+        return <Label size="mini">loading columns...</Label>;
+      }
+      if (view.type == "expired") {
+        return <Label size="mini">value no longer available</Label>;
+      }
+    }
+    let head = view.head;
+    let tail = view.tail || [];
+    let tailOffset = view.tail ? view.tail_offset : this.props.rows;
+    let windows = view.column_windows;
+    let leading = this.props.indexColumn ? 1 : 0;
+    let gapAt = windows && windows.length > 1 ? leading + windows[0][1] - windows[0][0] : null;
+    let rows = head.map((row, i) => this.renderRow(row, i, gapAt));
+    let offset = head.length;
+    let expired = false;
+    while (offset < tailOffset && pages[expansionKey(offset, columnOffset)]) {
+      let page = pages[expansionKey(offset, columnOffset)];
+      if (page.type == "expired") {
+        expired = true;
+        break;
+      }
+      for (let i=0; i<page.rows.length && offset + i < tailOffset; i++) {
+        rows.push(this.renderRow(page.rows[i], offset + i, gapAt));
+      }
+      offset += page.rows.length;
+    }
+    if (offset < tailOffset) {
+      let columns = head.length ? head[0].length + (this.props.rowNumbers ? 1 : 0) + (gapAt !== null ? 1 : 0) : 1;
+      let more;
+      if (expired) {
+        more = <Label size="mini">value no longer available</Label>;
+      } else {
+        more = <Button size="mini" onClick={() => expandValue(this.props.handle, offset, null, columnOffset)}>
+          {tailOffset - offset} more rows...
+        </Button>;
+      }
+      rows.push(<Table.Row key="more"><Table.Cell colSpan={columns}>{more}</Table.Cell></Table.Row>);
+    }
+    tail.forEach((row, i) => rows.push(this.renderRow(row, tailOffset + i, gapAt)));
+    let header = null;
+    if (view.columns) {
+      let columns = view.columns.map((column, i) => <Table.HeaderCell key={i}>{column}</Table.HeaderCell>);
+      if (gapAt !== null) {
+        columns.splice(gapAt - leading, 0, <Table.HeaderCell key="gap">…</Table.HeaderCell>);
+      }
+      if (this.props.indexColumn) {
+        columns.unshift(<Table.HeaderCell key="index" />);
+      }
+      header = <Table.Header><Table.Row>{columns}</Table.Row></Table.Header>;
+    }
+    return <div>
+      {windows ? this.renderColumnNavigation(windows, view.column_count) : null}
+      <Table compact="very" collapsing celled size="small">
+        {header}
+        <Table.Body>{rows}</Table.Body>
+      </Table>
+    </div>;
+  }
+}
+
+function renderStats(stats) {
+  if (!stats) {
+    return null;
+  }
+  let parts = [];
+  for (let name of ["min", "max", "mean", "nan_count"]) {
+    if (stats[name] !== undefined) {
+      parts.push(<span key={name} style={{marginRight: "1em"}}>{name}: <code>{stats[name]}</code></span>);
+    }
+  }
+  if (stats.sampled) {
+    parts.push(<span key="sampled">(sampled)</span>);
+  }
+  return <div>{parts}</div>;
+}
+
+Factories.ndarray = class ndarray extends React.Component {
+  render() {
+    let title = <code>array {this.props.shape.join("×")} {this.props.dtype}</code>;
+    let body;
+    if (this.props.preview !== undefined) {
+      body = <pre>{this.props.preview}</pre>;
+    } else {
+      body = <TableRows {...this.props} rowNumbers={true} />;
+    }
+    return <div>
+      {title}
+      {renderStats(this.props.stats)}
+      {body}
+    </div>;
+  }
+};
+
+Factories.DataFrame = Factories.Series = class DataFrame extends React.Component {
+  render() {
+    let stats = [];
+    for (let i=0; i<this.props.columns.length; i++) {
+      let column = this.props.columns[i];
+      let columnStats = this.props.stats[column];
+      if (columnStats && (columnStats.mean !== undefined || columnStats.nan_count)) {
+        stats.push(<div key={i}><strong>{column}</strong> <code>{this.props.dtypes[i]}</code> {renderStats(columnStats)}</div>);
+      }
+    }
+    let title = <code>{this.props.type} {this.props.shape.join("×")}</code>;
+    return <div>
+      {title}
+      {stats.length ? <Folded className="inline" title="Statistics">{stats}</Folded> : null}
+      <TableRows {...this.props} indexColumn={true} />
+    </div>;
+  }
+};
+
+// A value that appears earlier in the same output (or contains itself)
+Factories.ref = class ref extends React.Component {
+  render() {
+    return <Label size="mini" basic title="The same object as above">
+      {this.props.value_type} #{this.props.ref}
+    </Label>;
+  }
+};
+
 Factories.print_expr = class print_expr extends React.Component {
   render() {
     return <dl>
@@ -596,6 +1058,24 @@ Factories.print_expr = class print_expr extends React.Component {
   }
 };
 
+// All the values of an expression that stopped being printed (like one in a
+// loop), summarized
+Factories.expr_stats = class expr_stats extends React.Component {
+  render() {
+    let range = null;
+    if (this.props.min !== null && this.props.min !== undefined) {
+      range = <span>, min <code>{this.props.min}</code>, max <code>{this.props.max}</code></span>;
+    }
+    return <dl>
+      <dt><code>{this.props.expr_string}</code></dt>
+      <dd>
+        <Label size="mini">{this.props.count} values</Label>
+        {range}, last: {renderRemoteItem(this.props.last)}
+      </dd>
+    </dl>;
+  }
+};
+
 Factories.print = class print extends React.Component {
   render() {
     let sep = this.props.sep === undefined ? " " : this.props.sep;
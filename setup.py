@@ -15,7 +15,6 @@ requirements = [
     'Click>=6.0',
     'astor',
     'watchdog',
-    'python-rocksdb',
     'tempita',
     'webob',
     'matplotlib',
@@ -32,6 +31,11 @@ test_requirements = [
     # TODO: put package test requirements here
 ]
 
+extras_requirements = {
+    'rocksdb': ['python-rocksdb'],
+    'msgpack': ['msgpack'],
+}
+
 setup(
     name='sheets',
     version='0.1.0',
@@ -48,6 +52,7 @@ setup(
     },
     include_package_data=True,
     install_requires=requirements,
+    extras_require=extras_requirements,
     license="MIT license",
     zip_safe=False,
     keywords='sheets',
@@ -10,7 +10,15 @@ default_data_path = os.path.normpath(os.path.join(os.path.abspath(__file__), "..
 
 @click.command()
 @click.argument("path", default=default_data_path)
-def main(path):
+@click.option("--kernel/--no-kernel", default=True,
+              help="Run code in a separate process (default) or in the server process")
+@click.option("--history-backend", type=click.Choice(["rocksdb", "sqlite", "log"]),
+              help="How to store history (default rocksdb if installed, otherwise sqlite)")
+@click.option("--poll-files", is_flag=True,
+              help="Poll for changes to files, instead of using file system events (for network file systems)")
+@click.option("--bytecode-cache", is_flag=True,
+              help="Keep compiled cells in .sheets-cache, so they aren't compiled again after a restart")
+def main(path, kernel, history_backend, poll_files, bytecode_cache):
     """Console script for sheets."""
     from . import http
     path = os.path.abspath(path)
@@ -25,10 +33,14 @@ def main(path):
     from .history import History
     from . import importwatch
     importwatch.activate()
-    env = Environment(path)
-    history = History(path)
+    if kernel:
+        from .kernel import KernelEnvironment
+        env = KernelEnvironment(path, bytecode_cache=bytecode_cache)
+    else:
+        env = Environment(path, bytecode_cache=bytecode_cache)
+    history = History(path, backend=history_backend)
     model = Model(env, history)
-    router = Router(env=env, model=model)
+    router = Router(env=env, model=model, poll_files=poll_files)
     router.register()
     print("Saving files in %s" % env.path)
     run_server(10101)
@@ -0,0 +1,172 @@
+"""
+Caches the analysis and compiled code of cells, so that analyzing and
+executing the same content again doesn't parse and compile it again.
+
+Analysis and compilation each parse the content themselves, and only the
+cache is shared: with a kernel they run in different processes, and
+compiling rewrites its tree in place, so one tree couldn't be used for both
+without copying it (which costs about as much as parsing).
+
+Compiled code can also be kept on disk (as marshalled code objects, like
+.pyc files), so it survives restarts of the server and kernel.  Files not
+used recently are removed once there are more than max_bytecode_files.
+"""
+import os
+import time
+import marshal
+import hashlib
+import threading
+import collections
+import importlib.util
+from . import metrics, __version__
+
+# Entries kept in memory, for all files:
+max_entries = 256
+# The directory, under the sheet's path, for marshalled code:
+bytecode_dir = ".sheets-cache"
+# Files kept in that directory (the least recently used are removed), and how
+# many files are written between checks:
+max_bytecode_files = 1000
+prune_every = 100
+# Increment when compile_cell rewrites code differently, so code compiled by
+# an older rewriter isn't loaded:
+rewriter_version = 1
+
+
+def bytecode_header():
+    """Code objects can only be loaded by the Python version that made them,
+    and are only valid for the rewriter (and sheets version) that made them"""
+    return importlib.util.MAGIC_NUMBER + ("sheets %s %s\n" % (__version__, rewriter_version)).encode("ascii")
+
+
+class CompiledCell:
+    """A cell parsed, rewritten for execution and compiled.  tree is None when
+    the code was loaded from the bytecode cache"""
+
+    __slots__ = ("tree", "used", "code")
+
+    def __init__(self, tree, used, code):
+        self.tree = tree
+        # The names the code reads:
+        self.used = used
+        self.code = code
+
+
+class CompileCache:
+
+    def __init__(self, path, bytecode=False):
+        self.bytecode_path = os.path.join(path, bytecode_dir) if bytecode else None
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        # Files written since the directory was last pruned; this starts
+        # at prune_every so the first write prunes what earlier runs left:
+        self.saved_since_prune = prune_every
+
+    def get(self, key, kind):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+        metrics.incr("compile_cache", kind=kind, result="hit" if value is not None else "miss")
+        return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            while len(self.entries) > max_entries:
+                self.entries.popitem(last=False)
+
+    def analysis(self, filename, content_hash, make):
+        """The analysis of the content, from make() if it isn't cached.  Any
+        exception make() raises is passed on, and nothing is cached"""
+        key = ("analysis", filename, content_hash)
+        value = self.get(key, "analysis")
+        if value is None:
+            value = make()
+            self.put(key, value)
+        return value
+
+    def compiled(self, filename, content_hash, options, make):
+        """A CompiledCell for the content, compiled with the given options
+        (a tuple), from make() if it isn't cached in memory or on disk"""
+        key = ("compiled", filename, content_hash, options)
+        cell = self.get(key, "compiled")
+        if cell is None:
+            cell = self.load_bytecode(key)
+            if cell is None:
+                cell = make()
+                self.save_bytecode(key, cell)
+            self.put(key, cell)
+        return cell
+
+    def bytecode_filename(self, key):
+        digest = hashlib.sha1(repr((key, bytecode_header())).encode("UTF-8")).hexdigest()
+        return os.path.join(self.bytecode_path, digest + ".marshal")
+
+    def load_bytecode(self, key):
+        if not self.bytecode_path:
+            return None
+        filename = self.bytecode_filename(key)
+        try:
+            with open(filename, "rb") as fp:
+                data = fp.read()
+            # The modification time marks when the file was last used:
+            os.utime(filename)
+        except FileNotFoundError:
+            return None
+        header = bytecode_header()
+        if not data.startswith(header):
+            return None
+        try:
+            used, code = marshal.loads(data[len(header):])
+        except (EOFError, ValueError, TypeError):
+            print("Ignoring invalid bytecode cache file for", key[1])
+            return None
+        metrics.incr("compile_cache", kind="compiled", result="bytecode_hit")
+        return CompiledCell(None, set(used), code)
+
+    def save_bytecode(self, key, cell):
+        if not self.bytecode_path:
+            return
+        filename = self.bytecode_filename(key)
+        tmp_filename = "%s.%s.tmp" % (filename, os.getpid())
+        try:
+            os.makedirs(self.bytecode_path, exist_ok=True)
+            with open(tmp_filename, "wb") as fp:
+                fp.write(bytecode_header())
+                fp.write(marshal.dumps((sorted(cell.used), cell.code)))
+            os.replace(tmp_filename, filename)
+        except OSError as e:
+            print("Could not write bytecode cache file %s: %s" % (filename, e))
+            return
+        self.saved_since_prune += 1
+        if self.saved_since_prune >= prune_every:
+            self.saved_since_prune = 0
+            self.prune_bytecode()
+
+    def prune_bytecode(self):
+        """Removes the least recently used files beyond max_bytecode_files,
+        and temporary files left by writes that didn't finish"""
+        used = []
+        remove = []
+        try:
+            with os.scandir(self.bytecode_path) as entries:
+                for entry in entries:
+                    try:
+                        mtime = entry.stat().st_mtime
+                    except FileNotFoundError:
+                        continue
+                    if entry.name.endswith(".marshal"):
+                        used.append((mtime, entry.path))
+                    elif entry.name.endswith(".tmp") and mtime < time.time() - 3600:
+                        remove.append(entry.path)
+        except OSError as e:
+            print("Could not list bytecode cache %s: %s" % (self.bytecode_path, e))
+            return
+        used.sort()
+        remove.extend(path for mtime, path in used[:max(len(used) - max_bytecode_files, 0)])
+        for path in remove:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
@@ -2,7 +2,11 @@ import os
 import sys
 from functools import partial
 import traceback
+import heapq
+import threading
+import itertools
 import time
+from . import metrics
 
 def short_repr(s):
     v = repr(s)
@@ -10,47 +14,192 @@ def short_repr(s):
         return v[:12] + "..." + v[-5:]
     return v
 
+class Task:
+
+    __slots__ = ("key", "runner", "priority", "due", "background")
+
+    def __init__(self, key, runner, priority, due, background):
+        self.key = key
+        self.runner = runner
+        self.priority = priority
+        self.due = due
+        self.background = background
+
 class Model:
 
+    # Tasks with a lower priority run first:
+    execution_priority = 0
+    analysis_priority = 10
+    # Files are analyzed once they haven't been edited for this long:
+    analysis_delay = 0.3
+
     def __init__(self, env, history):
         self.files = {}
-        self.tasks = []
+        # Pending tasks by key; adding a task with the same key replaces the
+        # old one:
+        self.tasks = {}
+        # For foreground (False) and background (True) tasks, heaps of
+        # (priority, seq, task) for tasks that are due, and (due, seq, task)
+        # for tasks that aren't yet.  Tasks that were replaced or flushed
+        # are left in the heaps, and skipped once they're no longer in tasks:
+        self.ready_tasks = {False: [], True: []}
+        self.delayed_tasks = {False: [], True: []}
+        self.task_seq = itertools.count()
+        self.tasks_changed = threading.Condition()
+        self.running_tasks = False
+        self.background_thread = None
         self.env = env
         self.history = history
 
     def apply_command(self, command):
+        command.prepare(self)
         command.apply_to_environment(self.env)
         command.apply_to_model(self)
-        self.history.save_command(command)
-
-    def add_task(self, key, runner):
-        for item in list(self.tasks):
-            if item[0] == key:
-                self.tasks.remove(item)
-        self.tasks.append((key, runner))
+        if command.saved_in_history:
+            self.history.save_command(command)
+        if self.history.since_checkpoint >= self.history.checkpoint_every:
+            self.history.checkpoint_in_background(self.snapshot())
+
+    def add_task(self, key, runner, priority=execution_priority, delay=0, background=False):
+        """Queues runner to be called.  Background tasks are run on a separate
+        thread, once delay seconds have passed without the task being added
+        again; other tasks are run by run_tasks"""
+        with self.tasks_changed:
+            task = self.tasks[key] = Task(key, runner, priority, time.time() + delay, background)
+            if delay > 0:
+                heapq.heappush(self.delayed_tasks[background], (task.due, next(self.task_seq), task))
+            else:
+                heapq.heappush(self.ready_tasks[background], (priority, next(self.task_seq), task))
+            if background:
+                if self.background_thread is None:
+                    self.background_thread = threading.Thread(target=self.run_background_tasks, daemon=True)
+                    self.background_thread.start()
+                self.tasks_changed.notify()
+
+    def is_pending(self, task):
+        return self.tasks.get(task.key) is task
+
+    def next_due(self, background):
+        """The time the next delayed task is due, or None"""
+        delayed = self.delayed_tasks[background]
+        while delayed and not self.is_pending(delayed[0][2]):
+            heapq.heappop(delayed)
+        return delayed[0][0] if delayed else None
+
+    def pop_task(self, background):
+        """Removes and returns the due task with the lowest priority (the
+        earliest added for the same priority), or None"""
+        now = time.time()
+        ready = self.ready_tasks[background]
+        delayed = self.delayed_tasks[background]
+        while delayed and delayed[0][0] <= now:
+            due, seq, task = heapq.heappop(delayed)
+            if self.is_pending(task):
+                heapq.heappush(ready, (task.priority, seq, task))
+        while ready:
+            task = heapq.heappop(ready)[2]
+            if self.is_pending(task):
+                del self.tasks[task.key]
+                return task
+        return None
+
+    def run_task(self, task):
+        try:
+            with metrics.timed("task", kind=task.key[0]):
+                task.runner()
+        except:
+            print("Error running task", task.runner)
+            traceback.print_exc()
 
     def run_tasks(self):
-        while self.tasks:
-            runner = self.tasks.pop(0)[1]
-            try:
-                runner()
-            except:
-                print("Error running task", runner)
-                traceback.print_exc()
-
-    def on_open(self, router):
+        if self.running_tasks:
+            # Commands sent from inside a task are picked up by the outer loop
+            return
+        if threading.current_thread() is self.background_thread:
+            # Background tasks (analysis) send their results through the
+            # router too, but other tasks are left to the thread that runs
+            # them, so they aren't held up behind analysis, or run twice
+            return
+        self.running_tasks = True
+        try:
+            while True:
+                with self.tasks_changed:
+                    task = self.pop_task(background=False)
+                if task is None:
+                    break
+                self.run_task(task)
+        finally:
+            self.running_tasks = False
+
+    def run_background_tasks(self):
+        while True:
+            with self.tasks_changed:
+                task = self.pop_task(background=True)
+                while task is None:
+                    due = self.next_due(background=True)
+                    self.tasks_changed.wait(max(due - time.time(), 0) if due is not None else None)
+                    task = self.pop_task(background=True)
+            self.run_task(task)
+
+    def add_analysis_task(self, filename, content):
+        self.add_task(
+            ("analyze", filename), partial(self.env.analyze, filename, content),
+            priority=self.analysis_priority, delay=self.analysis_delay, background=True)
+
+    def flush_tasks(self, kind):
+        """Runs any pending tasks whose key starts with kind right away"""
+        with self.tasks_changed:
+            tasks = [self.tasks.pop(key) for key in list(self.tasks) if key[0] == kind]
+        for task in tasks:
+            self.run_task(task)
+
+    def load(self, router):
+        """Loads the saved history into the model, then brings it up to date
+        with the files on disk"""
         self.history.clean_commands()
         commands = self.history.get_commands()
         if not commands:
-            commands = self.env.init_commands()
+            for command in self.env.init_commands():
+                router.send(command)
+            return
         for command in commands:
-            router.send(command)
+            command.apply_to_model(self)
+        if len(commands) > 1:
+            self.history.checkpoint(self.snapshot())
+        for command in self.env.init_commands():
+            f = self.files.get(command.filename)
+            if f is None:
+                router.send(command)
+            elif f.get("content") != command.content:
+                router.send(FilePatch.from_contents(
+                    filename=command.filename, old=f.get("content") or "",
+                    new=command.content, base_version=f.get("version", 0),
+                    external_edit=True))
+        for filename in list(self.files):
+            if not os.path.exists(os.path.join(self.env.path, filename)):
+                router.send(FileDelete(filename=filename, external_edit=True))
+        self.run_tasks()
+
+    def snapshot(self):
+        # Copied as far as commands change files in place, so the snapshot
+        # can be encoded while more commands are applied:
+        files = {}
+        for filename, f in self.files.items():
+            f = dict(f)
+            if "streaming" in f:
+                f["streaming"] = dict(f["streaming"], emitted=list(f["streaming"]["emitted"]))
+            if "progress" in f:
+                f["progress"] = dict(f["progress"])
+            files[filename] = f
+        return Snapshot(files=files)
 
 class Command:
 
     attrs = None
     name = None
     _id = None
+    # Commands that only matter while the server runs aren't saved:
+    saved_in_history = True
 
     def __init__(self, *, id=None):
         self._id = id
@@ -80,6 +229,11 @@ class Command:
                 if name != "command"),
         )
 
+    def prepare(self, model):
+        """Called before a new command is applied (but not when history is
+        replayed)"""
+        pass
+
     def apply_to_model(self, model):
         pass
 
@@ -89,38 +243,127 @@ class Command:
     def scan_back(self, prev_commands):
         pass
 
+def write_file(env, relative_filename, content):
+    filename = os.path.abspath(os.path.join(env.path, relative_filename))
+    if not filename.startswith(env.path):
+        raise Exception("Bad file: {} resolves to {}, not in base {}".format(relative_filename, filename, env.path))
+    if not os.path.exists(os.path.dirname(filename)):
+        os.makedirs(os.path.dirname(filename))
+    # Written to a temporary file and moved into place, so the file watcher
+    # (or another program) never reads a partly written file.  Dot files
+    # aren't part of the sheet, so the watcher ignores the temporary file
+    dirname, basename = os.path.split(filename)
+    tmp_filename = os.path.join(dirname, ".%s.%s.tmp" % (basename, os.getpid()))
+    with open(tmp_filename, "w") as fp:
+        fp.write(content)
+    os.replace(tmp_filename, filename)
+
 class FileEdit(Command):
 
-    def __init__(self, *, filename, content, external_edit=False, id=None):
+    def __init__(self, *, filename, content, external_edit=False, version=None, id=None):
         super().__init__(id=id)
         self.filename = filename
         self.content = content
         self.external_edit = external_edit
+        # Each edit to a file increments its version; FilePatch commands are
+        # made against a specific version
+        self.version = version
 
     def apply_to_environment(self, env):
         if self.external_edit:
             # Then it is already applied to the environment
             return
-        filename = os.path.abspath(os.path.join(env.path, self.filename))
-        if not filename.startswith(env.path):
-            raise Exception("Bad file: {} resolves to {}, not in base {}".format(self.filename, filename, env.path))
-        if not os.path.exists(os.path.dirname(filename)):
-            os.makedirs(os.path.dirname(filename))
-        with open(filename, "w") as fp:
-            fp.write(self.content)
+        write_file(env, self.filename, self.content)
 
     def apply_to_model(self, model):
         if self.filename not in model.files:
             model.files[self.filename] = {}
-        model.files[self.filename]["content"] = self.content
-        model.add_task(("analyze", self.filename), partial(model.env.analyze, self.filename, self.content))
+        f = model.files[self.filename]
+        if self.version is None:
+            self.version = f.get("version", 0) + 1
+        f["content"] = self.content
+        f["version"] = self.version
+        model.add_analysis_task(self.filename, self.content)
 
     def scan_back(self, commands):
         for prev in reversed(commands):
             if isinstance(prev, Execution) and prev.filename == self.filename:
                 break
-            elif isinstance(prev, FileEdit) and prev.filename == self.filename:
+            elif isinstance(prev, (FileEdit, FilePatch, Analysis)) and prev.filename == self.filename:
                 yield prev
+
+class PatchConflict(Exception):
+    """A FilePatch was made against a different version of the file than the
+    server has"""
+
+def apply_patch(content, ops):
+    """Applies ops, a list of [start, end, text] replacements each applied to
+    the result of the ones before"""
+    for start, end, text in ops:
+        if not 0 <= start <= end <= len(content):
+            raise PatchConflict("Bad patch range {}-{} for content of length {}".format(start, end, len(content)))
+        content = content[:start] + text + content[end:]
+    return content
+
+class FilePatch(Command):
+    """An edit to part of a file, only carrying the text that changed"""
+
+    attrs = ["filename", "base_version", "version", "ops", "external_edit"]
+
+    def __init__(self, *, filename, base_version, ops, version=None, external_edit=False, id=None):
+        super().__init__(id=id)
+        self.filename = filename
+        self.base_version = base_version
+        self.version = version if version is not None else base_version + 1
+        self.ops = ops
+        self.external_edit = external_edit
+        self.content = None
+
+    @classmethod
+    def from_contents(cls, *, filename, old, new, **kw):
+        """A patch replacing everything between the common prefix and suffix of
+        old and new"""
+        prefix = 0
+        limit = min(len(old), len(new))
+        while prefix < limit and old[prefix] == new[prefix]:
+            prefix += 1
+        suffix = 0
+        limit -= prefix
+        while suffix < limit and old[-suffix - 1] == new[-suffix - 1]:
+            suffix += 1
+        return cls(filename=filename, ops=[[prefix, len(old) - suffix, new[prefix:len(new) - suffix]]], **kw)
+
+    def prepare(self, model):
+        f = model.files.get(self.filename)
+        version = f.get("version", 0) if f else None
+        if version != self.base_version:
+            raise PatchConflict("Patch to {} is against version {}, not {}".format(
+                self.filename, self.base_version, version))
+        self.content = apply_patch(f.get("content") or "", self.ops)
+
+    def apply_to_environment(self, env):
+        if self.external_edit:
+            return
+        write_file(env, self.filename, self.content)
+
+    def apply_to_model(self, model):
+        f = model.files.get(self.filename)
+        if f is None:
+            return
+        if self.content is None:
+            # Replaying history
+            self.content = apply_patch(f.get("content") or "", self.ops)
+        f["content"] = self.content
+        f["version"] = self.version
+        model.add_analysis_task(self.filename, self.content)
+
+    def scan_back(self, commands):
+        # Earlier patches are still needed to reconstruct the content, but
+        # earlier analysis isn't.  An earlier edit or patch removes the
+        # analysis before it itself
+        for prev in reversed(commands):
+            if isinstance(prev, (Execution, FileEdit, FilePatch)) and prev.filename == self.filename:
+                break
             elif isinstance(prev, Analysis) and prev.filename == self.filename:
                 yield prev
 
@@ -132,6 +375,7 @@ class FileDelete(Command):
         self.external_edit = external_edit
 
     def apply_to_environment(self, env):
+        env.forget_file(self.filename)
         if self.external_edit:
             return
         filename = os.path.abspath(os.path.join(env.path, self.filename))
@@ -149,14 +393,50 @@ class FileDelete(Command):
 
 class ExecutionRequest(Command):
 
-    def __init__(self, *, filename, content, subexpressions=False, id=None):
+    def __init__(self, *, filename, content, subexpressions=False, use_cache=True, profile=False, id=None):
         super().__init__(id=id)
         self.filename = filename
         self.content = content
         self.subexpressions = subexpressions
+        self.use_cache = use_cache
+        # Run the code under a line profiler (which also skips the cache):
+        self.profile = profile
+
+    def apply_to_model(self, model):
+        model.add_task(("execute_request", self.filename), partial(model.env.execute, self.filename, self.content, self.subexpressions, self.use_cache, self.profile))
+
+    def scan_back(self, commands):
+        yield self
+
+class ExecuteStaleRequest(Command):
 
     def apply_to_model(self, model):
-        model.add_task(("execute_request", self.filename), partial(model.env.execute, self.filename, self.content, self.subexpressions))
+        files = dict(
+            (filename, f["content"])
+            for filename, f in model.files.items()
+            if "content" in f)
+        model.add_task(("execute_stale",), partial(self.run, model, files))
+
+    def run(self, model, files):
+        # Stale cells are found from the analysis, so that has to be current
+        model.flush_tasks("analyze")
+        model.env.execute_stale(files)
+
+    def scan_back(self, commands):
+        yield self
+
+class KernelInterrupt(Command):
+
+    def apply_to_environment(self, env):
+        env.interrupt()
+
+    def scan_back(self, commands):
+        yield self
+
+class KernelRestart(Command):
+
+    def apply_to_environment(self, env):
+        env.restart()
 
     def scan_back(self, commands):
         yield self
@@ -177,28 +457,171 @@ class Analysis(Command):
             "properties": self.properties,
         }
 
+class ExecutionOutput(Command):
+    """Part of the output of an execution that is still running"""
+
+    def __init__(self, *, filename, output_id, index, emitted, id=None):
+        super().__init__(id=id)
+        self.filename = filename
+        self.output_id = output_id
+        self.index = index
+        self.emitted = emitted
+
+    def apply_to_model(self, model):
+        if self.filename not in model.files:
+            return
+        streaming = model.files[self.filename].get("streaming")
+        if not streaming or streaming["output_id"] != self.output_id:
+            streaming = model.files[self.filename]["streaming"] = {
+                "output_id": self.output_id,
+                "emitted": [],
+            }
+        streaming["emitted"].extend(self.emitted)
+
+class ExecutionProgress(Command):
+    """How far a loop in an execution that is still running has got.  Only
+    the latest matters, so these aren't saved in history, and clients that
+    fall behind only get the newest one for each loop"""
+
+    saved_in_history = False
+
+    def __init__(self, *, filename, loop_id, lineno, count, total, elapsed, done=False, id=None):
+        super().__init__(id=id)
+        self.filename = filename
+        self.loop_id = loop_id
+        self.lineno = lineno
+        self.count = count
+        # None if the length of what is being looped over isn't known:
+        self.total = total
+        self.elapsed = elapsed
+        self.done = done
+
+    def apply_to_model(self, model):
+        if self.filename not in model.files:
+            return
+        progress = model.files[self.filename].setdefault("progress", {})
+        progress[str(self.loop_id)] = {
+            "lineno": self.lineno,
+            "count": self.count,
+            "total": self.total,
+            "elapsed": self.elapsed,
+            "done": self.done,
+        }
+
+    def scan_back(self, commands):
+        for prev in commands:
+            if isinstance(prev, ExecutionProgress) and prev.filename == self.filename and prev.loop_id == self.loop_id:
+                yield prev
+
 class Execution(Command):
 
-    def __init__(self, *, filename, content, emitted, defines, start_time, end_time, exec_time, with_subexpressions=False, id=None):
+    def __init__(self, *, filename, content, emitted, defines, start_time, end_time, exec_time, with_subexpressions=False, cached=False, output_id=None, output_chunks=0, profile=None, id=None):
         super().__init__(id=id)
         self.filename = filename
         self.content = content
+        # If output_id is set, the output was already sent in output_chunks
+        # ExecutionOutput commands, and emitted only has what came after:
         self.emitted = emitted
+        self.output_id = output_id
+        self.output_chunks = output_chunks
         self.defines = defines
         self.start_time = start_time
         self.end_time = end_time
         self.exec_time = exec_time
         self.with_subexpressions = with_subexpressions
+        self.cached = cached
+        # Per-line timing and memory, if the execution was profiled (see
+        # profiling.LineProfiler.json):
+        self.profile = profile
 
     def apply_to_model(self, model):
         if self.filename not in model.files:
             return
+        emitted = self.emitted
+        model.files[self.filename].pop("progress", None)
+        streaming = model.files[self.filename].pop("streaming", None)
+        if self.output_id and streaming and streaming["output_id"] == self.output_id:
+            emitted = streaming["emitted"] + emitted
         model.files[self.filename]["execution"] = {
             "content": self.content,
-            "emitted": self.emitted,
+            "emitted": emitted,
             "defines": self.defines,
+            "cached": self.cached,
+            "profile": self.profile,
         }
 
+    def scan_back(self, commands):
+        for prev in commands:
+            if getattr(prev, "filename", None) != self.filename:
+                continue
+            if isinstance(prev, Execution):
+                # Superseded by this execution
+                yield prev
+            elif isinstance(prev, ExecutionOutput) and prev.output_id != self.output_id:
+                yield prev
+            elif isinstance(prev, ExecutionProgress):
+                yield prev
+
+class ExpandValue(Command):
+    """Asks for more of a value that was truncated or deferred when it was
+    serialized.  The reply only goes to reply_to, the id of the socket that
+    asked (set by the router).  column_offset asks for a page of the columns
+    of a wide table"""
+
+    saved_in_history = False
+
+    def __init__(self, *, handle, offset=None, count=None, column_offset=None, reply_to=None, id=None):
+        super().__init__(id=id)
+        self.handle = handle
+        self.offset = offset
+        self.count = count
+        self.column_offset = column_offset
+        self.reply_to = reply_to
+
+    def apply_to_model(self, model):
+        model.add_task(("expand_value", self.handle, self.offset, self.column_offset, self.reply_to), partial(model.env.expand_value, self.handle, self.offset, self.count, self.reply_to, self.column_offset))
+
+    def scan_back(self, commands):
+        yield self
+
+class ValueExpansion(Command):
+
+    saved_in_history = False
+
+    def __init__(self, *, handle, offset, page, column_offset=None, reply_to=None, id=None):
+        super().__init__(id=id)
+        self.handle = handle
+        self.offset = offset
+        self.column_offset = column_offset
+        self.page = page
+        # The socket to send this to, instead of every client:
+        self.reply_to = reply_to
+
+    def scan_back(self, commands):
+        # The values are gone once the server restarts
+        yield self
+
+class ServerStats(Command):
+    """Metrics about the server (see the metrics module), sent periodically
+    to clients.  These are not saved in history"""
+
+    def __init__(self, *, stats, id=None):
+        super().__init__(id=id)
+        self.stats = stats
+
+    def scan_back(self, commands):
+        yield self
+
+class Snapshot(Command):
+    """The entire state of the model, sent to newly connected clients"""
+
+    def __init__(self, *, files, id=None):
+        super().__init__(id=id)
+        self.files = files
+
+    def apply_to_model(self, model):
+        model.files = self.files
+
 no_default = ['NO DEFAULT']
 
 def hydrate(data, *, if_invalid=no_default):
@@ -0,0 +1,103 @@
+"""
+Dependencies between files, as derived from their analysis.
+
+Each file's analysis lists the variables it uses and sets.  A file depends on
+the file that most recently set (in sheet order) each variable it uses; if
+no earlier file sets a variable, the last file in the sheet that sets it is
+used instead.
+"""
+import heapq
+
+
+class DependencyGraph:
+
+    def __init__(self, analyses):
+        """analyses is a dictionary of filename to analysis properties (as
+        created by VariableInspector.json)"""
+        self.analyses = analyses
+        self.filenames = sorted(analyses)
+        self.dependencies = {}
+        self.dependents = dict((name, set()) for name in self.filenames)
+        setters = {}
+        for name in self.filenames:
+            for var in analyses[name].get("variables_set", ()):
+                setters.setdefault(var, []).append(name)
+        for name in self.filenames:
+            deps = set()
+            for var in analyses[name].get("variables_used", ()):
+                provider = self.provider(setters.get(var), name)
+                if provider:
+                    deps.add(provider)
+            self.dependencies[name] = deps
+            for dep in deps:
+                self.dependents[dep].add(name)
+
+    def provider(self, setters, filename):
+        if not setters:
+            return None
+        before = [s for s in setters if s < filename]
+        if before:
+            return before[-1]
+        if setters[-1] == filename:
+            return None
+        return setters[-1]
+
+    def order(self, only=None):
+        """Returns the filenames in topological order, ties broken by sheet
+        order.  If there are cycles, the remaining files are added in sheet
+        order.  If `only` is given, only those filenames are returned"""
+        remaining = dict((name, len(deps)) for name, deps in self.dependencies.items())
+        ready = [name for name, count in remaining.items() if not count]
+        heapq.heapify(ready)
+        result = []
+        while ready:
+            name = heapq.heappop(ready)
+            del remaining[name]
+            result.append(name)
+            for dependent in self.dependents[name]:
+                if dependent not in remaining:
+                    continue
+                remaining[dependent] -= 1
+                if not remaining[dependent]:
+                    heapq.heappush(ready, dependent)
+        result.extend(sorted(remaining))
+        if only is not None:
+            result = [name for name in result if name in only]
+        return result
+
+    def downstream(self, filenames):
+        """Returns the filenames given, and everything that transitively
+        depends on them"""
+        seen = set()
+        pending = list(filenames)
+        while pending:
+            name = pending.pop()
+            if name in seen or name not in self.dependents:
+                continue
+            seen.add(name)
+            pending.extend(self.dependents[name])
+        return seen
+
+    def stale(self, contents, executed):
+        """Returns the filenames (in execution order) that need to be re-run.
+
+        `contents` is the current content of each file, and `executed` maps
+        filenames to `(content, serial)` for their last execution.  A file is
+        stale if it hasn't been executed with its current content, if one of
+        its dependencies was executed after it, or if one of its dependencies
+        is itself stale."""
+        changed = set()
+        for name in self.filenames:
+            last = executed.get(name)
+            if name not in contents:
+                continue
+            if last is None or last[0] != contents[name]:
+                changed.add(name)
+                continue
+            for dep in self.dependencies[name]:
+                dep_last = executed.get(dep)
+                if dep_last is not None and dep_last[1] > last[1]:
+                    changed.add(name)
+                    break
+        stale = self.downstream(changed)
+        return self.order(only=stale)
@@ -0,0 +1,97 @@
+"""
+Encodings for commands, on the websocket and in history.
+
+"json" is plain JSON text.  "msgpack" is MessagePack where common keys are
+replaced with small integers from interned_keys, which is shared with
+frontend/src/encoding.js.  Since saved history depends on it, keys may only
+ever be added to the end of that list.
+
+Values neither encoding can represent (NaN and infinite floats in JSON,
+ints outside 64 bits in MessagePack, other objects) are sent as strings,
+so one odd value doesn't stop a command from being sent or saved.
+"""
+import json
+import math
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+interned_keys = [
+    "command", "id", "filename", "content", "type", "time", "show_repr",
+    "parts", "str", "repr", "contents", "emitted", "defines", "json",
+    "properties", "variables_used", "variables_set", "imports", "name",
+    "signature", "qualname", "self", "dump", "url", "html", "expr_string",
+    "expr_value", "start_time", "end_time", "exec_time", "with_subexpressions",
+    "cached", "output_id", "output_chunks", "index", "external_edit",
+    "subexpressions", "use_cache", "files", "analysis", "execution",
+    "streaming", "obj", "label", "attributes", "object_class", "doc",
+    "docstring", "dir", "bases", "sep", "end", "remaining_suppressed",
+    "this_suppressed", "embedded", "icon", "exists", "base", "dtype",
+    "values", "ref", "ref_id", "value_type", "version",
+    "base_version", "ops", "profile", "lines", "total_time", "peak_memory",
+    "memory_traced", "stats", "loop_id", "lineno", "count", "total",
+    "elapsed", "done", "progress", "handle", "length", "size", "min", "max",
+    "last",
+]
+
+key_index = dict((key, index) for index, key in enumerate(interned_keys))
+
+default_encoding = "msgpack" if msgpack is not None else "json"
+
+
+def intern_keys(o):
+    if isinstance(o, dict):
+        # Like JSON, all keys become strings before being interned
+        return dict(
+            (key_index.get(str(key), str(key)), intern_keys(value))
+            for key, value in o.items())
+    if isinstance(o, (list, tuple)):
+        return [intern_keys(item) for item in o]
+    return o
+
+
+def unintern_keys(o):
+    if isinstance(o, dict):
+        return dict(
+            (interned_keys[key] if isinstance(key, int) else key, unintern_keys(value))
+            for key, value in o.items())
+    if isinstance(o, list):
+        return [unintern_keys(item) for item in o]
+    return o
+
+
+def sanitize(o):
+    """A copy of o with non-finite floats and ints that don't fit in 64 bits
+    replaced by strings"""
+    if isinstance(o, dict):
+        return dict((key, sanitize(value)) for key, value in o.items())
+    if isinstance(o, (list, tuple)):
+        return [sanitize(item) for item in o]
+    if isinstance(o, float) and not math.isfinite(o):
+        return repr(o)
+    if isinstance(o, int) and not -2 ** 63 <= o < 2 ** 64:
+        return str(o)
+    return o
+
+
+def encode(data, encoding="json"):
+    """Returns the encoded data: a str for JSON, or bytes for msgpack"""
+    if encoding == "msgpack":
+        try:
+            return msgpack.packb(intern_keys(data), use_bin_type=True)
+        except (OverflowError, TypeError, ValueError):
+            return msgpack.packb(intern_keys(sanitize(data)), use_bin_type=True, default=repr)
+    try:
+        return json.dumps(data, allow_nan=False)
+    except (OverflowError, TypeError, ValueError):
+        return json.dumps(sanitize(data), default=repr)
+
+
+def decode(data):
+    """Decodes JSON (str or bytes) or msgpack data"""
+    if isinstance(data, bytes) and data[:1] not in (b"{", b"["):
+        return unintern_keys(msgpack.unpackb(data, raw=False, strict_map_key=False))
+    if isinstance(data, bytes):
+        data = data.decode("UTF-8")
+    return json.loads(data)
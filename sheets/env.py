@@ -1,15 +1,23 @@
 import os
 import ast
+import gc
 import traceback
 import time
 import sys
 import types
+import operator
 import builtins
 import collections
+import threading
 import astor
 import weakref
-from .jsonify import jsonify, jsonify_print, jsonify_print_expr
-from .datalayer import Analysis, Execution, FileEdit
+import hashlib
+from functools import partial
+from .jsonify import jsonify, jsonify_print, jsonify_print_expr, jsonify_page, jsonify_summary, value_registry
+from .datalayer import Analysis, Execution, ExecutionOutput, ExecutionProgress, FileEdit, ValueExpansion
+from .dependencies import DependencyGraph
+from .profiling import LineProfiler
+from .compilecache import CompileCache, CompiledCell
 from .router import send
 from . import stdlib
 
@@ -20,13 +28,38 @@ class Environment:
 
     extra_globals = {}
 
+    # If true, re-executing a file with the same content and inputs replays
+    # the previous results instead of running the code:
+    cache_executions = True
+
+    # If true, output is sent while code runs, instead of all at the end:
+    stream_output = True
+    # If true, output waiting to be streamed is also sent from a timer
+    # thread.  Only safe when sending doesn't wait for a lock the running
+    # code holds, as the router's lock is held in the server process (the
+    # kernel turns this on):
+    flush_output_in_background = False
+    # If true, top-level for loops report their progress while running:
+    report_loop_progress = True
+
     active = weakref.WeakSet()
 
-    def __init__(self, path):
+    def __init__(self, path, bytecode_cache=False):
         self.path = path
+        self.bytecode_cache = bytecode_cache
+        self._cached_analysis = {}
+        # Analysis runs on the model's background thread:
+        self._analysis_lock = threading.Lock()
+        self.compile_cache = CompileCache(path, bytecode=bytecode_cache)
+        self.reset()
+        self.active.add(self)
+
+    def reset(self):
+        """Clears all the globals and execution state"""
         self.globals = {
             "print": jsonify_print,
             "print_expr": jsonify_print_expr,
+            "loop_progress": loop_progress,
             "jsonify": jsonify,
             "jsonify_print": jsonify_print,
             "listdir": stdlib.listdir,
@@ -35,8 +68,12 @@ class Environment:
         }
         for name in stdlib.builtin_names:
             self.globals[name] = getattr(stdlib, name)
-        self._cached_analysis = {}
-        self.active.add(self)
+        # filename -> (content, serial) of the last execution of each file:
+        self._executed = {}
+        self._execution_serial = 0
+        # filename -> the inputs and results of the last successful execution:
+        self._execution_cache = {}
+        self._global_versions = collections.Counter()
 
     predefined_names = set(["parsed"])
 
@@ -44,7 +81,7 @@ class Environment:
         """Returns a list of commands that represent the existing state of the
         filesystem"""
         for path in os.listdir(self.path):
-            if path.endswith(".json"):
+            if not self.is_sheet_file(path):
                 continue
             if not os.path.isfile(os.path.join(self.path, path)):
                 continue
@@ -55,22 +92,40 @@ class Environment:
             except UnicodeDecodeError:
                 pass
 
+    def is_sheet_file(self, filename):
+        """Is filename (relative to path) part of the sheet?"""
+        return not (
+            "/" in filename or filename.startswith(".")
+            or filename.endswith(".json") or filename.startswith("sheets-history."))
+
     def fixup_globals(self):
         for name, value in self.extra_globals.items():
             self.globals.setdefault(name, value)
 
-    def execute(self, filename, content, subexpressions=False):
+    def execute(self, filename, content, subexpressions=False, use_cache=True, profile=False):
         print("Executing", filename, subexpressions)
         self.fixup_globals()
-        stdout = Stdout()
+        content_hash = hashlib.sha1(content.encode("UTF-8")).hexdigest()
+        if use_cache and self.cache_executions and not profile:
+            cached = self._execution_cache.get(filename)
+            if (cached and cached["key"] == (content_hash, subexpressions)
+                    and cached["stamps"] == self.input_stamps(cached["used"])
+                    and cached["output_stamps"] == self.input_stamps(cached["outputs"])):
+                self.replay_execution(filename, content, cached)
+                return
+        stdout = Stdout(
+            stream_filename=filename if self.stream_output else None,
+            flush_in_background=self.flush_output_in_background)
         compiled = None
+        parsed = None
+        used = set()
         try:
-            parsed = ast.parse(content, filename, mode='exec')
-            RewriteExprToPrint(subexpressions).walk(parsed)
-            var_inspect = VariableInspector()
-            var_inspect.walk(parsed)
-            print("varsed used:", sorted(var_inspect.used), "set:", sorted(var_inspect.set), "imported:", var_inspect.imports)
-            compiled = compile(parsed, filename, 'exec')
+            cell = self.compile_cache.compiled(
+                filename, content_hash, (subexpressions, self.report_loop_progress),
+                partial(compile_cell, filename, content, subexpressions, self.report_loop_progress))
+            parsed = cell.tree
+            used = cell.used
+            compiled = cell.code
         except:
             stdout.write(traceback.format_exc())
 
@@ -86,219 +141,762 @@ class Environment:
         self.globals["parsed"] = parsed
         self.globals["ast"] = ast
         globals_before = self.globals.copy()
+        failed = not compiled
+        profiler = LineProfiler(filename) if profile else None
         start = time.time()
         try:
             try:
-                if compiled:
+                if compiled and profiler:
+                    with profiler:
+                        exec(compiled, self.globals)
+                elif compiled:
                     exec(compiled, self.globals)
             except:
+                failed = True
                 traceback.print_exc()
         finally:
             end = time.time()
             sys.dipslayhook = orig_displayhook
             sys.stdout = orig_stdout
             sys.stderr = orig_stderr
+        stdout.write_expr_stats()
+        self._execution_serial += 1
+        self._executed[filename] = (content, self._execution_serial)
         local_scope = dict(
             (name, value)
             for name, value in self.globals.items()
             if name not in globals_before or globals_before[name] is not value)
+        deleted = set(globals_before) - set(self.globals)
+        self.bump_versions(used, rebound=set(local_scope) | deleted)
+        # Old values of these variables don't need to be kept for clients
+        # any more:
+        for name in set(local_scope) | deleted:
+            value_registry.forget_name(name)
         defines = dict(
             (key, {
-                "json": jsonify(local_scope[key]),
+                "json": jsonify_summary(local_scope[key], name=key),
                 "type": str(type(local_scope[key])),
             })
             for key in local_scope
             if not isinstance(local_scope[key], types.ModuleType))
+        if failed:
+            self._execution_cache.pop(filename, None)
+        else:
+            self._execution_cache[filename] = {
+                "key": (content_hash, subexpressions),
+                "used": used,
+                "stamps": self.input_stamps(used),
+                # Only the names, so the values can be freed (the stamps
+                # tell if they are still the same):
+                "outputs": set(local_scope),
+                # Other files that use these values may change them, and
+                # then they can't be replayed:
+                "output_stamps": self.input_stamps(local_scope),
+                "emitted": stdout.emitted,
+                "defines": defines,
+            }
+        stdout.close()
+        emitted = stdout.emitted
+        if stdout.output_id:
+            # Everything has been streamed, so only refer to that output
+            emitted = []
         command = Execution(
             filename=filename,
             content=content,
-            emitted=stdout.emitted,
+            emitted=emitted,
+            output_id=stdout.output_id,
+            output_chunks=stdout.chunks_sent,
             defines=defines,
             start_time=int(start * 1000),
             end_time=int(end * 1000),
             exec_time=int((end - start) * 1000),
             with_subexpressions=subexpressions,
+            profile=profiler.json if profiler else None,
         )
         send(command)
 
+    def replay_execution(self, filename, content, cached):
+        """Sends the results of a cached execution without running the code
+        again.  This is only done while the globals it defined are unchanged,
+        so there is nothing to restore"""
+        print("Replaying cached execution of", filename)
+        if filename not in self._executed:
+            self._execution_serial += 1
+            self._executed[filename] = (content, self._execution_serial)
+        start = now()
+        command = Execution(
+            filename=filename,
+            content=content,
+            emitted=cached["emitted"],
+            defines=cached["defines"],
+            start_time=start,
+            end_time=start,
+            exec_time=0,
+            with_subexpressions=cached["key"][1],
+            cached=True,
+        )
+        send(command)
+
+    # Values of these types can't be changed by code that only uses them
+    # (modules can, like cfg.x = 1 or np.random.seed()):
+    immutable_types = (
+        int, float, complex, bool, str, bytes, type(None), frozenset,
+        type, types.FunctionType, types.BuiltinFunctionType)
+
+    def bump_versions(self, used, rebound=()):
+        """Marks globals as (possibly) changed: all the rebound (or deleted)
+        names, and the used names whose values are mutable.  Rebound names
+        are always bumped, as the id() of a new value can be that of a freed
+        old one"""
+        for name in set(used) | set(rebound):
+            if name in rebound or not isinstance(self.globals.get(name), self.immutable_types):
+                self._global_versions[name] += 1
+
+    def input_stamps(self, names):
+        return dict(
+            (name, (id(self.globals[name]), self._global_versions[name]) if name in self.globals else None)
+            for name in names)
+
+    def expand_value(self, handle, offset=None, count=None, reply_to=None, column_offset=None):
+        """Sends more of a value that was only partly serialized"""
+        value = value_registry.get(handle)
+        if value is None:
+            page = {"type": "expired"}
+        else:
+            page = jsonify_page(value, offset, count, column_offset)
+        send(ValueExpansion(handle=handle, offset=offset, column_offset=column_offset, page=page, reply_to=reply_to))
+
+    def interrupt(self):
+        print("Warning: cannot interrupt code running in the server process")
+
+    def restart(self):
+        print("Resetting environment")
+        self.reset()
+
+    def forget_file(self, filename):
+        with self._analysis_lock:
+            self._cached_analysis.pop(filename, None)
+        self._executed.pop(filename, None)
+        self._execution_cache.pop(filename, None)
+
+    def cached_analysis(self):
+        """A copy of the latest analysis of every file"""
+        with self._analysis_lock:
+            return dict(self._cached_analysis)
+
+    def dependency_graph(self):
+        return DependencyGraph(self.cached_analysis())
+
+    def execute_stale(self, files, analyses=None):
+        """Executes every file whose inputs have changed since it was last
+        run, in dependency order.  `files` is a dictionary of filename to
+        content"""
+        if analyses is not None:
+            with self._analysis_lock:
+                self._cached_analysis.update(analyses)
+        graph = self.dependency_graph()
+        stale = graph.stale(files, self._executed)
+        print("Executing stale files:", stale)
+        for filename in stale:
+            if filename not in files:
+                continue
+            self.execute(filename, files[filename])
+
     def analyze(self, filename, content):
         print("Analyzing", filename)
         properties = {}
+        content_hash = hashlib.sha1(content.encode("UTF-8")).hexdigest()
         try:
-            parsed = ast.parse(content, filename, mode='exec')
-            var_inspect = VariableInspector()
-            var_inspect.walk(parsed)
+            properties = self.compile_cache.analysis(
+                filename, content_hash, partial(analyze_content, filename, content))
         except:
             return
             properties["parse_error"] = jsonify(traceback.format_exc())
-        else:
-            properties = var_inspect.json
-        if properties != self._cached_analysis.get(filename):
-            self._cached_analysis[filename] = properties
+        with self._analysis_lock:
+            changed = properties != self._cached_analysis.get(filename)
+            if changed:
+                self._cached_analysis[filename] = properties
+        if changed:
             send(Analysis(filename=filename, content=content, properties=properties))
 
 
-class VariableInspector(astor.TreeWalk):
+def analyze_content(filename, content):
+    parsed = ast.parse(content, filename, mode='exec')
+    var_inspect = VariableInspector()
+    var_inspect.walk(parsed)
+    return var_inspect.json
 
-    builtin_names = dir(builtins)
 
-    def init_variables(self):
-        self.used = set()
-        self.set = set()
-        self.imports = set()
-        self.in_target = False
+# Compiled cells can be cached on disk; increment compilecache.rewriter_version
+# when this changes how code is rewritten
+def compile_cell(filename, content, subexpressions, report_loop_progress):
+    parsed = ast.parse(content, filename, mode='exec')
+    RewriteExprToPrint(content, subexpressions).walk(parsed)
+    used = loaded_names(parsed) - Environment.predefined_names
+    # After finding the names used, as loop_progress isn't one of them:
+    if report_loop_progress:
+        add_loop_progress(parsed)
+    return CompiledCell(parsed, used, compile(parsed, filename, 'exec'))
 
-    @property
-    def json(self):
-        used = set(self.used)
-        for key in self.builtin_names:
-            used.discard(key)
-        for key in self.set:
-            used.discard(key)
-        for key in Environment.predefined_names:
-            used.discard(key)
-        return {
-            "variables_used": list(used),
-            "variables_set": list(self.set),
-            "imports": list(self.imports)
-        }
 
-    def pre_arg(self):
-        self.set.add(self.cur_node.arg)
+def loaded_names(tree):
+    """Returns the names whose values are read anywhere in tree"""
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Load):
+            names.add(node.id)
+        elif isinstance(node, ast.AugAssign) and isinstance(node.target, ast.Name):
+            names.add(node.target.id)
+    return names
 
-    def pre_Name(self):
-        if self.in_target:
-            # Actually this is a set
-            self.set.add(self.cur_node.id)
-        else:
-            self.used.add(self.cur_node.id)
 
-    def pre_For(self):
-        self.process_assignment(self.cur_node.target)
+def all_arguments(args):
+    """The ast.arg nodes of a function's arguments"""
+    return [
+        arg for arg in args.posonlyargs + args.args + args.kwonlyargs + [args.vararg, args.kwarg]
+        if arg is not None]
 
-    def pre_Assign(self):
-        self.process_assignment(self.cur_node.targets)
 
-    def pre_withitem(self):
-        self.process_assignment(self.cur_node.optional_vars)
+class Scope:
+    """A function (or lambda), class or comprehension scope being analyzed"""
 
-    def pre_ExceptHandler(self):
-        if self.cur_node.name:
-            self.set.add(self.cur_node.name)
+    __slots__ = ("kind", "parent", "bound", "loads", "global_names")
 
-    def pre_alias(self):
-        # Used in imports
-        name = self.cur_node.asname or self.cur_node.name
-        name = name.split(".")[0]
-        self.set.add(name)
-        self.imports.add(name)
+    def __init__(self, kind, parent):
+        self.kind = kind
+        self.parent = parent
+        # Names bound in this scope (so far, for a class):
+        self.bound = set()
+        # Names read in this scope, resolved when the scope ends:
+        self.loads = set()
+        self.global_names = set()
 
-    def pre_FunctionDef(self):
-        self.set.add(self.cur_node.name)
 
-    def pre_ListComp(self):
-        self.process_assignment(self.cur_node.elt)
+class VariableInspector(ast.NodeVisitor):
+    """Finds the module-level variables a file uses (reads before setting
+    them) and sets, and what it imports, in one pass over the tree.
 
-    def process_assignment(self, item):
-        if isinstance(item, list):
-            for x in item:
-                self.process_assignment(x)
-            return
-        old_in_target = self.in_target
-        self.in_target = True
+    Module-level code is followed in execution order.  Names inside
+    functions, lambdas, classes and comprehensions are resolved like Python
+    does, so their locals don't count.  Reads of globals from function
+    bodies happen when the function is called, so they only count as uses
+    if the file doesn't set the variable anywhere.  Attribute and item
+    assignments at module level (like df["a"] = ...) count as using and
+    setting the variable"""
+
+    builtin_names = dir(builtins)
+
+    def __init__(self):
+        self.used = set()
+        self.set = set()
+        self.imports = set()
+        # Module-level names bound so far:
+        self.bound = set()
+        # Globals read by functions:
+        self.deferred = set()
+        # The innermost function, class or comprehension scope, or None at
+        # module level:
+        self.scope = None
+
+    def walk(self, tree):
+        self.visit(tree)
+
+    @property
+    def json(self):
+        used = self.used | (self.deferred - self.set)
+        used.difference_update(self.builtin_names, Environment.predefined_names)
+        return {
+            "variables_used": sorted(used),
+            "variables_set": sorted(self.set),
+            "imports": sorted(self.imports),
+        }
+
+    def load(self, name, scope):
+        """Records a read of name that happens now (not later, like in a
+        function body), from scope"""
+        while scope is not None and scope.kind == "class":
+            if name in scope.bound:
+                return
+            scope = scope.parent
+        if scope is None:
+            if name not in self.bound:
+                self.used.add(name)
+        elif name in scope.global_names:
+            self.deferred.add(name)
+        else:
+            scope.loads.add(name)
+
+    def store(self, name, scope):
+        if scope is None:
+            self.bound.add(name)
+            self.set.add(name)
+        elif name in scope.global_names:
+            self.set.add(name)
+        else:
+            scope.bound.add(name)
+
+    def enclosing_function_scope(self, scope):
+        """The scope reads from a function body go to, skipping classes (whose
+        names functions can't see)"""
+        scope = scope.parent
+        while scope is not None and scope.kind == "class":
+            scope = scope.parent
+        return scope
+
+    def run_scope(self, kind, visit_body):
+        scope = self.scope = Scope(kind, self.scope)
         try:
-            self.walk(item)
+            visit_body()
         finally:
-            self.in_target = old_in_target
-
-class RewriteExprToPrint(astor.TreeWalk):
-
-    expr_node_types = """
-    UnaryOp
-    BinOp
-    BoolOp
-    Compare
-    Call
-    IfExp
-    Attribute
-    Subscript
-    ListComp SetComp GeneratorExp DictComp
-    """.split()
-    # Skipped:
-    #  UAdd USub Not Invert
-    #  Add Sub Mult Div FloorDiv Mod Pow LShift RShift BitOr BitXor BitAnd MatMult
-    #  And Or
-    #  Eq NotEq Lt Gt GtE Is IsNot In NotIn
-    #  Index Slice ExtSlice
-
-    def __init__(self, subexpressions=False):
+            self.scope = scope.parent
+        if kind == "class":
+            return
+        parent = self.enclosing_function_scope(scope)
+        for name in scope.loads - scope.bound:
+            if kind == "comprehension":
+                # Run right away, like the code around it
+                self.load(name, parent)
+            elif parent is None:
+                self.deferred.add(name)
+            else:
+                parent.loads.add(name)
+
+    def visit_Name(self, node):
+        if isinstance(node.ctx, ast.Load):
+            self.load(node.id, self.scope)
+        else:
+            self.store(node.id, self.scope)
+
+    def visit_target_base(self, node):
+        self.generic_visit(node)
+        if self.scope is None and not isinstance(node.ctx, ast.Load):
+            # Assigning to an attribute or item changes the variable
+            base = node.value
+            while isinstance(base, (ast.Attribute, ast.Subscript)):
+                base = base.value
+            if isinstance(base, ast.Name):
+                self.set.add(base.id)
+
+    visit_Attribute = visit_target_base
+    visit_Subscript = visit_target_base
+
+    def visit_Assign(self, node):
+        self.visit(node.value)
+        for target in node.targets:
+            self.visit(target)
+
+    def visit_AugAssign(self, node):
+        if isinstance(node.target, ast.Name):
+            self.load(node.target.id, self.scope)
+        self.visit(node.value)
+        self.visit(node.target)
+
+    def visit_AnnAssign(self, node):
+        if node.value is not None:
+            self.visit(node.value)
+        self.visit(node.annotation)
+        if node.value is not None or not isinstance(node.target, ast.Name):
+            self.visit(node.target)
+
+    def visit_For(self, node):
+        self.visit(node.iter)
+        self.visit(node.target)
+        for stmt in node.body + node.orelse:
+            self.visit(stmt)
+
+    visit_AsyncFor = visit_For
+
+    def visit_NamedExpr(self, node):
+        self.visit(node.value)
+        # Binds in the scope around any comprehensions
+        scope = self.scope
+        while scope is not None and scope.kind == "comprehension":
+            scope = scope.parent
+        self.store(node.target.id, scope)
+
+    def visit_Import(self, node):
+        for alias in node.names:
+            if alias.name == "*":
+                continue
+            name = (alias.asname or alias.name).split(".")[0]
+            self.store(name, self.scope)
+            self.imports.add(name)
+
+    visit_ImportFrom = visit_Import
+
+    def visit_Global(self, node):
+        if self.scope is not None:
+            self.scope.global_names.update(node.names)
+
+    def visit_Nonlocal(self, node):
+        # The names belong to an enclosing function
+        if self.scope is not None:
+            self.scope.bound.update(node.names)
+
+    def visit_ExceptHandler(self, node):
+        if node.type is not None:
+            self.visit(node.type)
+        if node.name:
+            self.store(node.name, self.scope)
+        for stmt in node.body:
+            self.visit(stmt)
+
+    def visit_MatchAs(self, node):
+        if node.pattern is not None:
+            self.visit(node.pattern)
+        if node.name:
+            self.store(node.name, self.scope)
+
+    def visit_MatchStar(self, node):
+        if node.name:
+            self.store(node.name, self.scope)
+
+    def visit_MatchMapping(self, node):
+        self.generic_visit(node)
+        if node.rest:
+            self.store(node.rest, self.scope)
+
+    def visit_defaults(self, args):
+        for default in args.defaults + args.kw_defaults:
+            if default is not None:
+                self.visit(default)
+
+    def bind_arguments(self, args):
+        for arg in all_arguments(args):
+            self.scope.bound.add(arg.arg)
+
+    def visit_FunctionDef(self, node):
+        for decorator in node.decorator_list:
+            self.visit(decorator)
+        self.visit_defaults(node.args)
+        for arg in all_arguments(node.args):
+            if arg.annotation is not None:
+                self.visit(arg.annotation)
+        if node.returns is not None:
+            self.visit(node.returns)
+
+        def visit_body():
+            self.bind_arguments(node.args)
+            for stmt in node.body:
+                self.visit(stmt)
+
+        self.run_scope("function", visit_body)
+        self.store(node.name, self.scope)
+
+    visit_AsyncFunctionDef = visit_FunctionDef
+
+    def visit_Lambda(self, node):
+        self.visit_defaults(node.args)
+
+        def visit_body():
+            self.bind_arguments(node.args)
+            self.visit(node.body)
+
+        self.run_scope("function", visit_body)
+
+    def visit_ClassDef(self, node):
+        for expr in node.decorator_list + node.bases + [k.value for k in node.keywords]:
+            self.visit(expr)
+
+        def visit_body():
+            for stmt in node.body:
+                self.visit(stmt)
+
+        self.run_scope("class", visit_body)
+        self.store(node.name, self.scope)
+
+    def visit_comprehension_node(self, node):
+        generators = node.generators
+        # The first iterable is evaluated in the enclosing scope:
+        self.visit(generators[0].iter)
+
+        def visit_body():
+            for i, generator in enumerate(generators):
+                if i:
+                    self.visit(generator.iter)
+                self.visit(generator.target)
+                for test in generator.ifs:
+                    self.visit(test)
+            if isinstance(node, ast.DictComp):
+                self.visit(node.key)
+                self.visit(node.value)
+            else:
+                self.visit(node.elt)
+
+        self.run_scope("comprehension", visit_body)
+
+    visit_ListComp = visit_comprehension_node
+    visit_SetComp = visit_comprehension_node
+    visit_GeneratorExp = visit_comprehension_node
+    visit_DictComp = visit_comprehension_node
+
+
+class SourceSegments:
+    """Gets the source code of nodes from their positions, like
+    ast.get_source_segment but without splitting the source again for every
+    node"""
+
+    def __init__(self, source):
+        # Column offsets in the AST are in UTF-8 bytes
+        self.source = source.encode("UTF-8")
+        self.line_starts = [0]
+        for line in self.source.splitlines(keepends=True):
+            self.line_starts.append(self.line_starts[-1] + len(line))
+
+    def get(self, node):
+        """The source of node, or None if it has no position"""
+        try:
+            start = self.line_starts[node.lineno - 1] + node.col_offset
+            end = self.line_starts[node.end_lineno - 1] + node.end_col_offset
+        except (AttributeError, IndexError, TypeError):
+            return None
+        return self.source[start:end].decode("UTF-8", "replace")
+
+
+class RewriteExprToPrint(ast.NodeTransformer):
+    """Wraps top-level expression statements in print_expr() calls, or with
+    subexpressions, every expression of expr_node_types and every name that
+    is read"""
+
+    expr_node_types = (
+        ast.UnaryOp,
+        ast.BinOp,
+        ast.BoolOp,
+        ast.Compare,
+        ast.Call,
+        ast.IfExp,
+        ast.Attribute,
+        ast.Subscript,
+        ast.ListComp, ast.SetComp, ast.GeneratorExp, ast.DictComp,
+        ast.Name,
+    )
+
+    def __init__(self, source, subexpressions=False):
+        self.segments = SourceSegments(source)
         self.subexpressions = subexpressions
         self.id_counter = 0
-        astor.TreeWalk.__init__(self)
-        if self.subexpressions:
-            for method in self.expr_node_types:
-                self.pre_handlers[method] = self.save_node_name
-                self.post_handlers[method] = self.fixup_subexpressions
-            del self.post_handlers['Module']
-
-    def post_Name(self):
-        if not self.subexpressions:
-            return
-        if isinstance(self.cur_node.ctx, ast.Load):
-            self.replace(self.rewrite_expr(self.cur_node))
 
-    def post_Module(self):
-        node = self.cur_node
-        node.body = [
-            self.rewrite_expr(n) if isinstance(n, ast.Expr) else n
-            for n in node.body]
-
-    def save_node_name(self):
-        self.cur_node.astor_repr = astor.to_source(self.cur_node)
-
-    def fixup_subexpressions(self):
-        new_node = self.rewrite_expr(self.cur_node, self.cur_node.astor_repr)
-        self.replace(new_node)
+    def walk(self, tree):
+        if self.subexpressions:
+            # The rewrite makes no reference cycles, but creates enough nodes
+            # that collections (which go through the whole tree) dominate:
+            gc_enabled = gc.isenabled()
+            gc.disable()
+            try:
+                self.visit(tree)
+            finally:
+                if gc_enabled:
+                    gc.enable()
+        else:
+            tree.body = [
+                self.rewrite_expr(n) if isinstance(n, ast.Expr) else n
+                for n in tree.body]
+
+    def generic_visit(self, node):
+        if not isinstance(node, self.expr_node_types):
+            return super().generic_visit(node)
+        # Attributes, subscripts and names that are assigned or deleted:
+        if not isinstance(getattr(node, "ctx", ast.Load()), ast.Load):
+            return super().generic_visit(node)
+        # The source is from the original positions, so it can be taken
+        # before or after the node's children are rewritten:
+        expr_string = self.expr_source(node)
+        super().generic_visit(node)
+        return self.rewrite_expr(node, expr_string)
+
+    def expr_source(self, node):
+        expr_string = self.segments.get(node)
+        if expr_string is None:
+            expr_string = astor.to_source(node).strip()
+        return expr_string
 
     def rewrite_expr(self, node, expr_string=None):
         if expr_string is None:
-            expr_string = astor.to_source(node)
-        node_string = ast.Str(s=expr_string)
+            expr_string = self.expr_source(node)
         self.id_counter += 1
+        # Only the new nodes need locations (ast.fix_missing_locations would
+        # walk the whole, already rewritten, expression again):
+        location = dict(
+            lineno=node.lineno, col_offset=node.col_offset,
+            end_lineno=node.end_lineno, end_col_offset=node.end_col_offset)
+        call = ast.Call(
+            func=ast.Name(id='print_expr', ctx=ast.Load(), **location),
+            args=[
+                ast.Constant(value=expr_string, **location),
+                node.value if isinstance(node, ast.Expr) else node,
+                ast.Constant(value=self.id_counter, **location),
+            ],
+            keywords=[],
+            **location
+        )
         if isinstance(node, ast.Expr):
-            new_node = ast.Expr(
-                ast.Call(
-                    func=ast.Name(id='print_expr', ctx=ast.Load()),
-                    args=[node_string, node.value, ast.Num(n=self.id_counter)],
-                    keywords=[],
-                    starargs=None,
-                )
-            )
-            new_node.is_print_expr = True
+            new_node = ast.Expr(call, **location)
         else:
-            new_node = ast.Call(
-                func=ast.Name(id='print_expr', ctx=ast.Load()),
-                args=[node_string, node, ast.Num(n=self.id_counter)],
-                keywords=[],
-                starargs=None,
-            )
-            new_node.is_print_expr = True
-        ast.fix_missing_locations(new_node)
+            new_node = call
+        new_node.is_print_expr = True
         return new_node
 
 
+def add_loop_progress(tree):
+    """Wraps the iterables of top-level for loops in loop_progress().  Only
+    the module body is looked at, so this doesn't walk the whole tree"""
+    loop_id = 0
+    for node in tree.body:
+        if not isinstance(node, ast.For):
+            continue
+        loop_id += 1
+        node.iter = ast.Call(
+            func=ast.Name(id='loop_progress', ctx=ast.Load()),
+            args=[node.iter, ast.Constant(value=loop_id), ast.Constant(value=node.lineno)],
+            keywords=[],
+        )
+        ast.copy_location(node.iter, node.iter.args[0])
+        ast.fix_missing_locations(node.iter)
+
+# Loops only report progress once they have run this long (in seconds):
+progress_delay = 0.5
+# And then about this often:
+progress_interval = 0.5
+
+def loop_progress(iterable, loop_id, lineno):
+    """Yields the items of iterable, sending ExecutionProgress commands if
+    the loop takes longer than progress_delay.  The time is only checked
+    after as many iterations as should take progress_interval"""
+    stdout = sys.stdout
+    if not isinstance(stdout, Stdout) or not stdout.stream_filename:
+        yield from iterable
+        return
+    try:
+        # Iterators without a length (like generators) give 0, for unknown
+        total = operator.length_hint(iterable, 0) or None
+    except Exception:
+        total = None
+    start = time.time()
+    count = 0
+    check_at = 1
+    reported = False
+    try:
+        for item in iterable:
+            yield item
+            count += 1
+            if count == check_at:
+                elapsed = time.time() - start
+                if elapsed >= progress_delay:
+                    stdout.send_progress(loop_id, lineno, count, total, elapsed)
+                    reported = True
+                if elapsed:
+                    check_at = count + max(1, int(count / elapsed * progress_interval))
+                else:
+                    check_at = count * 2
+    finally:
+        if reported:
+            stdout.send_progress(loop_id, lineno, count, total, time.time() - start, done=True)
+
 class Stdout:
 
     total_exprs_limit = 100
     expr_limit = 10
-
-    def __init__(self):
+    # When streaming, the first output is sent right away, then at most this
+    # often (in seconds), unless this many items are waiting to be sent.
+    # With flush_in_background, output that is waiting is sent by a timer, so
+    # it shows while the cell is still busy:
+    flush_interval = 0.25
+    flush_items = 100
+
+    def __init__(self, stream_filename=None, flush_in_background=False):
         self.emitted = []
         self.total_exprs_printed = 0
         self.exprs_printed = collections.Counter()
+        # expr_id -> ExprSite:
+        self.expr_sites = {}
+        self.stream_filename = stream_filename
+        self.output_id = None
+        self.chunks_sent = 0
+        self.unsent = 0
+        self.last_sent = 0
+        self.flush_in_background = flush_in_background
+        # Guards the streaming state, which the flush timer uses too:
+        self.lock = threading.RLock()
+        self.flush_timer = None
+        self.closed = False
+        # Set on the thread that is sending a command:
+        self.sending = threading.local()
+
+    def emit(self, item):
+        if not self.stream_filename:
+            self.emitted.append(item)
+            return
+        with self.lock:
+            self.emitted.append(item)
+            self.unsent += 1
+            wait = self.flush_interval - (time.time() - self.last_sent)
+            if self.unsent >= self.flush_items or wait <= 0:
+                self.send_output()
+            elif self.flush_in_background and self.flush_timer is None and not self.closed:
+                self.flush_timer = threading.Timer(wait, self.flush_from_timer)
+                self.flush_timer.daemon = True
+                self.flush_timer.start()
+
+    def flush_from_timer(self):
+        with self.lock:
+            self.flush_timer = None
+            if not self.closed:
+                self.send_output()
+
+    def close(self):
+        """Stops the flush timer, sending anything that is waiting; call when
+        the execution is done"""
+        with self.lock:
+            self.closed = True
+            if self.flush_timer is not None:
+                self.flush_timer.cancel()
+                self.flush_timer = None
+            self.send_output()
+
+    def send_output(self):
+        """Sends any output that hasn't been sent yet as an ExecutionOutput
+        command"""
+        if not self.unsent:
+            return
+        if self.output_id is None:
+            self.output_id = "o-%s" % time.time()
+        command = ExecutionOutput(
+            filename=self.stream_filename,
+            output_id=self.output_id,
+            index=self.chunks_sent,
+            emitted=self.emitted[-self.unsent:],
+        )
+        self.send_command(command)
+        self.chunks_sent += 1
+        self.unsent = 0
+        self.last_sent = time.time()
+
+    def send_progress(self, loop_id, lineno, count, total, elapsed, done=False):
+        self.send_command(ExecutionProgress(
+            filename=self.stream_filename,
+            loop_id=loop_id,
+            lineno=lineno,
+            count=count,
+            total=total,
+            elapsed=round(elapsed, 3),
+            done=done,
+        ))
+
+    def send_command(self, command):
+        # Anything the server prints while sending shouldn't end up in the
+        # output.  sys.stdout isn't swapped, as the flush timer sends while
+        # the cell is still running on another thread:
+        self.sending.active = True
+        try:
+            send(command)
+        finally:
+            self.sending.active = False
 
     def write(self, content):
-        self.emitted.append({
+        if getattr(self.sending, "active", False):
+            sys.__stdout__.write(content)
+            return
+        self.emit({
             "type": "print",
             "time": now(),
             "parts": [{"type": "str", "str": content}],
@@ -307,10 +905,17 @@ class Stdout:
     def writejson(self, json):
         assert json.get("type"), "JSON objects must have a type"
         json.setdefault("time", now())
-        self.emitted.append(json)
+        self.emit(json)
 
     def write_repr(self, o):
-        self.emitted.append(jsonify(o))
+        self.emit(jsonify(o))
+
+    def write_expr_stats(self):
+        """Writes the statistics of the expressions whose values stopped
+        being printed"""
+        for expr_id, site in sorted(self.expr_sites.items()):
+            if site.suppressed:
+                self.writejson(site.json)
 
     def flush(self):
         pass
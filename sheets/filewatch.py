@@ -1,62 +1,186 @@
+"""
+Watches the sheet directory for changes made outside of sheets (in other
+editors, or by syncing files), and sends them as commands.
+
+Events are collected, and only processed once no new events have come in
+for debounce seconds (or max_delay seconds have passed).  A changed file is
+only read if its size, mtime or inode changed, and is compared to the model
+by hash.  Files are read without holding the router lock, so if a file
+changed again by the time the lock is held (for instance, the server wrote
+it), that read is dropped and the newer event is processed instead.
+"""
 import os
+import time
 import atexit
+import hashlib
+import threading
 from watchdog.observers import Observer
+from watchdog.observers.polling import PollingObserver
 from watchdog.events import FileSystemEventHandler
-from .datalayer import FileEdit, FileDelete
-from .router import send
+from .datalayer import FileEdit, FilePatch, FileDelete
+from . import router
+
+debounce = 0.2
+max_delay = 2.0
+# Seconds between scans when polling:
+poll_interval = 1.0
 
-def watch(env, model):
-    return
+
+def watch(env, model, polling=False):
+    """Starts watching env.path.  If polling is false, native file system
+    events are used if possible, falling back to polling (which also works on
+    network file systems)"""
     event_handler = FileStoreEventHandler(env, model)
-    observer = Observer()
-    observer.schedule(event_handler, env.path, recursive=True)
-    observer.start()
+    observer = None
+    if not polling:
+        try:
+            observer = Observer()
+            observer.schedule(event_handler, env.path, recursive=True)
+            observer.start()
+        except OSError as e:
+            print("Could not watch {} for changes ({}), polling instead".format(env.path, e))
+            observer = None
+    if observer is None:
+        observer = PollingObserver(timeout=poll_interval)
+        observer.schedule(event_handler, env.path, recursive=True)
+        observer.start()
     atexit.register(observer.stop)
+    return observer
+
+
+def file_hash(data):
+    return hashlib.sha1(data).hexdigest()
+
 
 class FileStoreEventHandler(FileSystemEventHandler):
 
     def __init__(self, env, model):
         self.env = env
+        self.base = os.path.abspath(env.path)
         self.model = model
+        # Names of changed files, waiting to be processed:
+        self.pending = set()
+        self.first_event = self.last_event = None
+        self.changed = threading.Condition()
+        # (size, mtime) and hash of each file when it was last read:
+        self.stats = {}
+        self.hashes = {}
+        # The version and hash of each file's content in the model:
+        self.model_hashes = {}
+        self.thread = threading.Thread(target=self.process_events, daemon=True)
+        self.thread.start()
 
     def name_from_path(self, path):
-        path = os.path.abspath(os.path.join(self.env.path, path))
-        if not path.startswith(os.path.abspath(self.env.path)):
-            print("Unexpected update of file {} not under {}".format(path, self.env.path))
-            raise Exception("Bad file: {}".format(path))
-        path = path[len(os.path.abspath(self.env.path)):].lstrip("/")
-        return path
+        path = os.path.abspath(os.path.join(self.base, path))
+        if not path.startswith(self.base):
+            print("Unexpected update of file {} not under {}".format(path, self.base))
+            return None
+        return path[len(self.base):].lstrip("/")
+
+    def add_pending(self, *paths):
+        with self.changed:
+            for path in paths:
+                name = self.name_from_path(path)
+                if name and self.env.is_sheet_file(name):
+                    self.pending.add(name)
+            now = time.time()
+            if self.first_event is None:
+                self.first_event = now
+            self.last_event = now
+            self.changed.notify()
 
     def on_modified(self, event):
-        if event.is_directory:
-            return
-        filename = event.src_path
-        name = self.name_from_path(filename)
-        with open(filename, "r") as fp:
-            content = fp.read()
-        expected = self.model.files.get(name)
-        if expected and expected["content"] == content:
-            return
-        send(FileEdit(filename=name, content=content, external_edit=True))
+        if not event.is_directory:
+            self.add_pending(event.src_path)
 
-    on_created = on_modified
+    on_created = on_deleted = on_modified
 
     def on_moved(self, event):
-        if event.is_directory:
+        if not event.is_directory:
+            self.add_pending(event.src_path, event.dest_path)
+
+    def process_events(self):
+        while True:
+            with self.changed:
+                while not self.pending:
+                    self.changed.wait()
+                now = time.time()
+                wait = min(self.last_event + debounce, self.first_event + max_delay) - now
+                if wait > 0:
+                    self.changed.wait(wait)
+                    continue
+                names = self.pending
+                self.pending = set()
+                self.first_event = self.last_event = None
+            for name in sorted(names):
+                try:
+                    self.process_file(name)
+                except Exception as e:
+                    print("Error processing change to {}: {}".format(name, e))
+
+    def file_stats(self, stat):
+        # The server replaces files, so the inode changes too:
+        return (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+    def unchanged_since_read(self, name, path, stats):
+        try:
+            current = self.file_stats(os.stat(path))
+        except FileNotFoundError:
+            current = None
+        if current != stats:
+            # There is an event for the change, which will read it again
+            self.stats.pop(name, None)
+            self.hashes.pop(name, None)
+            self.add_pending(path)
+            return False
+        return True
+
+    def process_file(self, name):
+        path = os.path.join(self.base, name)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            self.stats.pop(name, None)
+            self.hashes.pop(name, None)
+            self.model_hashes.pop(name, None)
+            with router.a_router.lock:
+                if name in self.model.files:
+                    router.send(FileDelete(filename=name, external_edit=True))
+            return
+        stats = self.file_stats(stat)
+        if self.stats.get(name) == stats:
+            return
+        with open(path, "rb") as fp:
+            data = fp.read()
+        self.stats[name] = stats
+        h = file_hash(data)
+        if self.hashes.get(name) == h:
             return
-        name = self.name_from_path(event.src_path)
-        dest_name = self.name_from_path(event.dest_path)
-        if self.model.files.get(name):
-            send(FileDelete(filename=name), external_edit=True)
-        with open(event.dest_path, "r") as fp:
-            content = fp.read()
-        expected = self.model.files.get(dest_name)
-        if not expected or expected["content"] != content:
-            send(FileEdit(filename=dest_name, content=content, external_edit=True))
-
-    def on_deleted(self, event):
-        if event.is_directory:
+        self.hashes[name] = h
+        try:
+            # Newlines are translated like reading in text mode (as
+            # Environment.init_commands does)
+            content = data.decode("UTF-8").replace("\r\n", "\n").replace("\r", "\n")
+        except UnicodeDecodeError:
             return
-        name = self.name_from_path(event.src_path)
-        if self.model.files.get(name):
-            send(FileDelete(filename=name, external_edit=True))
+        content_hash = file_hash(content.encode("UTF-8"))
+        # Model.files (and the files themselves, by the server) are only
+        # changed while holding the router lock:
+        with router.a_router.lock:
+            if not self.unchanged_since_read(name, path, stats):
+                return
+            f = self.model.files.get(name)
+            if f is None:
+                router.send(FileEdit(filename=name, content=content, external_edit=True))
+                return
+            old = f.get("content") or ""
+            version = f.get("version", 0)
+            model_hash = self.model_hashes.get(name)
+            if model_hash is None or model_hash[0] != version:
+                model_hash = self.model_hashes[name] = (version, file_hash(old.encode("UTF-8")))
+            if model_hash[1] == content_hash:
+                # Probably a file written by a FileEdit or FilePatch
+                return
+            router.send(FilePatch.from_contents(
+                filename=name, old=old, new=content,
+                base_version=f.get("version", 0), external_edit=True))
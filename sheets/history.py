@@ -1,49 +1,104 @@
-import rocksdb
 import os
-import json
+import threading
+import collections
 from . import datalayer
+from . import encoding
+from . import metrics
+from .historystore import backends, default_backend
 
 class History:
 
-    def __init__(self, base_path):
+    # A checkpoint of the model is saved after this many commands:
+    checkpoint_every = 1000
+
+    def __init__(self, base_path, backend=None, encoding_name=None):
         self.base_path = base_path
-        self.db_path = os.path.join(self.base_path, "sheets-history.db")
-        self.db = rocksdb.DB(self.db_path, rocksdb.Options(create_if_missing=True))
+        self.backend = backend or default_backend
+        # Saved commands are decoded from whatever encoding they were saved in:
+        self.encoding = encoding_name or encoding.default_encoding
+        Store = backends[self.backend]
+        self.db_path = os.path.join(self.base_path, Store.filename)
+        self.store = Store(self.db_path)
+        self.since_checkpoint = 0
+        # Checkpoints saved in the background are written one at a time:
+        self.checkpoint_lock = threading.Lock()
 
     def save_command(self, command):
-        id = command.id.encode('ascii')
-        self.db.put(id, json.dumps(command.asJson).encode('UTF-8'))
+        with metrics.timed("history_save"):
+            data = self.encode(command)
+            self.store.put(command.id, data)
+        metrics.incr("history_bytes", len(data))
+        self.since_checkpoint += 1
+
+    def encode(self, command):
+        data = encoding.encode(command.asJson, self.encoding)
+        if isinstance(data, str):
+            data = data.encode('UTF-8')
+        return data
+
+    def checkpoint(self, snapshot):
+        """Saves a Snapshot of the model, and removes every command before it"""
+        keys = self.store.keys()
+        self.since_checkpoint = 0
+        self.write_checkpoint(snapshot, keys)
+
+    def checkpoint_in_background(self, snapshot):
+        """Like checkpoint(), but encodes and saves the snapshot on another
+        thread.  The snapshot must not be changed afterwards (see
+        Model.snapshot); commands saved in the meantime are kept"""
+        keys = self.store.keys()
+        # The id (a timestamp) has to come before any later command's:
+        snapshot.id
+        self.since_checkpoint = 0
+        thread = threading.Thread(target=self.write_checkpoint, args=(snapshot, keys))
+        thread.daemon = True
+        thread.start()
+
+    def write_checkpoint(self, snapshot, keys):
+        with self.checkpoint_lock:
+            with metrics.timed("history_checkpoint"):
+                self.store.write(
+                    puts=[(snapshot.id, self.encode(snapshot))],
+                    deletes=keys)
+        print("Saved checkpoint %s, replacing %s commands" % (snapshot.id, len(keys)))
 
     def get_commands(self, return_invalid=False):
-        it = self.db.itervalues()
-        it.seek_to_first()
-        commands = [json.loads(c.decode('UTF-8')) for c in it]
+        commands = [encoding.decode(c) for c in self.store.values()]
         if return_invalid:
             commands = [datalayer.hydrate(c, if_invalid=c) for c in commands]
         else:
             commands = [datalayer.hydrate(c, if_invalid=None) for c in commands]
             commands = [c for c in commands if c is not None]
+        # Everything before the latest checkpoint is already included in it:
+        for index in range(len(commands) - 1, -1, -1):
+            if isinstance(commands[index], datalayer.Snapshot):
+                commands = commands[index:]
+                break
         return list(commands)
 
     def clean_commands(self):
         commands = self.get_commands(return_invalid=True)
-        remove_ids = []
+        # scan_back() only looks at commands for the same file, so each
+        # command is given just the earlier commands for its file (which are
+        # popped as the scan moves back):
+        by_filename = collections.defaultdict(list)
+        for c in commands:
+            if not isinstance(c, dict):
+                by_filename[getattr(c, "filename", None)].append(c)
+        remove_ids = set()
         while commands:
             last = commands.pop()
             if isinstance(last, dict):
                 # Some invalid command in history
-                remove_ids.append(last["id"])
+                remove_ids.add(last["id"])
+                continue
+            earlier = by_filename[getattr(last, "filename", None)]
+            earlier.pop()
+            if last.id in remove_ids:
                 continue
-            to_remove = last.scan_back(commands)
-            if to_remove:
-                for c in to_remove:
-                    if c is not last:
-                        commands.remove(c)
-                    remove_ids.append(c.id)
-        batch = rocksdb.WriteBatch()
-        for id in remove_ids:
-            id = id.encode('ascii')
-            data = self.db.get(id)
-            print("Deleting", id.decode('ascii'), data)
-            batch.delete(id)
-            self.db.write(batch)
+            for c in last.scan_back(earlier) or ():
+                remove_ids.add(c.id)
+        if not remove_ids:
+            return
+        self.store.write(deletes=remove_ids)
+        print("Deleted %s commands from history" % len(remove_ids))
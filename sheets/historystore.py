@@ -0,0 +1,231 @@
+"""
+Storage backends for History.
+
+Each store keeps bytes values under string keys, and returns them in key
+order.  Command ids are time-based, so key order is the order commands were
+saved in.
+"""
+import os
+import time
+import struct
+import atexit
+import sqlite3
+import threading
+try:
+    import rocksdb
+except ImportError:
+    rocksdb = None
+
+
+class RocksDBStore:
+
+    filename = "sheets-history.db"
+
+    def __init__(self, path):
+        if rocksdb is None:
+            raise NotImplementedError("You must pip install python-rocksdb")
+        self.db = rocksdb.DB(path, rocksdb.Options(create_if_missing=True))
+
+    def put(self, key, value):
+        self.db.put(key.encode('ascii'), value)
+
+    def values(self):
+        it = self.db.itervalues()
+        it.seek_to_first()
+        return list(it)
+
+    def keys(self):
+        it = self.db.iterkeys()
+        it.seek_to_first()
+        return [k.decode('ascii') for k in it]
+
+    def write(self, puts=(), deletes=()):
+        batch = rocksdb.WriteBatch()
+        for key in deletes:
+            batch.delete(key.encode('ascii'))
+        for key, value in puts:
+            batch.put(key.encode('ascii'), value)
+        self.db.write(batch)
+
+    def close(self):
+        pass
+
+
+class SQLiteStore:
+    """Stores history in SQLite, in WAL mode.  Single commands are committed
+    in batches, once commit_every commands are waiting or commit_interval
+    seconds after the first of them (from a timer if no more commands come),
+    so that much can be lost if the process dies"""
+
+    filename = "sheets-history.sqlite"
+    commit_every = 100
+    commit_interval = 1.0
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS history (key TEXT PRIMARY KEY, value BLOB NOT NULL)")
+        self.conn.commit()
+        self.lock = threading.Lock()
+        self.uncommitted = 0
+        self.last_commit = time.time()
+        self.commit_timer = None
+        self.closed = False
+        atexit.register(self.close)
+
+    def commit(self):
+        self.conn.commit()
+        self.uncommitted = 0
+        self.last_commit = time.time()
+        if self.commit_timer is not None:
+            self.commit_timer.cancel()
+            self.commit_timer = None
+
+    def commit_from_timer(self):
+        with self.lock:
+            self.commit_timer = None
+            if self.uncommitted and not self.closed:
+                self.commit()
+
+    def put(self, key, value):
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO history (key, value) VALUES (?, ?)", (key, value))
+            self.uncommitted += 1
+            wait = self.commit_interval - (time.time() - self.last_commit)
+            if self.uncommitted >= self.commit_every or wait <= 0:
+                self.commit()
+            elif self.commit_timer is None and not self.closed:
+                self.commit_timer = threading.Timer(wait, self.commit_from_timer)
+                self.commit_timer.daemon = True
+                self.commit_timer.start()
+
+    def values(self):
+        with self.lock:
+            self.commit()
+            return [row[0] for row in self.conn.execute("SELECT value FROM history ORDER BY key")]
+
+    def keys(self):
+        with self.lock:
+            self.commit()
+            return [row[0] for row in self.conn.execute("SELECT key FROM history ORDER BY key")]
+
+    def write(self, puts=(), deletes=()):
+        with self.lock:
+            self.conn.executemany(
+                "DELETE FROM history WHERE key = ?", [(key,) for key in deletes])
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO history (key, value) VALUES (?, ?)", list(puts))
+            self.commit()
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            if self.uncommitted or self.commit_timer is not None:
+                self.commit()
+
+
+class LogStore:
+    """An append-only file of put and delete records.  All the live values are
+    kept in memory, and the file is rewritten once most of it is made up of
+    overwritten or deleted entries"""
+
+    filename = "sheets-history.log"
+    compact_minimum = 1000
+    # Each record is an op (b"p" or b"d"), the key length, the value length,
+    # then the key and value:
+    header = struct.Struct(">cII")
+
+    def __init__(self, path):
+        self.path = path
+        self.data = {}
+        self.dead = 0
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            self.read()
+        self.fp = open(path, "ab")
+
+    def read(self):
+        with open(self.path, "rb") as fp:
+            content = fp.read()
+        pos = 0
+        while pos < len(content):
+            end = pos + self.header.size
+            if end > len(content):
+                break
+            op, key_length, value_length = self.header.unpack_from(content, pos)
+            if end + key_length + value_length > len(content):
+                break
+            key = content[end:end + key_length].decode('ascii')
+            value = content[end + key_length:end + key_length + value_length]
+            self.apply(op, key, value)
+            pos = end + key_length + value_length
+        if pos < len(content):
+            print("Ignoring partially written record at the end of %s" % self.path)
+            with open(self.path, "r+b") as fp:
+                fp.truncate(pos)
+
+    def apply(self, op, key, value):
+        if key in self.data:
+            # The old entry, and the delete entry, are now dead
+            self.dead += 1 if op == b"p" else 2
+        if op == b"p":
+            self.data[key] = value
+        else:
+            self.data.pop(key, None)
+
+    def record(self, op, key, value):
+        key = key.encode('ascii')
+        return self.header.pack(op, len(key), len(value)) + key + value
+
+    def append(self, entries):
+        records = []
+        for op, key, value in entries:
+            self.apply(op, key, value)
+            records.append(self.record(op, key, value))
+        self.fp.write(b"".join(records))
+        self.fp.flush()
+        if self.dead > max(self.compact_minimum, len(self.data)):
+            self.compact()
+
+    def compact(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as fp:
+            for key in sorted(self.data):
+                fp.write(self.record(b"p", key, self.data[key]))
+        self.fp.close()
+        os.replace(tmp_path, self.path)
+        self.fp = open(self.path, "ab")
+        self.dead = 0
+
+    def put(self, key, value):
+        with self.lock:
+            self.append([(b"p", key, value)])
+
+    def values(self):
+        with self.lock:
+            return [self.data[key] for key in sorted(self.data)]
+
+    def keys(self):
+        with self.lock:
+            return sorted(self.data)
+
+    def write(self, puts=(), deletes=()):
+        with self.lock:
+            self.append(
+                [(b"d", key, b"") for key in deletes]
+                + [(b"p", key, value) for key, value in puts])
+
+    def close(self):
+        self.fp.close()
+
+
+backends = {
+    "rocksdb": RocksDBStore,
+    "sqlite": SQLiteStore,
+    "log": LogStore,
+}
+
+default_backend = "rocksdb" if rocksdb is not None else "sqlite"
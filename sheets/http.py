@@ -5,7 +5,9 @@ from webob.dec import wsgify
 from weakref import WeakValueDictionary
 import uuid
 import os
+import collections
 from urllib.parse import quote as url_quote
+from . import metrics
 
 base = os.path.dirname(os.path.abspath(__file__))
 html_path = os.path.abspath(os.path.join(base, '../frontend/public'))
@@ -13,8 +15,18 @@ html_path = os.path.abspath(os.path.join(base, '../frontend/public'))
 static_app = webob.static.DirectoryApp(html_path, cache_control="none")
 
 class HTTPObjects:
+    # Apps forwarded from the kernel are kept alive here, up to these limits
+    # (the oldest are dropped first):
+    max_forwarded = 500
+    max_forwarded_bytes = 100 * 1024 * 1024
+
     def __init__(self):
         self.refs = WeakValueDictionary()
+        # Apps registered from the kernel process, oldest first:
+        self.forwarded = collections.OrderedDict()
+        self.forwarded_bytes = 0
+        # Set in the kernel process to send apps to the server process:
+        self.forward = None
 
     def app(self, object_name):
         value = self.refs.get(object_name)
@@ -33,8 +45,24 @@ class HTTPObjects:
     def register(self, app):
         id = str(uuid.uuid1())
         self.refs[id] = app
+        if self.forward:
+            self.forward(id, app)
         return "/object?name=%s" % url_quote(id)
 
+    def register_forwarded(self, id, content_type, body):
+        app = self.explicit_app(content_type, body)
+        if id in self.forwarded:
+            self.forwarded_bytes -= len(self.forwarded.pop(id).body)
+        self.forwarded[id] = app
+        self.forwarded_bytes += len(body)
+        self.refs[id] = app
+        while self.forwarded and (
+                len(self.forwarded) > self.max_forwarded
+                or self.forwarded_bytes > self.max_forwarded_bytes):
+            old_id, old = self.forwarded.popitem(last=False)
+            self.forwarded_bytes -= len(old.body)
+            self.refs.pop(old_id, None)
+
 http_objects = HTTPObjects()
 
 @wsgify
@@ -45,6 +73,10 @@ def app(req):
     if req.path.startswith("/object"):
         object_name = req.params.get("name")
         return http_objects.app(object_name)
+    if req.path == "/metrics":
+        return webob.Response(
+            content_type="text/plain", charset="utf-8",
+            body=metrics.prometheus_text().encode("UTF-8"))
     return static_app(req)
 
 def start(port=10100):
@@ -6,9 +6,12 @@ is a module or modules that should be imported at the same time.
 """
 import sys
 import importlib
+import importlib.machinery
 
 watchers = {
     "keras": "sheets.support.keras",
+    "numpy": "sheets.support.numpy",
+    "pandas": "sheets.support.pandas",
     "PIL": "sheets.support.PIL",
     "matplotlib": ["sheets.support.matplotlib_nonframework", "sheets.support.matplotlib"]
 }
@@ -17,17 +20,32 @@ class WatchPaths:
 
     in_import = False
 
+    def __init__(self):
+        # Watched modules that are still being imported
+        self.loading = set()
+
     def find_spec(self, fullname, path, target=None):
         """Called when an import happens. Note this is only to watch imports,
         not to change what is imported"""
         if self.in_import:
             return None
+        if fullname in watchers and fullname not in sys.modules:
+            # The supporting modules can only be imported once this module
+            # has finished importing
+            spec = importlib.machinery.PathFinder.find_spec(fullname, path, target)
+            if spec is not None and spec.loader is not None:
+                spec.loader = SupportLoader(spec.loader, self, fullname)
+            return spec
+        self.import_support(fullname)
+        return None
+
+    def import_support(self, fullname):
         parts = fullname.split(".")
         module_parts = []
         for part in parts:
             module_parts.append(part)
             module = ".".join(module_parts)
-            if module not in watchers:
+            if module not in watchers or module in self.loading:
                 continue
             other_import = watchers[module]
             if isinstance(other_import, str):
@@ -41,7 +59,34 @@ class WatchPaths:
                     importlib.import_module(support_module)
                 finally:
                     self.in_import = False
-        return None
+
+class SupportLoader:
+    """Wraps the loader of a watched module, importing the supporting modules
+    after the module itself is imported"""
+
+    def __init__(self, loader, watch_paths, fullname):
+        self.loader = loader
+        self.watch_paths = watch_paths
+        self.fullname = fullname
+
+    def create_module(self, spec):
+        return self.loader.create_module(spec)
+
+    def exec_module(self, module):
+        self.watch_paths.loading.add(self.fullname)
+        try:
+            self.loader.exec_module(module)
+        finally:
+            self.watch_paths.loading.discard(self.fullname)
+        self.watch_paths.import_support(self.fullname)
+
+    def __getattr__(self, name):
+        return getattr(self.loader, name)
 
 def activate():
-    sys.meta_path.insert(0, WatchPaths())
+    watch_paths = WatchPaths()
+    sys.meta_path.insert(0, watch_paths)
+    # Modules imported before this won't be seen by find_spec:
+    for module in list(watchers):
+        if module in sys.modules:
+            watch_paths.import_support(module)
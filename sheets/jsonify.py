@@ -1,18 +1,22 @@
 import sys
 import ast
+import math
 import astor
 import time
 import types
+import weakref
+import uuid
 import builtins
 import inspect
+import itertools
+import threading
+import collections
 from functools import singledispatch
+from . import metrics
 
-builtins_set = set()
-for _name in dir(builtins):
-    try:
-        builtins_set.add(getattr(builtins, _name))
-    except TypeError:
-        pass
+# The ids of the builtins (which live as long as the process), so values are
+# compared by identity: by equality, 0 and 1 would be False and True:
+builtins_ids = set(id(getattr(builtins, _name)) for _name in dir(builtins))
 
 def jsonify_plain(o, show_repr=False):
     if show_repr:
@@ -28,17 +32,211 @@ def jsonify_plain(o, show_repr=False):
 
 jsonify_dispatched = singledispatch(jsonify_plain)
 
+# Limits on how much of a value is serialized at once; the rest can be
+# fetched later with an ExpandValue command:
+max_items = 100
+max_depth = 8
+max_str_length = 5000
+
+_local = threading.local()
+
+class ValueRegistry:
+    """Keeps track of values that were only partly serialized, so more of
+    them can be fetched.  Values are kept with weak references when possible,
+    but the common cases (list, dict, str, tuple) can't be weakly referenced,
+    so those are kept alive here.  Only the most recent ones are kept, up to
+    max_strong values and max_strong_bytes, measured with value_size (an
+    estimate that includes nested values).
+
+    Values registered for a global variable (as defines) are also forgotten
+    when the variable is rebound or deleted, so old values of a variable
+    don't stay alive"""
+
+    max_strong = 500
+    max_strong_bytes = 64 * 1024 * 1024
+
+    def __init__(self):
+        self.weak = weakref.WeakValueDictionary()
+        self.strong = collections.OrderedDict()
+        self.strong_bytes = 0
+        self.handles = {}
+        # Global name -> the handle of the value registered for it:
+        self.names = {}
+        self.counter = itertools.count()
+        # Each process (like each new kernel) has its own handles, so handles
+        # clients still have from an earlier one don't refer to new values:
+        self.prefix = "v-%s" % uuid.uuid4().hex[:8]
+
+    def register(self, o, name=None):
+        """Returns a handle for o.  If name is given, o is the value of that
+        global variable"""
+        handle = self.handles.get(id(o))
+        if handle is None or self.get(handle) is not o:
+            handle = self.add(o)
+        if name is not None:
+            if self.names.get(name) != handle:
+                self.forget_name(name)
+            self.names[name] = handle
+        return handle
+
+    def add(self, o):
+        handle = "%s-%s" % (self.prefix, next(self.counter))
+        try:
+            self.weak[handle] = o
+            weakref.finalize(o, self.handles.pop, id(o), None)
+        except TypeError:
+            # The size is kept, as the value may change later:
+            size = value_size(o) or 0
+            self.strong[handle] = (o, size)
+            self.strong_bytes += size
+            # The newest value is kept even if it is over the budget alone:
+            while len(self.strong) > 1 and (
+                    len(self.strong) > self.max_strong
+                    or self.strong_bytes > self.max_strong_bytes):
+                self.forget(next(iter(self.strong)))
+        self.handles[id(o)] = handle
+        return handle
+
+    def forget(self, handle):
+        o = self.weak.pop(handle, None)
+        if handle in self.strong:
+            o, size = self.strong.pop(handle)
+            self.strong_bytes -= size
+        if o is not None and self.handles.get(id(o)) == handle:
+            del self.handles[id(o)]
+
+    def forget_name(self, name):
+        """Forgets the value registered for a global variable, which was
+        rebound or deleted"""
+        handle = self.names.pop(name, None)
+        # Unless another variable has the same value:
+        if handle is not None and handle not in self.names.values():
+            self.forget(handle)
+
+    def get(self, handle):
+        o = self.weak.get(handle)
+        if o is None:
+            o = self.strong.get(handle, (None, 0))[0]
+        return o
+
+value_registry = ValueRegistry()
+
+def jsonify_deferred(o):
+    """A placeholder for a value that is too deeply nested to serialize now"""
+    return {
+        "type": "deferred",
+        "handle": value_registry.register(o),
+        "value_type": type(o).__name__,
+        "length": len(o),
+    }
+
+def too_deep():
+    return getattr(_local, "depth", 0) > max_depth
+
 def has_method(o, name):
     if not hasattr(o, name):
         return False
     value = getattr(o, name)
     return isinstance(value, types.MethodType)
 
+# Types that are serialized directly, without looking for _sheets_json_ or
+# dispatching (only exact types, not subclasses):
+primitive_types = {int, float, bool, type(None), bytes}
+
+# Lists and tuples of only one of these types are sent as a packed list of
+# values (the dtype is the type name):
+packed_types = {int: "int", float: "float", bool: "bool", type(None): "NoneType"}
+
+# Bigger integers can't be represented exactly in JavaScript:
+max_packed_int = 2 ** 53
+
+def jsonify_primitive(o, show_repr=False):
+    if type(o) is bytes and len(o) > max_str_length:
+        return jsonify_long_bytes(o)
+    if show_repr:
+        return {"type": "plain_repr", "repr": repr(o), "show_repr": True}
+    return {"type": "plain_str", "str": str(o), "show_repr": False}
+
+def packed_values(items):
+    """If all the items are of one packed type, returns (dtype, values),
+    otherwise None"""
+    if not items:
+        return None
+    t = type(items[0])
+    dtype = packed_types.get(t)
+    if dtype is None:
+        return None
+    for item in items:
+        if type(item) is not t:
+            return None
+    if t is int and (max(items) >= max_packed_int or min(items) <= -max_packed_int):
+        return None
+    if t is float and not all(map(math.isfinite, items)):
+        return None
+    return dtype, list(items)
+
+# Containers that are serialized only once per jsonify call; any other
+# occurrence (including a container inside itself) becomes a ref node:
+memo_types = (list, tuple, dict)
+
 def jsonify(o, show_repr=False):
+    if type(o) in primitive_types:
+        return jsonify_primitive(o, show_repr)
+    depth = getattr(_local, "depth", 0)
+    if not depth:
+        # Maps id(o) to a SeenValue
+        _local.seen = {}
+        start = time.perf_counter()
+    _local.depth = depth + 1
+    try:
+        if isinstance(o, memo_types) and o:
+            return jsonify_memo(o, show_repr)
+        return _jsonify(o, show_repr)
+    finally:
+        _local.depth = depth
+        if not depth:
+            del _local.seen
+            metrics.observe("jsonify", time.perf_counter() - start)
+
+def jsonify_memo(o, show_repr):
+    seen = _local.seen
+    entry = seen.get(id(o))
+    if entry is not None:
+        if entry.node is not None:
+            entry.node["ref_id"] = entry.ref_id
+        else:
+            # A cycle: o is still being serialized
+            entry.referenced = True
+        return {
+            "type": "ref",
+            "ref": entry.ref_id,
+            "value_type": type(o).__name__,
+        }
+    entry = seen[id(o)] = SeenValue(len(seen), o)
+    node = _jsonify(o, show_repr)
+    if entry.referenced:
+        node["ref_id"] = entry.ref_id
+    entry.node = node
+    return node
+
+class SeenValue:
+    """A container that has been (or is being) serialized in this jsonify
+    call.  The value is kept so its id can't be reused during the call"""
+
+    __slots__ = ("ref_id", "value", "node", "referenced")
+
+    def __init__(self, ref_id, value):
+        self.ref_id = ref_id
+        self.value = value
+        self.node = None
+        self.referenced = False
+
+def _jsonify(o, show_repr):
     if has_method(o, "_sheets_json_"):
         j = o._sheets_json_()
         return j
-    if has_method(o, "_repr_html_"):
+    # A specific jsonify registration is preferred over _repr_html_:
+    if has_method(o, "_repr_html_") and jsonify_dispatched.dispatch(type(o)) is jsonify_plain:
         h = o._repr_html_()
         if h is None:
             print("Warning: object %r._repr_html_() returned None")
@@ -91,35 +289,238 @@ def jsonify_class(x, show_repr=False):
         d["bases"] = [c.__name__ for c in x.__bases__]
     return d
 
-@jsonify.register((list, tuple))
+@jsonify.register(list)
+@jsonify.register(tuple)
 def jsonify_list_tuple(x, show_repr=False):
     if isinstance(x, list):
         json_type = "list"
     else:
         json_type = "tuple"
-    contents = [jsonify(child, show_repr=show_repr) for child in x]
-    return {
-        "type": json_type,
-        "contents": contents,
-    }
+    if x and too_deep():
+        return jsonify_deferred(x)
+    items = x[:max_items]
+    packed = packed_values(items)
+    if packed:
+        d = {
+            "type": json_type,
+            "dtype": packed[0],
+            "values": packed[1],
+        }
+    else:
+        d = {
+            "type": json_type,
+            "contents": [jsonify(child, show_repr=show_repr) for child in items],
+        }
+    if len(x) > max_items:
+        d["truncated"] = truncated(x, len(items))
+    return d
 
 @jsonify.register(dict)
 def jsonify_dict(x, show_repr=False):
+    if x and too_deep():
+        return jsonify_deferred(x)
     contents = []
-    for key, value in x.items():
+    for key, value in itertools.islice(x.items(), max_items):
         contents.append([jsonify(key, show_repr=True), jsonify(value, show_repr=show_repr)])
-    return {
+    d = {
         "type": "dict",
         "contents": contents,
     }
+    if len(x) > max_items:
+        d["truncated"] = truncated(x, len(contents))
+    return d
 
 @jsonify.register(str)
 def jsonify_str(x, show_repr=False):
+    d = {
+        "type": "str",
+        "str": str(x[:max_str_length]),
+    }
+    if len(x) > max_str_length:
+        d["truncated"] = truncated(x, max_str_length)
+    return d
+
+def jsonify_long_bytes(x):
+    # Shown like a truncated str; the rest comes in pages of escaped bytes
+    # (see jsonify_page_bytes), so the closing quote is left off
     return {
         "type": "str",
-        "str": str(x),
+        "str": repr(x[:max_str_length])[:-1],
+        "truncated": truncated(x, max_str_length),
     }
 
+def truncated(x, shown):
+    return {
+        "handle": value_registry.register(x),
+        "shown": shown,
+        "total": len(x),
+    }
+
+def jsonify_page(o, offset=None, count=None, column_offset=None):
+    """Serializes more of a value that was truncated or deferred.  If offset is
+    None the whole value is serialized (with the normal limits), otherwise the
+    items (or characters) from offset on.  For tables, column_offset selects a
+    page of columns instead of the ones shown at first"""
+    if column_offset is not None:
+        return jsonify_column_page(o, column_offset, offset, count)
+    if offset is None:
+        return {"type": "value", "value": jsonify(o)}
+    return jsonify_page_dispatched(o, offset, count)
+
+@singledispatch
+def jsonify_page_dispatched(o, offset, count):
+    count = count or max_items
+    items = o[offset:offset + count]
+    d = {
+        "type": "page",
+        "offset": offset,
+        "total": len(o),
+    }
+    packed = packed_values(items)
+    if packed:
+        d["dtype"], d["values"] = packed
+    else:
+        d["contents"] = [jsonify(child) for child in items]
+    return d
+
+jsonify_page.register = jsonify_page_dispatched.register
+
+@singledispatch
+def jsonify_column_page(o, column_offset, offset, count):
+    # Only tables (see the numpy and pandas support modules) have columns
+    return jsonify_page(o, offset, count)
+
+@jsonify_page.register(dict)
+def jsonify_page_dict(o, offset, count):
+    count = count or max_items
+    return {
+        "type": "page",
+        "contents": [
+            [jsonify(key, show_repr=True), jsonify(value)]
+            for key, value in itertools.islice(o.items(), offset, offset + count)],
+        "offset": offset,
+        "total": len(o),
+    }
+
+@jsonify_page.register(str)
+def jsonify_page_str(o, offset, count):
+    count = count or max_str_length
+    return {
+        "type": "str_page",
+        "str": str(o[offset:offset + count]),
+        "offset": offset,
+        "total": len(o),
+    }
+
+@jsonify_page.register(bytes)
+def jsonify_page_bytes(o, offset, count):
+    count = count or max_str_length
+    page = o[offset:offset + count]
+    return {
+        "type": "str_page",
+        "str": repr(page)[2:-1],
+        # The number of bytes (escaping makes str longer)
+        "length": len(page),
+        "offset": offset,
+        "total": len(o),
+    }
+
+# Values defined by a cell are only serialized in full right away if they are
+# small; anything else is summarized and serialized when a client asks for it
+# (with an ExpandValue command):
+summary_max_items = 10
+summary_max_str_length = 200
+# Containers bigger than this have their size estimated from a sample, which
+# is measured looking this many levels into nested containers:
+size_sample_items = 20
+size_max_depth = 3
+
+def is_small_scalar(o):
+    t = type(o)
+    if t is str or t is bytes:
+        return len(o) <= summary_max_str_length
+    return t in primitive_types
+
+def is_small(o):
+    # Strings are truncated by jsonify anyway:
+    if is_small_scalar(o) or type(o) is str:
+        return True
+    if isinstance(o, (types.FunctionType, types.BuiltinFunctionType, type)):
+        return True
+    t = type(o)
+    if t in (list, tuple, set, frozenset):
+        return len(o) <= summary_max_items and all(map(is_small_scalar, o))
+    if t is dict:
+        return len(o) <= summary_max_items and all(
+            is_small_scalar(key) and is_small_scalar(value) for key, value in o.items())
+    return False
+
+def value_length(o):
+    if not hasattr(type(o), "__len__"):
+        return None
+    try:
+        return len(o)
+    except Exception:
+        return None
+
+@singledispatch
+def value_size(o):
+    """An estimate of the memory used by o in bytes, or None"""
+    try:
+        return sys.getsizeof(o)
+    except Exception:
+        return None
+
+@value_size.register(list)
+@value_size.register(tuple)
+@value_size.register(set)
+@value_size.register(frozenset)
+def value_size_sequence(o):
+    size = sys.getsizeof(o)
+    if o:
+        sample = list(itertools.islice(o, size_sample_items))
+        size += sample_size(sample) * len(o) // len(sample)
+    return size
+
+@value_size.register(dict)
+def value_size_dict(o):
+    size = sys.getsizeof(o)
+    if o:
+        sample = list(itertools.islice(o.items(), size_sample_items))
+        size += sample_size([item for pair in sample for item in pair]) * len(o) // len(sample)
+    return size
+
+def sample_size(items):
+    """The total size of items, including what they contain, down to
+    size_max_depth levels of nesting"""
+    depth = getattr(_local, "size_depth", 0)
+    if depth >= size_max_depth:
+        return sum(map(sys.getsizeof, items))
+    _local.size_depth = depth + 1
+    try:
+        return sum(value_size(item) or 0 for item in items)
+    finally:
+        _local.size_depth = depth
+
+def jsonify_summary(o, name=None):
+    """Serializes a small value in full, or anything else as a deferred
+    placeholder with its type, length and estimated size.  name is the global
+    variable o is the value of, if any"""
+    if is_small(o):
+        return jsonify(o)
+    d = {
+        "type": "deferred",
+        "handle": value_registry.register(o, name=name),
+        "value_type": type(o).__name__,
+    }
+    length = value_length(o)
+    if length is not None:
+        d["length"] = length
+    size = value_size(o)
+    if size is not None:
+        d["size"] = size
+    return d
+
 @jsonify.register(ast.AST)
 def jsonify_ast(x, show_repr=False):
     return {
@@ -143,14 +544,70 @@ def jsonify_print(*objects, sep=' ', end='\n', file=sys.stdout, flush=False):
         d["parts"].append(jsonify(o))
     file.writejson(d)
 
+class ExprSite:
+    """Statistics of all the values of one expression: the count, the last
+    value, and the minimum and maximum of the values that were finite
+    numbers.  Once suppressed (after too many values were printed), values
+    are only added to the statistics"""
+
+    __slots__ = ("expr_string", "count", "last", "min", "max", "suppressed")
+
+    def __init__(self, expr_string):
+        self.expr_string = expr_string
+        self.count = 0
+        self.last = None
+        self.min = None
+        self.max = None
+        self.suppressed = False
+
+    @property
+    def json(self):
+        return {
+            "type": "expr_stats",
+            "expr_string": self.expr_string,
+            "count": self.count,
+            "min": json_stat(self.min),
+            "max": json_stat(self.max),
+            "last": jsonify(self.last),
+        }
+
+def json_stat(value):
+    # Like packed_values, ints JavaScript can't represent exactly are not
+    # sent as numbers
+    if type(value) is int and not -max_packed_int < value < max_packed_int:
+        return str(value)
+    return value
+
 def jsonify_print_expr(expr_string, expr_value, expr_id=None):
+    stdout = sys.stdout
+    if expr_id:
+        # This is run for every evaluation of the expression (like in a
+        # loop), so it is kept cheap once the expression is suppressed
+        site = stdout.expr_sites.get(expr_id)
+        if site is None:
+            site = stdout.expr_sites[expr_id] = ExprSite(expr_string)
+        site.count += 1
+        site.last = expr_value
+        t = type(expr_value)
+        # NaN would stop min and max from changing (every comparison with it
+        # is false), and infinities aren't useful bounds:
+        if t is int or (t is float and math.isfinite(expr_value)):
+            if site.min is None:
+                site.min = site.max = expr_value
+            elif expr_value < site.min:
+                site.min = expr_value
+            elif expr_value > site.max:
+                site.max = expr_value
+        if site.suppressed:
+            return expr_value
     if expr_value is None:
         # Don't print anything, just like the CLI
         return None
     if print_expr_should_ignore(expr_string, expr_value):
         return expr_value
-    stdout = sys.stdout
     if stdout.total_exprs_printed > stdout.total_exprs_limit or (expr_id and stdout.exprs_printed[expr_id] > stdout.expr_limit):
+        if expr_id:
+            site.suppressed = True
         return expr_value
     stdout.total_exprs_printed += 1
     if expr_id:
@@ -183,9 +640,6 @@ def print_expr_should_ignore(expr, value):
         prop_name = expr.split(".")[-1]
         if method_name == prop_name:
             return True
-    try:
-        if value in builtins_set:
-            return True
-    except TypeError:
-        pass
+    if id(value) in builtins_ids:
+        return True
     return False
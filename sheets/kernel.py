@@ -0,0 +1,191 @@
+"""
+Runs user code in a separate, persistent process (the kernel).
+
+The server process keeps a KernelEnvironment, which does analysis itself but
+forwards executions to the kernel over a pipe.  The kernel holds the real
+Environment (and so all the globals), and sends the resulting commands back,
+where they are routed just like commands from the browser.
+"""
+import os
+import atexit
+import signal
+import threading
+import traceback
+import multiprocessing
+from .env import Environment, Stdout, now
+from .datalayer import Execution, hydrate
+from .router import send
+from .http import http_objects
+from . import metrics
+
+
+class KernelEnvironment(Environment):
+
+    def __init__(self, path, bytecode_cache=False):
+        super().__init__(path, bytecode_cache=bytecode_cache)
+        self.process = None
+        self.conn = None
+        # Guards process, conn and pending, which the reader thread changes
+        # too:
+        self.lock = threading.RLock()
+        # Only one thread can write to the pipe at a time:
+        self.send_lock = threading.Lock()
+        # filename -> content, for executions the kernel hasn't finished:
+        self.pending = {}
+        self.closing = False
+        self.start()
+        atexit.register(self.close)
+
+    def start(self):
+        context = multiprocessing.get_context("spawn")
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=kernel_main, args=(child_conn, self.path, self.bytecode_cache), daemon=True)
+        self.process.start()
+        child_conn.close()
+        reader = threading.Thread(
+            target=self.read_results, args=(self.conn, self.process), daemon=True)
+        reader.start()
+        print("Started kernel process", self.process.pid)
+
+    def call(self, method, *args):
+        with self.lock:
+            conn, process = self.conn, self.process
+        try:
+            with self.send_lock:
+                conn.send((method, args))
+        except (OSError, ValueError):
+            print("Kernel connection lost, restarting")
+            self.restart(process)
+            with self.lock:
+                conn = self.conn
+            with self.send_lock:
+                conn.send((method, args))
+
+    def read_results(self, conn, process):
+        while True:
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                break
+            try:
+                if message[0] == "command":
+                    command = hydrate(message[1])
+                    if isinstance(command, Execution):
+                        with self.lock:
+                            self.pending.pop(command.filename, None)
+                    send(command)
+                elif message[0] == "http_object":
+                    http_objects.register_forwarded(*message[1:])
+                elif message[0] == "metrics":
+                    metrics.set_remote("kernel", *message[1:])
+                else:
+                    print("Unexpected message from kernel:", message[0])
+            except:
+                print("Error handling message from kernel:")
+                traceback.print_exc()
+        if process is self.process and not self.closing:
+            print("Kernel process died (exit code %s), restarting" % process.exitcode)
+            self.restart(process)
+
+    def execute(self, filename, content, subexpressions=False, use_cache=True, profile=False):
+        with self.lock:
+            self.pending[filename] = content
+        self.call("execute", filename, content, subexpressions, use_cache, profile)
+
+    def execute_stale(self, files, analyses=None):
+        self.call("execute_stale", files, self.cached_analysis())
+
+    def expand_value(self, handle, offset=None, count=None, reply_to=None, column_offset=None):
+        self.call("expand_value", handle, offset, count, reply_to, column_offset)
+
+    def forget_file(self, filename):
+        super().forget_file(filename)
+        self.call("forget_file", filename)
+
+    def interrupt(self):
+        if self.process and self.process.is_alive():
+            os.kill(self.process.pid, signal.SIGINT)
+
+    def close(self):
+        self.closing = True
+        self.conn.close()
+
+    def restart(self, process=None):
+        """Replaces the kernel process.  If process is given, only if it is
+        still the current one, so that the reader thread and call() noticing
+        the same failure only restart it once"""
+        with self.lock:
+            if process is not None and process is not self.process:
+                return
+            old_process, old_conn = self.process, self.conn
+            self.start()
+            if old_process.is_alive():
+                old_process.terminate()
+            old_conn.close()
+            pending, self.pending = self.pending, {}
+        for filename, content in pending.items():
+            send(failed_execution(filename, content, "Kernel restarted before execution finished\n"))
+
+
+class PipeRouter:
+    """Used in place of a Router in the kernel process"""
+
+    def __init__(self, conn):
+        self.conn = conn
+        # Output can be sent from a timer thread while code runs:
+        self.lock = threading.Lock()
+
+    def send(self, command):
+        with self.lock:
+            self.conn.send(("command", command.asJson))
+
+    def forward_http_object(self, id, app):
+        with self.lock:
+            self.conn.send(("http_object", id, app.content_type, app.body))
+
+    def send_metrics(self):
+        with self.lock:
+            self.conn.send(("metrics",) + metrics.state())
+
+
+def failed_execution(filename, content, message):
+    stdout = Stdout()
+    stdout.write(message)
+    t = now()
+    return Execution(
+        filename=filename,
+        content=content,
+        emitted=stdout.emitted,
+        defines={},
+        start_time=t,
+        end_time=t,
+        exec_time=0,
+    )
+
+
+def kernel_main(conn, path, bytecode_cache=False):
+    from . import router
+    from . import importwatch
+    importwatch.activate()
+    pipe_router = PipeRouter(conn)
+    router.a_router = pipe_router
+    http_objects.forward = pipe_router.forward_http_object
+    env = Environment(path, bytecode_cache=bytecode_cache)
+    env.flush_output_in_background = True
+    while True:
+        try:
+            method, args = conn.recv()
+        except KeyboardInterrupt:
+            # An interrupt that came in between executions
+            continue
+        except EOFError:
+            break
+        try:
+            getattr(env, method)(*args)
+        except (Exception, KeyboardInterrupt):
+            traceback.print_exc()
+            if method == "execute":
+                pipe_router.send(failed_execution(
+                    args[0], args[1], traceback.format_exc()))
+        pipe_router.send_metrics()
@@ -0,0 +1,182 @@
+"""
+Counters, timers and gauges for the server itself, exposed at /metrics (in
+Prometheus text format) and sent to clients in ServerStats commands.
+
+Usage:
+
+    from . import metrics
+    metrics.incr("history_bytes", len(data))
+    with metrics.timed("history_save"):
+        ...
+    metrics.gauge("sockets", lambda: len(sockets))
+
+Names can have labels, like metrics.timed("task", kind="analyze").
+"""
+import time
+import threading
+import traceback
+import contextlib
+
+prefix = "sheets_"
+# ServerStats commands are sent this often (in seconds), while clients are
+# connected:
+report_interval = 10
+
+_lock = threading.Lock()
+# (name, labels) -> count
+counters = {}
+# (name, labels) -> [count, total seconds, max seconds]
+timers = {}
+# name -> function returning a number
+gauges = {}
+# source -> (counters, timers) from another process (the kernel)
+remote = {}
+
+
+def metric_key(name, labels):
+    return (name, tuple(sorted(labels.items())))
+
+
+def incr(name, amount=1, **labels):
+    key = metric_key(name, labels)
+    with _lock:
+        counters[key] = counters.get(key, 0) + amount
+
+
+def observe(name, seconds, **labels):
+    key = metric_key(name, labels)
+    with _lock:
+        timer = timers.get(key)
+        if timer is None:
+            timer = timers[key] = [0, 0.0, 0.0]
+        timer[0] += 1
+        timer[1] += seconds
+        if seconds > timer[2]:
+            timer[2] = seconds
+
+
+@contextlib.contextmanager
+def timed(name, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def state():
+    """Copies of the counters and timers, to send to another process"""
+    with _lock:
+        return dict(counters), dict((key, list(value)) for key, value in timers.items())
+
+
+def set_remote(source, remote_counters, remote_timers):
+    with _lock:
+        remote[source] = (remote_counters, remote_timers)
+
+
+def all_metrics():
+    """The counters and timers of this and other processes, with a process
+    label added to the ones from other processes"""
+    with _lock:
+        all_counters = dict(counters)
+        all_timers = dict((key, list(value)) for key, value in timers.items())
+        for source, (remote_counters, remote_timers) in remote.items():
+            for (name, labels), value in remote_counters.items():
+                all_counters[(name, tuple(sorted(labels + (("process", source),))))] = value
+            for (name, labels), value in remote_timers.items():
+                all_timers[(name, tuple(sorted(labels + (("process", source),))))] = value
+    return all_counters, all_timers
+
+
+def gauge(name, func):
+    gauges[name] = func
+
+
+def gauge_values():
+    values = {}
+    for name, func in list(gauges.items()):
+        try:
+            values[name] = func()
+        except Exception:
+            print("Error getting gauge", name)
+            traceback.print_exc()
+    return values
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join(
+        '%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in labels)
+
+
+def prometheus_text():
+    """All the metrics, in the Prometheus text exposition format"""
+    lines = []
+    all_counters, all_timers = all_metrics()
+    counter_items = sorted(all_counters.items())
+    timer_items = sorted(all_timers.items())
+    seen = set()
+    for (name, labels), value in counter_items:
+        if name not in seen:
+            lines.append("# TYPE %s%s_total counter" % (prefix, name))
+            seen.add(name)
+        lines.append("%s%s_total%s %s" % (prefix, name, format_labels(labels), value))
+    for (name, labels), (count, total, max_seconds) in timer_items:
+        if name not in seen:
+            lines.append("# TYPE %s%s_seconds summary" % (prefix, name))
+            seen.add(name)
+        lines.append("%s%s_seconds_count%s %s" % (prefix, name, format_labels(labels), count))
+        lines.append("%s%s_seconds_sum%s %r" % (prefix, name, format_labels(labels), total))
+    # Maximums are a separate gauge, as summaries can't include them:
+    seen = set()
+    for (name, labels), (count, total, max_seconds) in timer_items:
+        if name not in seen:
+            lines.append("# TYPE %s%s_seconds_max gauge" % (prefix, name))
+            seen.add(name)
+        lines.append("%s%s_seconds_max%s %r" % (prefix, name, format_labels(labels), max_seconds))
+    for name, value in sorted(gauge_values().items()):
+        lines.append("# TYPE %s%s gauge" % (prefix, name))
+        lines.append("%s%s %s" % (prefix, name, value))
+    return "\n".join(lines) + "\n"
+
+
+def json_key(name, labels):
+    return name + "".join(".%s" % value for _, value in labels)
+
+
+def snapshot():
+    """All the metrics as JSON-able data, with labels folded into the names
+    (like task.analyze)"""
+    all_counters, all_timers = all_metrics()
+    result = {
+        "counters": dict(
+            (json_key(name, labels), value)
+            for (name, labels), value in all_counters.items()),
+        "timers": dict(
+            (json_key(name, labels), {
+                "count": count,
+                "total": round(total, 6),
+                "max": round(max_seconds, 6),
+            })
+            for (name, labels), (count, total, max_seconds) in all_timers.items()),
+        "gauges": gauge_values(),
+    }
+    return result
+
+
+def start_reporting(send_stats):
+    """Calls send_stats every report_interval seconds, from a daemon thread"""
+    def run():
+        while True:
+            time.sleep(report_interval)
+            try:
+                send_stats()
+            except Exception:
+                print("Error sending server stats")
+                traceback.print_exc()
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
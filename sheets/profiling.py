@@ -0,0 +1,107 @@
+"""
+Line-level profiling of cell executions.
+
+Only frames running code from the cell itself are traced; code in other
+modules runs untraced, and its time and memory are counted against the cell
+line that called it.
+"""
+import sys
+import time
+import tracemalloc
+
+
+# Code objects that are counted as part of the line that runs them:
+inline_code_names = {"<listcomp>", "<dictcomp>", "<setcomp>", "<genexpr>", "<lambda>"}
+
+
+class LineState:
+
+    __slots__ = ("lineno", "start_time", "start_memory", "peak_memory")
+
+    def __init__(self):
+        self.lineno = None
+
+
+class LineProfiler:
+    """Counts hits, time and peak memory allocated for each line of the code
+    from filename run while the profiler is active (as a context manager)"""
+
+    def __init__(self, filename, trace_memory=True):
+        self.filename = filename
+        self.trace_memory = trace_memory
+        # lineno -> [hits, seconds, peak bytes allocated]
+        self.lines = {}
+        # The lines currently being run, innermost last:
+        self.active = []
+        self.total_time = 0
+
+    def __enter__(self):
+        self.started_tracemalloc = False
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracemalloc = True
+        self.old_trace = sys.gettrace()
+        self.start = time.perf_counter()
+        sys.settrace(self.trace_call)
+        return self
+
+    def __exit__(self, *exc_info):
+        sys.settrace(self.old_trace)
+        self.total_time = time.perf_counter() - self.start
+        if self.started_tracemalloc:
+            tracemalloc.stop()
+        return False
+
+    def memory(self):
+        """Returns the memory currently allocated, after resetting the peak.
+        The peak so far is first recorded for all the lines still running"""
+        current, peak = tracemalloc.get_traced_memory()
+        for state in self.active:
+            if peak > state.peak_memory:
+                state.peak_memory = peak
+        tracemalloc.reset_peak()
+        return current
+
+    def trace_call(self, frame, event, arg):
+        code = frame.f_code
+        if code.co_filename != self.filename or code.co_name in inline_code_names:
+            return None
+        state = LineState()
+
+        def trace_line(frame, event, arg):
+            now = time.perf_counter()
+            if state.lineno is not None:
+                self.finish_line(state, now)
+            if event == "line":
+                state.lineno = frame.f_lineno
+                state.start_time = now
+                if self.trace_memory:
+                    state.start_memory = state.peak_memory = self.memory()
+                self.active.append(state)
+            return trace_line
+
+        return trace_line
+
+    def finish_line(self, state, now):
+        self.active.pop()
+        line = self.lines.get(state.lineno)
+        if line is None:
+            line = self.lines[state.lineno] = [0, 0.0, 0]
+        line[0] += 1
+        line[1] += now - state.start_time
+        if self.trace_memory:
+            peak = max(state.peak_memory, tracemalloc.get_traced_memory()[1])
+            line[2] = max(line[2], peak - state.start_memory)
+        state.lineno = None
+
+    @property
+    def json(self):
+        return {
+            # Each line is [lineno, hits, milliseconds, peak bytes allocated]
+            "lines": [
+                [lineno, hits, round(seconds * 1000, 3), peak]
+                for lineno, (hits, seconds, peak) in sorted(self.lines.items())],
+            "total_time": round(self.total_time * 1000, 3),
+            "peak_memory": max([line[2] for line in self.lines.values()] or [0]),
+            "memory_traced": self.trace_memory,
+        }
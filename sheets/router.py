@@ -1,37 +1,93 @@
+import threading
 from . import datalayer
 from . import server
+from . import metrics
 
 a_router = None
 
 class Router:
 
-    def __init__(self, *, env, model):
+    def __init__(self, *, env, model, poll_files=False):
         self.env = env
         self.model = model
+        self.poll_files = poll_files
+        # Commands come from the websocket server and the kernel (if any):
+        self.lock = threading.RLock()
 
     def send(self, command):
         assert isinstance(command, datalayer.Command)
-        self.model.apply_command(command)
-        j = command.asJson
-        server.send(j)
-        self.model.run_tasks()
+        if getattr(command, "reply_to", None) is not None:
+            self.reply(command)
+            return
+        with self.lock:
+            try:
+                self.apply_command(command)
+            except datalayer.PatchConflict as e:
+                print("Rejected patch:", e)
+                self.resync_file(command.filename)
+                return
+            j = command.asJson
+            server.send(j)
+            self.model.run_tasks()
 
-    def incoming(self, data):
+    def apply_command(self, command):
+        name = command.__class__.__name__
+        metrics.incr("commands", command=name)
+        with metrics.timed("apply_command", command=name):
+            self.model.apply_command(command)
+        if isinstance(command, datalayer.Execution) and not command.cached:
+            # Time spent running user code
+            metrics.observe("execution", command.exec_time / 1000)
+
+    def reply(self, command):
+        """Sends a command only to the socket it answers, if it is still
+        connected.  Replies aren't applied to the model"""
+        socket = server.socket_by_id(command.reply_to)
+        if socket is not None:
+            server.send_to(socket, command.asJson)
+
+    def incoming(self, data, socket=None):
         command = datalayer.hydrate(data)
-        self.model.apply_command(command)
-        self.model.run_tasks()
+        if socket is not None and hasattr(command, "reply_to"):
+            command.reply_to = socket.socket_id
+        with self.lock:
+            try:
+                self.apply_command(command)
+            except datalayer.PatchConflict as e:
+                print("Rejected patch:", e)
+                self.resync_file(command.filename)
+                return
+            self.model.run_tasks()
+
+    def resync_file(self, filename):
+        """Sends clients the current content of a file, without changing it"""
+        f = self.model.files.get(filename)
+        if f is None:
+            server.send(datalayer.FileDelete(filename=filename, external_edit=True).asJson)
+            return
+        server.send(datalayer.FileEdit(
+            filename=filename, content=f.get("content") or "",
+            external_edit=True, version=f.get("version", 0)).asJson)
+
+    def on_open(self, socket):
+        with self.lock:
+            server.send_to(socket, self.model.snapshot().asJson)
 
-    def on_open(self):
-        self.model.on_open(self)
-        self.model.run_tasks()
+    def send_stats(self):
+        if server.sockets:
+            server.send(datalayer.ServerStats(stats=metrics.snapshot()).asJson)
 
     def register(self):
         global a_router
         a_router = self
+        with self.lock:
+            self.model.load(self)
         server.listen(self.incoming)
         server.listen_open(self.on_open)
+        metrics.gauge("tasks_pending", lambda: len(self.model.tasks))
+        metrics.start_reporting(self.send_stats)
         from . import filewatch
-        filewatch.watch(self.env, self.model)
+        filewatch.watch(self.env, self.model, polling=self.poll_files)
 
 def send(command):
     print("Sending:", command)
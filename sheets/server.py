@@ -1,18 +1,117 @@
 import json
+import threading
+import itertools
 import traceback
+import collections
+from urllib.parse import parse_qs
 from wsgiref.simple_server import make_server
 from ws4py.websocket import WebSocket
 from ws4py.server.wsgirefserver import WSGIServer, WebSocketWSGIRequestHandler
 from ws4py.server.wsgiutils import WebSocketWSGIApplication
+from . import encoding
+from . import metrics
 
 sockets = []
+socket_ids = itertools.count()
 listeners = []
 listeners_open = []
 
+# Commands where only the newest unsent message per file (and loop) matters:
+coalesce_commands = set(["Analysis", "ExecutionProgress"])
+
 def send(message):
-    data = json.dumps(message)
-    for socket in sockets:
-        socket.send(data)
+    # Each encoding in use is only done once:
+    encoded = {}
+    key = None
+    if message.get("command") in coalesce_commands:
+        key = (message["command"], message.get("filename"), message.get("loop_id"))
+    metrics.incr("ws_messages")
+    with metrics.timed("ws_send"):
+        for socket in list(sockets):
+            if socket.encoding not in encoded:
+                encoded[socket.encoding] = encoding.encode(message, socket.encoding)
+                metrics.incr("ws_bytes", len(encoded[socket.encoding]), encoding=socket.encoding)
+            socket.send_queue.put(encoded[socket.encoding], key)
+
+def send_to(socket, message):
+    socket.send_queue.put(encoding.encode(message, socket.encoding))
+
+def socket_by_id(socket_id):
+    for socket in list(sockets):
+        if socket.socket_id == socket_id:
+            return socket
+    return None
+
+def queue_depths():
+    return [len(socket.send_queue) for socket in list(sockets)]
+
+metrics.gauge("ws_sockets", lambda: len(sockets))
+metrics.gauge("ws_queued", lambda: sum(queue_depths()))
+metrics.gauge("ws_max_queue_depth", lambda: max(queue_depths() or [0]))
+
+class SendQueue:
+    """Messages waiting to be sent to one websocket, which are sent from their
+    own thread so a slow client doesn't hold up anything else.  If the client
+    falls too far behind it is disconnected, and will resync when it
+    reconnects"""
+
+    max_size = 10000
+
+    def __init__(self, socket):
+        self.socket = socket
+        self.messages = collections.OrderedDict()
+        self.condition = threading.Condition()
+        self.counter = itertools.count()
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def __len__(self):
+        return len(self.messages)
+
+    def put(self, data, key=None):
+        with self.condition:
+            if self.closed:
+                return
+            if key is None:
+                key = next(self.counter)
+            elif key in self.messages:
+                # Replace the old message, but send it in the new position
+                del self.messages[key]
+                metrics.incr("ws_coalesced")
+            if len(self.messages) >= self.max_size:
+                print("Client %s fell too far behind, disconnecting" % (self.socket.peer_address,))
+                metrics.incr("ws_dropped_clients")
+                self.closed = True
+                self.messages.clear()
+                self.condition.notify()
+                threading.Thread(target=self.socket.close, args=(1011, "Too far behind")).start()
+                return
+            self.messages[key] = data
+            self.condition.notify()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.messages.clear()
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.messages and not self.closed:
+                    self.condition.wait()
+                if self.closed:
+                    return
+                key, data = self.messages.popitem(last=False)
+            try:
+                self.socket.send(data, binary=isinstance(data, bytes))
+            except:
+                print("Error sending to", self.socket)
+                traceback.print_exc()
+                self.close()
+                return
+            metrics.incr("ws_sent")
 
 def listen(callback):
     listeners.append(callback)
@@ -23,17 +122,26 @@ def listen_open(callback):
 class WebSocketHandler(WebSocket):
 
     def opened(self):
+        # The client can ask for ws://host/?encoding=msgpack
+        query = parse_qs((self.environ or {}).get("QUERY_STRING", ""))
+        self.encoding = "json"
+        if query.get("encoding") == ["msgpack"] and encoding.msgpack is not None:
+            self.encoding = "msgpack"
+        self.send_queue = SendQueue(self)
+        self.socket_id = "s-%s" % next(socket_ids)
         sockets.append(self)
         for listener_open in listeners_open:
             try:
-                listener_open()
+                listener_open(self)
             except:
                 print("Error in listener_open", listener_open)
                 traceback.print_exc()
                 continue
 
     def closed(self, code, reason=None):
-        sockets.remove(self)
+        self.send_queue.close()
+        if self in sockets:
+            sockets.remove(self)
 
     def received_message(self, message):
         try:
@@ -43,7 +151,7 @@ class WebSocketHandler(WebSocket):
             raise
         for listener in listeners:
             try:
-                listener(data)
+                listener(data, self)
             except:
                 print("Error in", listener, ":")
                 traceback.print_exc()
@@ -14,7 +14,7 @@ import re
 import json
 from .jsonify import jsonify
 from functools import singledispatch
-from collections import MutableMapping
+from collections.abc import MutableMapping
 from .watcher import watch
 
 builtin_names = ["listdir", "save", "cv_image", "watch"]
@@ -0,0 +1,155 @@
+import math
+import numpy
+from ..jsonify import jsonify, jsonify_page, jsonify_column_page, value_registry, value_size
+
+# Rows shown at the start and end of an array:
+head_rows = 5
+tail_rows = 5
+# Rows in each page fetched with ExpandValue:
+page_rows = 50
+# Columns shown at the start and end of a wide table, and in each page of
+# columns fetched with ExpandValue:
+edge_columns = 10
+page_columns = 20
+# Statistics for arrays bigger than this are computed from a strided sample:
+stats_max_size = 10 ** 7
+
+
+def format_cell(value):
+    if isinstance(value, float):
+        if math.isnan(value) or math.isinf(value):
+            return str(value)
+        return repr(value)
+    if isinstance(value, (list, tuple)):
+        return repr(value)
+    return str(value)
+
+
+def column_windows(count, column_offset=None):
+    """The [start, stop) ranges of the columns shown of a table with count
+    columns: the page_columns from column_offset on, or else all of them if
+    there are few enough, or else the first and last edge_columns"""
+    if column_offset is not None:
+        return [[column_offset, min(count, column_offset + page_columns)]]
+    if count > 2 * edge_columns:
+        return [[0, edge_columns], [count - edge_columns, count]]
+    return [[0, count]]
+
+
+def column_indexes(windows):
+    return [i for start, stop in windows for i in range(start, stop)]
+
+
+def table_rows(array, windows=None):
+    """Formats the rows of a 1 or 2 dimensional array (or slice) as lists of
+    strings, with only the columns in windows if given"""
+    if array.ndim == 1:
+        return [[format_cell(v)] for v in array.tolist()]
+    if windows is not None:
+        array = array[:, column_indexes(windows)]
+    return [[format_cell(v) for v in row] for row in array.tolist()]
+
+
+def table_edges(x, windows=None):
+    """The head and tail rows of an array, or all of them if there are few"""
+    rows = x.shape[0]
+    if rows > head_rows + tail_rows:
+        return {
+            "head": table_rows(x[:head_rows], windows),
+            "tail": table_rows(x[-tail_rows:], windows),
+            "tail_offset": rows - tail_rows,
+        }
+    return {"head": table_rows(x, windows)}
+
+
+def json_number(value):
+    value = float(value)
+    if math.isnan(value) or math.isinf(value):
+        return str(value)
+    return value
+
+
+def array_stats(x):
+    if x.dtype.kind not in "biuf" or not x.size:
+        return None
+    stats = {}
+    if x.size > stats_max_size:
+        step = x.size // stats_max_size + 1
+        x = x.reshape(-1)[::step]
+        stats["sampled"] = True
+    if x.dtype.kind == "f":
+        nans = numpy.isnan(x)
+        nan_count = int(nans.sum())
+        stats["nan_count"] = nan_count
+        if nan_count == x.size:
+            return stats
+        x = x[~nans] if nan_count else x
+    stats["min"] = json_number(x.min())
+    stats["max"] = json_number(x.max())
+    stats["mean"] = json_number(x.mean())
+    return stats
+
+
+@jsonify.register(numpy.ndarray)
+def jsonify_ndarray(x, show_repr=False):
+    d = {
+        "type": "ndarray",
+        "shape": list(x.shape),
+        "dtype": str(x.dtype),
+        "size": int(x.size),
+        "stats": array_stats(x),
+    }
+    if x.ndim in (1, 2):
+        windows = None
+        if x.ndim == 2:
+            windows = column_windows(x.shape[1])
+            if len(windows) > 1:
+                d["column_count"] = x.shape[1]
+                d["column_windows"] = windows
+        d.update(table_edges(x, windows))
+        d["rows"] = x.shape[0]
+        d["handle"] = value_registry.register(x)
+    else:
+        # numpy summarizes large arrays itself, only formatting the edges
+        d["preview"] = numpy.array2string(x, threshold=100, edgeitems=2)
+    return d
+
+
+@jsonify.register(numpy.generic)
+def jsonify_numpy_scalar(x, show_repr=False):
+    return jsonify(x.item(), show_repr=show_repr)
+
+
+@jsonify_page.register(numpy.ndarray)
+def jsonify_page_ndarray(x, offset, count, windows=None):
+    count = count or page_rows
+    if windows is None and x.ndim == 2:
+        windows = column_windows(x.shape[1])
+    return {
+        "type": "table_page",
+        "rows": table_rows(x[offset:offset + count], windows),
+        "offset": offset,
+        "total": x.shape[0],
+    }
+
+
+@jsonify_column_page.register(numpy.ndarray)
+def jsonify_column_page_ndarray(x, column_offset, offset, count):
+    """The head and tail rows (if offset is None) or a page of rows, with only
+    the page of columns from column_offset on"""
+    if x.ndim != 2:
+        return jsonify_page(x, offset, count)
+    windows = column_windows(x.shape[1], column_offset)
+    if offset is None:
+        d = {"type": "table_columns", "total": x.shape[0]}
+        d.update(table_edges(x, windows))
+    else:
+        d = jsonify_page_ndarray(x, offset, count, windows)
+    d["column_count"] = x.shape[1]
+    d["column_windows"] = windows
+    return d
+
+
+@value_size.register(numpy.ndarray)
+def value_size_ndarray(x):
+    return int(x.nbytes)
@@ -0,0 +1,135 @@
+import numpy
+import pandas
+from ..jsonify import jsonify, jsonify_page, jsonify_column_page, value_registry, value_size
+from .numpy import (
+    format_cell, json_number, column_windows, column_indexes, head_rows, tail_rows, page_rows,
+    edge_columns, stats_max_size)
+
+
+def frame_rows(df):
+    """Formats the rows of a (small) DataFrame as lists of strings, with the
+    index first"""
+    return [
+        [format_cell(index)] + [format_cell(v) for v in row]
+        for index, row in zip(df.index.tolist(), df.itertuples(index=False, name=None))]
+
+
+def column_stats(df):
+    """Null counts for every column, and min/max/mean for numeric columns, each
+    computed with one vectorized pass per statistic.  Like array_stats, frames
+    with more than stats_max_size cells use a strided sample of the rows, and
+    the stats are marked as sampled"""
+    sampled = df.size > stats_max_size
+    if sampled:
+        df = df.iloc[::df.size // stats_max_size + 1]
+    stats = dict((str(name), {"nan_count": int(count)}) for name, count in df.isna().sum().items())
+    if sampled:
+        for entry in stats.values():
+            entry["sampled"] = True
+    numeric = df.select_dtypes(include="number")
+    if len(numeric.columns) and len(numeric):
+        for stat_name, values in (
+                ("min", numeric.min()), ("max", numeric.max()), ("mean", numeric.mean())):
+            for name, value in values.items():
+                # Nullable columns with no values give pandas.NA
+                if not pandas.isna(value):
+                    stats[str(name)][stat_name] = json_number(value)
+    return stats
+
+
+def frame_columns(df, windows):
+    """The frame with only the columns in windows, and its column labels and
+    dtypes"""
+    if len(windows) > 1 or windows[0] != [0, df.shape[1]]:
+        df = df.iloc[:, column_indexes(windows)]
+    return df, {
+        "columns": [str(c) for c in df.columns],
+        "dtypes": [str(t) for t in df.dtypes],
+    }
+
+
+def frame_edges(df):
+    """The head and tail rows of a frame, or all of them if there are few"""
+    rows = len(df)
+    if rows > head_rows + tail_rows:
+        return {
+            "head": frame_rows(df.iloc[:head_rows]),
+            "tail": frame_rows(df.iloc[-tail_rows:]),
+            "tail_offset": rows - tail_rows,
+        }
+    return {"head": frame_rows(df)}
+
+
+def jsonify_frame(df, json_type, value):
+    windows = column_windows(df.shape[1])
+    shown, d = frame_columns(df, windows)
+    d.update({
+        "type": json_type,
+        "shape": list(df.shape),
+        "stats": column_stats(shown),
+        "rows": len(df),
+        "handle": value_registry.register(value),
+    })
+    if len(windows) > 1:
+        d["column_count"] = df.shape[1]
+        d["column_windows"] = windows
+    d.update(frame_edges(shown))
+    return d
+
+
+@jsonify.register(pandas.DataFrame)
+def jsonify_dataframe(df, show_repr=False):
+    return jsonify_frame(df, "DataFrame", df)
+
+
+@jsonify.register(pandas.Series)
+def jsonify_series(series, show_repr=False):
+    return jsonify_frame(series.to_frame(), "Series", series)
+
+
+@jsonify_page.register(pandas.DataFrame)
+@jsonify_page.register(pandas.Series)
+def jsonify_page_frame(df, offset, count, windows=None):
+    count = count or page_rows
+    page = df.iloc[offset:offset + count]
+    if isinstance(page, pandas.Series):
+        page = page.to_frame()
+    page, _ = frame_columns(page, windows or column_windows(page.shape[1]))
+    return {
+        "type": "table_page",
+        "rows": frame_rows(page),
+        "offset": offset,
+        "total": len(df),
+    }
+
+
+@jsonify_column_page.register(pandas.DataFrame)
+@jsonify_column_page.register(pandas.Series)
+def jsonify_column_page_frame(df, column_offset, offset, count):
+    """Like jsonify_column_page_ndarray, with the labels and dtypes of the
+    columns in the page"""
+    if isinstance(df, pandas.Series):
+        df = df.to_frame()
+    windows = column_windows(df.shape[1], column_offset)
+    if offset is None:
+        shown, d = frame_columns(df, windows)
+        d["type"] = "table_columns"
+        d["total"] = len(df)
+        d.update(frame_edges(shown))
+    else:
+        d = jsonify_page_frame(df, offset, count, windows)
+    d["column_count"] = df.shape[1]
+    d["column_windows"] = windows
+    return d
+
+
+@value_size.register(pandas.DataFrame)
+@value_size.register(pandas.Series)
+def value_size_frame(df):
+    if df.ndim == 2 and df.shape[1] > 2 * edge_columns:
+        # memory_usage makes a Series for every column, so wide frames are
+        # estimated from their dtypes instead
+        item_bytes = sum(getattr(t, "itemsize", 8) for t in df.dtypes)
+        return int(df.index.memory_usage() + len(df) * item_bytes)
+    # deep=True would look at every object in object columns
+    return int(numpy.sum(df.memory_usage(index=True, deep=False)))
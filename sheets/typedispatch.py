@@ -13,17 +13,25 @@ def handle_ob(ob):
     return repr(ob)
 
 print(some_dispatch.funcs_for_type(type(2)))
-# ==> [<function handle_int>, <function handle_ob>]
+# ==> (<function handle_int>, <function handle_ob>)
 print(some_dispatch.collect(2))
 # ==> ['4', '2']
+
+Functions are returned most specific type first (in the order of the type's
+MRO), and in registration order for the same type.  Results are cached per
+type until another function is registered, and returned as tuples so the
+cache can't be changed by callers.
 """
+import weakref
+
 
 class TypeDispatcher:
 
     def __init__(self, default=None):
         self.registered = []
+        self.cache = weakref.WeakKeyDictionary()
         if default is not None:
-            self.registered.append(object, default)
+            self.registered.append((object, default))
 
     def __call__(self, types):
         def decorator(func):
@@ -36,16 +44,28 @@ class TypeDispatcher:
             types = (types,)
         for t in types:
             self.registered.append((t, func))
+        self.cache.clear()
 
     def funcs_for_type(self, t):
+        try:
+            return self.cache[t]
+        except KeyError:
+            pass
+        funcs = self.cache[t] = self.resolve(t)
+        return funcs
+
+    def resolve(self, t):
+        mro = t.__mro__
+        positions = dict((base, index) for index, base in enumerate(mro))
+        # Types that match without being in the MRO (abstract base classes)
+        # go just before object:
+        virtual_position = len(mro) - 1.5
         options = [
-            (f, f_type) for f_type, f in self.registered
+            (positions.get(f_type, virtual_position), index, f)
+            for index, (f_type, f) in enumerate(self.registered)
             if issubclass(t, f_type)]
-        options_ranked = [
-            (len([f_type for sub_f, f_type in options if issubclass(main_type, f_type)]), f)
-            for f, main_type in options]
-        options_ranked.sort(key=lambda x: -x[0])
-        return [f for c, f in options_ranked]
+        options.sort(key=lambda x: x[:2])
+        return tuple(f for position, index, f in options)
 
     def collect(self, ob, *args, **kw):
         return [f(ob, *args, **kw) for f in self.funcs_for_type(type(ob))]
@@ -5,34 +5,683 @@
 
 import pytest
 
-from click.testing import CliRunner
+from sheets import env as env_module
+from sheets import router
 
-from sheets import sheets
-from sheets import cli
+
+class RecordingRouter:
+    """Stands in for the router, keeping the commands sent"""
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, command):
+        self.sent.append(command)
+
+    def executions(self, filename=None):
+        return [
+            c for c in self.sent
+            if type(c).__name__ == "Execution" and (filename is None or c.filename == filename)]
+
+
+@pytest.fixture
+def sent(monkeypatch):
+    recording = RecordingRouter()
+    monkeypatch.setattr(router, "a_router", recording)
+    return recording
 
 
 @pytest.fixture
-def response():
-    """Sample pytest fixture.
-
-    See more at: http://doc.pytest.org/en/latest/fixture.html
-    """
-    # import requests
-    # return requests.get('https://github.com/audreyr/cookiecutter-pypackage')
-
-
-def test_content(response):
-    """Sample pytest test function with the pytest fixture as an argument."""
-    # from bs4 import BeautifulSoup
-    # assert 'GitHub' in BeautifulSoup(response.content).title.string
-
-
-def test_command_line_interface():
-    """Test the CLI."""
-    runner = CliRunner()
-    result = runner.invoke(cli.main)
-    assert result.exit_code == 0
-    assert 'sheets.cli.main' in result.output
-    help_result = runner.invoke(cli.main, ['--help'])
-    assert help_result.exit_code == 0
-    assert '--help  Show this message and exit.' in help_result.output
+def env(tmpdir, sent):
+    environment = env_module.Environment(str(tmpdir))
+    environment.stream_output = False
+    return environment
+
+
+def test_unchanged_execution_is_replayed(env, sent):
+    env.execute("a.py", "x = [1, 2]\n")
+    env.execute("a.py", "x = [1, 2]\n")
+    assert [e.cached for e in sent.executions("a.py")] == [False, True]
+
+
+def test_rebound_immutable_invalidates_even_with_reused_id(env, sent, monkeypatch):
+    # Every value gets the same id(), as a freed value's id can be reused
+    monkeypatch.setattr(env_module, "id", lambda o: 1, raising=False)
+    env.execute("a.py", "x = 10 ** 20\n")
+    env.execute("b.py", "y = x + 1\n")
+    env.execute("a.py", "x = 10 ** 21\n")
+    env.execute("b.py", "y = x + 1\n")
+    assert sent.executions("b.py")[-1].cached is False
+    assert env.globals["y"] == 10 ** 21 + 1
+
+
+def test_deleted_global_invalidates(env, sent):
+    env.execute("a.py", "x = 1\n")
+    env.execute("b.py", "y = x if 'x' in globals() else None\n")
+    env.execute("c.py", "del x\n")
+    env.execute("b.py", "y = x if 'x' in globals() else None\n")
+    assert sent.executions("b.py")[-1].cached is False
+    assert env.globals["y"] is None
+
+
+def test_module_attribute_change_invalidates(env, sent):
+    env.execute("a.py", "import types\ncfg = types.ModuleType('cfg')\ncfg.x = 1\n")
+    env.execute("b.py", "y = cfg.x\n")
+    env.execute("c.py", "cfg.x = 2\n")
+    env.execute("b.py", "y = cfg.x\n")
+    assert sent.executions("b.py")[-1].cached is False
+    assert env.globals["y"] == 2
+
+
+def test_mutated_outputs_are_not_replayed(env, sent):
+    env.execute("a.py", "data = [3, 1, 2]\n")
+    env.execute("b.py", "data.sort()\n")
+    env.execute("a.py", "data = [3, 1, 2]\n")
+    assert sent.executions("a.py")[-1].cached is False
+    assert env.globals["data"] == [3, 1, 2]
+
+
+def test_streamed_output_is_sent_while_cell_runs(env, sent):
+    env.stream_output = True
+    env.flush_output_in_background = True
+    env.execute("a.py", "import time\nprint('loading')\ntime.sleep(0.6)\nprint('done')\n")
+    chunks = [c for c in sent.sent if type(c).__name__ == "ExecutionOutput"]
+    printed = [[part["str"] for item in c.emitted for part in item["parts"]] for c in chunks]
+    assert "loading" in printed[0] and "done" not in printed[0]
+    assert "done" in sum(printed[1:], [])
+    assert sent.executions("a.py")[-1].output_chunks == len(chunks)
+
+
+def test_clean_commands_keeps_what_is_still_needed(tmpdir):
+    from sheets import datalayer
+    from sheets.history import History
+
+    def execution(id):
+        return datalayer.Execution(
+            filename="a.py", content="", emitted=[], defines={},
+            start_time=0, end_time=0, exec_time=0, id=id)
+
+    def analysis(id):
+        return datalayer.Analysis(filename="a.py", content="", properties={}, id=id)
+
+    def patch(id, version):
+        return datalayer.FilePatch(filename="a.py", base_version=version, ops=[], id=id)
+
+    history = History(str(tmpdir), backend="log")
+    for command in [
+            datalayer.FileEdit(filename="a.py", content="", id="c-01"),
+            analysis("c-02"),
+            patch("c-03", 1),
+            analysis("c-04"),
+            execution("c-05"),
+            patch("c-06", 2),
+            analysis("c-07"),
+            patch("c-08", 3),
+            analysis("c-09"),
+            datalayer.FileEdit(filename="b.py", content="", id="c-10"),
+            execution("c-11")]:
+        history.save_command(command)
+    history.clean_commands()
+    assert [c.id for c in history.get_commands()] == [
+        "c-01", "c-03", "c-04", "c-06", "c-08", "c-09", "c-10", "c-11"]
+
+
+@pytest.mark.parametrize("name", ["json", "msgpack"])
+def test_encode_values_the_encodings_cant_represent(name):
+    from sheets import encoding
+    if name == "msgpack" and encoding.msgpack is None:
+        pytest.skip("msgpack isn't installed")
+    data = {"command": "Execution", "values": [1, float("nan"), float("-inf"), 2 ** 70, -2 ** 70, object]}
+    decoded = encoding.decode(encoding.encode(data, name))
+    assert decoded["values"][:5] == [1, "nan", "-inf", str(2 ** 70), str(-2 ** 70)]
+    assert decoded["values"][5] == repr(object)
+
+
+def test_value_expansion_only_goes_to_the_socket_that_asked(monkeypatch):
+    from sheets import datalayer, server
+
+    class FakeSocket:
+        encoding = "json"
+
+        def __init__(self, socket_id):
+            self.socket_id = socket_id
+            self.send_queue = self
+            self.queued = []
+
+        def put(self, data, key=None):
+            self.queued.append(data)
+
+    asker, other = FakeSocket("s-1"), FakeSocket("s-2")
+    monkeypatch.setattr(server, "sockets", [asker, other])
+    # The reply isn't applied to the model, or saved in history:
+    a_router = router.Router(env=None, model=None)
+    a_router.send(datalayer.ValueExpansion(handle="v-1", offset=None, page={}, reply_to="s-1"))
+    assert len(asker.queued) == 1 and other.queued == []
+
+
+def test_value_registry_keeps_strong_values_within_budget(monkeypatch):
+    from sheets.jsonify import ValueRegistry
+    registry = ValueRegistry()
+    monkeypatch.setattr(registry, "max_strong_bytes", 100000)
+    # Each is about 18KB, counting the ints in it:
+    values = [list(range(500)) for i in range(10)]
+    handles = [registry.register(v) for v in values]
+    assert registry.get(handles[-1]) is values[-1]
+    assert registry.get(handles[0]) is None
+    assert registry.strong_bytes <= 100000
+
+
+def test_rebound_defines_are_forgotten(env, sent):
+    from sheets.jsonify import value_registry
+    env.execute("a.py", "x = [list(range(100)) for i in range(100)]\n")
+    handle = sent.executions("a.py")[-1].defines["x"]["json"]["handle"]
+    assert value_registry.get(handle) is not None
+    env.execute("b.py", "x = None\n")
+    assert value_registry.get(handle) is None
+
+
+def test_large_frame_stats_are_sampled(monkeypatch):
+    pandas = pytest.importorskip("pandas")
+    from sheets.support import pandas as pandas_support
+    monkeypatch.setattr(pandas_support, "stats_max_size", 100)
+    df = pandas.DataFrame({"a": range(1000), "b": [1.5] * 1000})
+    stats = pandas_support.column_stats(df)
+    assert stats["a"]["sampled"] and stats["b"]["sampled"]
+    assert stats["a"]["min"] == 0 and stats["b"]["mean"] == 1.5
+    assert "sampled" not in pandas_support.column_stats(df.head(10))["a"]
+
+
+def test_all_na_nullable_columns_have_no_min_max_mean():
+    pandas = pytest.importorskip("pandas")
+    from sheets.support import pandas as pandas_support
+    df = pandas.DataFrame({
+        "a": pandas.array([pandas.NA] * 3, dtype="Int64"),
+        "b": pandas.array([1.5, pandas.NA, 2.5], dtype="Float64"),
+    })
+    stats = pandas_support.column_stats(df)
+    assert stats["a"] == {"nan_count": 3}
+    assert stats["b"] == {"nan_count": 1, "min": 1.5, "max": 2.5, "mean": 2.0}
+
+
+def test_wide_tables_show_edge_columns_and_page_the_rest():
+    numpy = pytest.importorskip("numpy")
+    pandas = pytest.importorskip("pandas")
+    from sheets.jsonify import jsonify, jsonify_page
+    from sheets.support import pandas as pandas_support
+    x = numpy.arange(3 * 100).reshape(3, 100)
+    d = jsonify(x)
+    assert d["column_count"] == 100
+    assert d["column_windows"] == [[0, 10], [90, 100]]
+    assert d["head"][0] == [str(i) for i in list(range(10)) + list(range(90, 100))]
+    page = jsonify_page(x, None, None, 10)
+    assert page["type"] == "table_columns"
+    assert page["column_windows"] == [[10, 30]]
+    assert page["head"][1] == [str(100 + i) for i in range(10, 30)]
+    page = jsonify_page(x, 1, 1, 95)
+    assert page["rows"] == [[str(100 + i) for i in range(95, 100)]]
+    assert len(jsonify_page(x, 1, 1)["rows"][0]) == 20
+    assert "column_windows" not in jsonify(x[:, :20])
+
+    df = pandas.DataFrame(x, columns=["c%d" % i for i in range(100)])
+    d = jsonify(df)
+    assert d["columns"] == ["c%d" % i for i in list(range(10)) + list(range(90, 100))]
+    assert len(d["dtypes"]) == len(d["stats"]) == 20
+    assert d["head"][2][:2] == ["2", "200"]
+    page = jsonify_page(df, None, None, 40)
+    assert page["columns"][0] == "c40" and page["head"][0][1] == "40"
+    assert pandas_support.value_size(df) == numpy.sum(df.memory_usage(index=True))
+
+
+def test_type_dispatch_order_and_cached_result_is_immutable():
+    from sheets.typedispatch import TypeDispatcher
+    dispatch = TypeDispatcher()
+    dispatch.register_function(object, "object")
+    dispatch.register_function(int, "int")
+    dispatch.register_function(bool, "bool")
+    assert dispatch.funcs_for_type(bool) == ("bool", "int", "object")
+    assert dispatch.funcs_for_type(bool) is dispatch.funcs_for_type(bool)
+    dispatch.register_function(bool, "bool again")
+    assert dispatch.funcs_for_type(bool) == ("bool", "bool again", "int", "object")
+
+
+def test_conflicting_patch_is_resynced_then_accepted(tmpdir, monkeypatch):
+    from sheets import datalayer, server
+    from sheets.history import History
+    broadcast = []
+    monkeypatch.setattr(server, "send", broadcast.append)
+    environment = env_module.Environment(str(tmpdir))
+    model = datalayer.Model(environment, History(str(tmpdir), backend="log"))
+    a_router = router.Router(env=environment, model=model)
+    monkeypatch.setattr(router, "a_router", a_router)
+    a_router.incoming({"command": "FileEdit", "filename": "a.py", "content": "x = 1\n"})
+    # Made against a version the server no longer has:
+    a_router.incoming({"command": "FilePatch", "filename": "a.py", "base_version": 0, "ops": [[4, 5, "2"]]})
+    resync = broadcast[-1]
+    assert resync["command"] == "FileEdit" and resync["content"] == "x = 1\n"
+    assert resync["version"] == model.files["a.py"]["version"]
+    a_router.incoming({
+        "command": "FilePatch", "filename": "a.py",
+        "base_version": resync["version"], "ops": [[4, 5, "2"]]})
+    assert model.files["a.py"]["content"] == "x = 2\n"
+    assert model.files["a.py"]["version"] == resync["version"] + 1
+
+
+def test_background_tasks_dont_run_foreground_tasks():
+    import threading
+    from sheets import datalayer
+    model = datalayer.Model(env=None, history=None)
+    ran = []
+    done = threading.Event()
+    model.add_task(("execute_request", "a.py"), lambda: ran.append(threading.current_thread()))
+
+    def analyze():
+        # As when an Analysis is sent through the router
+        model.run_tasks()
+        done.set()
+
+    model.add_task(("analyze", "a.py"), analyze, background=True)
+    assert done.wait(5)
+    assert ran == []
+    model.run_tasks()
+    assert ran == [threading.current_thread()]
+
+
+def test_tasks_pop_by_priority_then_order_added():
+    import time
+    from sheets import datalayer
+    model = datalayer.Model(env=None, history=None)
+    for key, priority in [("a", 10), ("b", 0), ("c", 10), ("d", 0)]:
+        model.add_task((key,), None, priority=priority)
+    # Replacing a task moves it to the end, and the old one is skipped
+    model.add_task(("b",), "new b")
+    model.add_task(("later",), None, priority=-1, delay=0.2)
+    model.tasks.pop(("c",))
+    popped = []
+    while True:
+        task = model.pop_task(background=False)
+        if task is None:
+            break
+        popped.append(task.key[0])
+        if task.key == ("b",):
+            assert task.runner == "new b"
+    assert popped == ["d", "b", "a"]
+    assert model.next_due(background=False) > time.time()
+    time.sleep(0.25)
+    assert model.pop_task(background=False).key == ("later",)
+    assert model.tasks == {}
+    assert model.next_due(background=False) is None
+
+
+def test_file_watcher_drops_reads_of_files_replaced_since(tmpdir, env):
+    pytest.importorskip("watchdog")
+    import os
+    from sheets import datalayer, filewatch
+    datalayer.write_file(env, "a.py", "x = 1\n")
+    assert os.listdir(str(tmpdir)) == ["a.py"]
+    handler = filewatch.FileStoreEventHandler(env, model=None)
+    # Only the checks are tested, not processing the queued file:
+    handler.process_file = lambda name: None
+    path = os.path.join(str(tmpdir), "a.py")
+    stats = handler.file_stats(os.stat(path))
+    assert handler.unchanged_since_read("a.py", path, stats)
+    datalayer.write_file(env, "a.py", "x = 2\n")
+    assert not handler.unchanged_since_read("a.py", path, stats)
+    assert handler.pending == {"a.py"}
+
+
+def test_loop_progress_total_uses_length_hint(env, sent, monkeypatch):
+    monkeypatch.setattr(env_module, "progress_delay", 0)
+    env.stream_output = True
+    env.execute("a.py", (
+        "class NoLength:\n"
+        "    def __iter__(self):\n"
+        "        return iter(range(3))\n"
+        "    def __len__(self):\n"
+        "        raise TypeError('no length')\n"
+        "for i in NoLength():\n"
+        "    pass\n"
+        "for i in iter([1, 2, 3]):\n"
+        "    pass\n"))
+    progress = [c for c in sent.sent if type(c).__name__ == "ExecutionProgress"]
+    totals = dict((c.lineno, c.total) for c in progress)
+    assert totals == {6: None, 8: 3}
+    assert not progress[0].saved_in_history
+
+
+def test_bytecode_cache_removes_least_recently_used_files(tmpdir, monkeypatch):
+    import os
+    from sheets import compilecache
+    from sheets.env import compile_cell
+    monkeypatch.setattr(compilecache, "max_bytecode_files", 3)
+    monkeypatch.setattr(compilecache, "prune_every", 1)
+    cache = compilecache.CompileCache(str(tmpdir), bytecode=True)
+    for i in range(5):
+        content = "x = %s\n" % i
+        cache.compiled("a.py", str(i), (), lambda: compile_cell("a.py", content, False, False))
+        # Distinct modification times, oldest first:
+        for name in os.listdir(cache.bytecode_path):
+            path = os.path.join(cache.bytecode_path, name)
+            os.utime(path, (os.stat(path).st_mtime - 10,) * 2)
+    assert len(os.listdir(cache.bytecode_path)) == 3
+    assert cache.load_bytecode(("compiled", "a.py", "4", ())) is not None
+    assert cache.load_bytecode(("compiled", "a.py", "0", ())) is None
+
+
+def test_bytecode_cache_is_keyed_on_the_rewriter_version(tmpdir, monkeypatch):
+    import os
+    from sheets import compilecache
+    from sheets.env import compile_cell
+    cache = compilecache.CompileCache(str(tmpdir), bytecode=True)
+    key = ("compiled", "a.py", "hash", ())
+    cache.compiled("a.py", "hash", (), lambda: compile_cell("a.py", "x = 1\n", False, False))
+    filename, = os.listdir(cache.bytecode_path)
+    with open(os.path.join(cache.bytecode_path, filename), "rb") as fp:
+        assert fp.read().startswith(compilecache.bytecode_header())
+    assert cache.load_bytecode(key) is not None
+    monkeypatch.setattr(compilecache, "rewriter_version", compilecache.rewriter_version + 1)
+    assert cache.load_bytecode(key) is None
+    # Even a file with the old name isn't loaded
+    os.replace(os.path.join(cache.bytecode_path, filename), cache.bytecode_filename(key))
+    assert cache.load_bytecode(key) is None
+
+
+def expr_stats(sent, filename="a.py"):
+    emitted = sent.executions(filename)[-1].emitted
+    return dict((item["expr_string"], item) for item in emitted if item["type"] == "expr_stats")
+
+
+def test_expr_stats_skip_non_finite_and_stringify_big_ints(env, sent):
+    env.execute("a.py", (
+        "for x in [float('nan'), 2.5, float('inf'), -1.5] * 20:\n"
+        "    x\n"
+        "for y in [2 ** 60, 1] * 20:\n"
+        "    y\n"), subexpressions=True)
+    stats = expr_stats(sent)
+    assert (stats["x"]["min"], stats["x"]["max"], stats["x"]["count"]) == (-1.5, 2.5, 80)
+    assert (stats["y"]["min"], stats["y"]["max"]) == (1, str(2 ** 60))
+
+
+def test_none_and_boring_values_dont_suppress_later_values(env, sent):
+    env.execute("a.py", (
+        "out = []\n"
+        "for i in range(5):\n"
+        "    out.append(i)\n"
+        "d = {3: 5}\n"
+        "for k in [1, 3]:\n"
+        "    v = d.get(k)\n"), subexpressions=True)
+    printed = [
+        (item["expr_string"], item["expr_value"])
+        for item in sent.executions("a.py")[-1].emitted if item["type"] == "print_expr"]
+    # 0 and 1 aren't boring, though they equal the builtins False and True:
+    assert [value["str"] for expr, value in printed if expr == "i"][:5] == ["0", "1", "2", "3", "4"]
+    assert [value["str"] for expr, value in printed if expr == "d.get(k)"] == ["5"]
+    assert "out.append(i)" not in [expr for expr, value in printed]
+    assert expr_stats(sent) == {}
+
+
+def inspect_variables(source):
+    import ast
+    inspector = env_module.VariableInspector()
+    inspector.walk(ast.parse(source))
+    return inspector.json["variables_used"], inspector.json["variables_set"]
+
+
+@pytest.mark.parametrize("source, used, set_", [
+    # Class bodies are a scope, which methods can't see:
+    ("class C:\n    a = x\n    b = a\n    def m(self):\n        return b + y\n",
+     ["b", "x", "y"], ["C"]),
+    # Comprehension variables don't leak:
+    ("r = [i * k for i in data if i]\ni\n", ["data", "i", "k"], ["r"]),
+    # But names bound with := in a comprehension do:
+    ("r = [(n := v) for v in data]\nn\n", ["data"], ["n", "r"]),
+    ("def f():\n    global g\n    g = h\n"
+     "def outer():\n    z = 1\n    def inner():\n        nonlocal z\n        z = w\n    return inner\n",
+     ["h", "w"], ["f", "g", "outer"]),
+    ("match cmd:\n"
+     "    case [a, *rest]:\n        pass\n"
+     "    case {'k': b, **kw}:\n        pass\n"
+     "    case P(x=c) as whole:\n        pass\n",
+     ["P", "cmd"], ["a", "b", "c", "kw", "rest", "whole"]),
+    # Attribute and item assignments use and set the variable, unless it
+    # was already set:
+    ("df['a'] = 1\nobj.attr = 2\nnew = None\nnew.attr = 3\n", ["df", "obj"], ["df", "new", "obj"]),
+    # Functions read globals when called, by which time the file has set them:
+    ("def f():\n    return later\nlater = 1\n", [], ["f", "later"]),
+])
+def test_variable_inspector_scopes(source, used, set_):
+    assert inspect_variables(source) == (used, set_)
+
+
+segments_source = (
+    'x = "héllo → " + nàme\n'
+    'y = f(\n    a,\n    b)\n'
+    'z = f"{nàme!r:>10} {a + 1}"\n'
+)
+
+
+def test_source_segments_match_ast():
+    import ast
+    tree = ast.parse(segments_source)
+    segments = env_module.SourceSegments(segments_source)
+    for node in ast.walk(tree):
+        if hasattr(node, "lineno"):
+            assert segments.get(node) == ast.get_source_segment(segments_source, node)
+
+
+def test_subexpression_strings_come_from_the_source(env, sent):
+    env.execute("a.py", (
+        'nàme = "é"\n'
+        'def f(*args):\n    return len(args)\n'
+        'a = 1\nb = 2\n'
+        '"héllo → " + nàme\n'
+        'f(\n    a,\n    b)\n'
+        'f"{nàme!r:>10} {a + 1}"\n'), subexpressions=True)
+    expr_strings = [
+        item["expr_string"] for item in sent.executions("a.py")[-1].emitted
+        if item["type"] == "print_expr"]
+    assert '"héllo → " + nàme' in expr_strings
+    assert "f(\n    a,\n    b)" in expr_strings
+    assert "a + 1" in expr_strings
+
+
+def test_deleted_globals_are_freed(env, sent):
+    import gc
+    import weakref
+    env.execute("a.py", "class Big:\n    pass\nbig = Big()\n")
+    ref = weakref.ref(env.globals["big"])
+    env.execute("b.py", "del big\n")
+    gc.collect()
+    assert ref() is None
+
+
+def chain_graph():
+    """a.py sets x, b.py uses x and sets y, c.py uses y, d.py is on its own"""
+    from sheets.dependencies import DependencyGraph
+    return DependencyGraph({
+        "a.py": {"variables_set": ["x"]},
+        "b.py": {"variables_used": ["x"], "variables_set": ["y"]},
+        "c.py": {"variables_used": ["y"]},
+        "d.py": {"variables_set": ["x"]},
+    })
+
+
+def test_dependency_provider_is_the_last_earlier_setter():
+    graph = chain_graph()
+    assert graph.provider(["a.py", "d.py"], "b.py") == "a.py"
+    assert graph.provider(["a.py", "d.py"], "0.py") == "d.py"
+    assert graph.provider(["a.py"], "a.py") is None
+    assert graph.provider(None, "a.py") is None
+    assert graph.dependencies["b.py"] == {"a.py"}
+    assert graph.dependencies["a.py"] == set()
+
+
+def test_stale_files_and_their_dependents():
+    graph = chain_graph()
+    contents = dict((name, name) for name in graph.filenames)
+    executed = dict((name, (name, serial)) for serial, name in enumerate(graph.filenames))
+    assert graph.stale(contents, executed) == []
+    # Changed content:
+    assert graph.stale(dict(contents, **{"b.py": "new"}), executed) == ["b.py", "c.py"]
+    # Never executed:
+    assert graph.stale(contents, dict((k, v) for k, v in executed.items() if k != "c.py")) == ["c.py"]
+    # An upstream file re-ran after its dependents:
+    assert graph.stale(contents, dict(executed, **{"a.py": ("a.py", 10)})) == ["b.py", "c.py"]
+    # Files without content aren't checked themselves:
+    assert graph.stale({"c.py": "c.py"}, {"c.py": ("c.py", 0)}) == []
+    assert graph.downstream(["a.py"]) == {"a.py", "b.py", "c.py"}
+    assert graph.downstream(["c.py", "missing.py"]) == {"c.py"}
+
+
+def test_dependency_cycles_fall_back_to_sheet_order():
+    from sheets.dependencies import DependencyGraph
+    graph = DependencyGraph({
+        "p.py": {"variables_used": ["q"], "variables_set": ["p"]},
+        "q.py": {"variables_used": ["p"], "variables_set": ["q"]},
+        "r.py": {"variables_set": ["r"]},
+        "s.py": {"variables_used": ["q", "r"]},
+    })
+    assert graph.dependencies["p.py"] == {"q.py"}
+    assert graph.dependencies["q.py"] == {"p.py"}
+    assert graph.order() == ["r.py", "p.py", "q.py", "s.py"]
+    assert graph.order(only={"s.py", "p.py"}) == ["p.py", "s.py"]
+
+
+def test_containers_are_serialized_once_per_jsonify_call():
+    from sheets.jsonify import jsonify
+    from sheets.encoding import interned_keys
+    # Factories.ref in frontend/src/view.js shows value_type and ref, and
+    # renderRemoteItem labels nodes that have a ref_id
+    assert {"ref", "ref_id", "value_type"} <= set(interned_keys)
+    a_list = [1]
+    a_list.append(a_list)
+    node = jsonify(a_list)
+    assert node["ref_id"] == 0
+    assert node["contents"][1] == {"type": "ref", "ref": 0, "value_type": "list"}
+
+    shared = {"k": 1}
+    node = jsonify([shared, shared, (shared,)])
+    assert "ref_id" not in node
+    first, second, nested = node["contents"]
+    assert first["type"] == "dict" and first["ref_id"] == 1
+    assert second == nested["contents"][0] == {"type": "ref", "ref": 1, "value_type": "dict"}
+    # The memo only lasts for one call
+    assert jsonify(shared)["type"] == "dict"
+
+
+def test_deeply_nested_containers_are_deferred():
+    from sheets import jsonify as jsonify_module
+    from sheets.jsonify import jsonify, jsonify_page, value_registry
+    outer = inner = []
+    for i in range(jsonify_module.max_depth + 5):
+        inner.append([i])
+        inner = inner[-1]
+    node = jsonify(outer)
+    depth = 0
+    while node["type"] == "list":
+        node = node["contents"][-1]
+        depth += 1
+    assert depth == jsonify_module.max_depth
+    assert node["type"] == "deferred" and node["value_type"] == "list" and node["length"] == 2
+    deferred = value_registry.get(node["handle"])
+    assert jsonify_page(deferred)["value"]["type"] == "list"
+
+
+def test_long_bytes_are_truncated_and_paged():
+    from sheets import jsonify as jsonify_module
+    from sheets.jsonify import jsonify, jsonify_page, jsonify_summary, value_registry
+    data = b"'\x00" * jsonify_module.max_str_length
+    node = jsonify(data)
+    assert node["type"] == "str"
+    assert node["str"] == repr(data[:jsonify_module.max_str_length])[:-1]
+    assert node["truncated"]["shown"] == jsonify_module.max_str_length
+    assert node["truncated"]["total"] == len(data)
+    page = jsonify_page(value_registry.get(node["truncated"]["handle"]), len(data) - 3, None)
+    assert page == {
+        "type": "str_page", "str": "\\x00'\\x00", "length": 3, "offset": len(data) - 3,
+        "total": len(data)}
+    assert jsonify(b"ab")["str"] == "b'ab'"
+    assert jsonify_summary(data, name="data")["type"] == "deferred"
+
+
+@pytest.mark.parametrize("backend", ["rocksdb", "sqlite", "log"])
+def test_history_store_round_trip_and_reopen(tmpdir, backend):
+    from sheets import historystore
+    if backend == "rocksdb" and historystore.rocksdb is None:
+        pytest.skip("python-rocksdb is not installed")
+    store_class = historystore.backends[backend]
+    path = str(tmpdir.join(store_class.filename))
+    store = store_class(path)
+    store.put("c-2", b"two")
+    store.put("c-1", b"one")
+    store.write(puts=[("c-3", b"three"), ("c-1", b"uno")], deletes=["c-2"])
+    assert store.keys() == ["c-1", "c-3"]
+    assert store.values() == [b"uno", b"three"]
+    store.put("c-4", b"\x00four")
+    store.close()
+    reopened = store_class(path)
+    assert reopened.keys() == ["c-1", "c-3", "c-4"]
+    assert reopened.values() == [b"uno", b"three", b"\x00four"]
+    reopened.close()
+
+
+def test_sqlite_store_commits_idle_puts_from_a_timer(tmpdir):
+    import sqlite3
+    import time
+    from sheets.historystore import SQLiteStore
+    path = str(tmpdir.join(SQLiteStore.filename))
+    store = SQLiteStore(path)
+    store.commit_interval = 0.1
+    store.last_commit = time.time()
+    store.put("c-1", b"one")
+    reader = sqlite3.connect(path)
+    assert reader.execute("SELECT COUNT(*) FROM history").fetchone()[0] == 0
+    deadline = time.time() + 5
+    while not reader.execute("SELECT COUNT(*) FROM history").fetchone()[0]:
+        assert time.time() < deadline, "put was never committed"
+        time.sleep(0.02)
+    assert store.commit_timer is None
+    store.close()
+
+
+def wait_for(condition, timeout=30):
+    import time
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, "timed out"
+        time.sleep(0.05)
+
+
+def test_kernel_keeps_globals_between_cells_and_can_be_interrupted(tmpdir, sent):
+    import json
+    from sheets.kernel import KernelEnvironment
+
+    def output(filename):
+        # Output is streamed while the cell runs, so look at every chunk
+        return json.dumps([
+            c.emitted for c in sent.sent
+            if type(c).__name__ in ("ExecutionOutput", "Execution") and c.filename == filename])
+
+    kernel = KernelEnvironment(str(tmpdir))
+    try:
+        kernel.execute("a.py", "x = 41\n")
+        kernel.execute("b.py", "print(x + 1)\n")
+        wait_for(lambda: sent.executions("b.py"))
+        assert "42" in output("b.py")
+
+        kernel.execute("c.py", "import time\nprint('started')\nwhile True:\n    time.sleep(0.01)\n")
+        wait_for(lambda: "started" in output("c.py"))
+        kernel.interrupt()
+        wait_for(lambda: sent.executions("c.py"))
+        assert "KeyboardInterrupt" in output("c.py")
+
+        # The same process is still running, with the same globals
+        pid = kernel.process.pid
+        kernel.execute("d.py", "print(x)\n")
+        wait_for(lambda: sent.executions("d.py"))
+        assert "41" in output("d.py")
+        assert kernel.process.pid == pid and kernel.process.is_alive()
+    finally:
+        kernel.close()
+        kernel.process.join(5)
+        if kernel.process.is_alive():
+            kernel.process.terminate()